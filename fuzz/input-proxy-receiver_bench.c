@@ -0,0 +1,576 @@
+/*
+ * The Qubes OS Project, http://www.qubes-os.org
+ *
+ * Copyright (C) 2026 agent <agent@local>
+ *
+ * This program is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License
+ * as published by the Free Software Foundation; either version 2
+ * of the License, or (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+ *
+ */
+
+/* Benchmark of the receiver validation path, built the same way as the fuzzer.
+ *
+ * Each stream (a descriptor from the seed corpus followed by events) is fed to
+ * the receiver main on stdin, the same as the fuzzer does, so it goes through
+ * receive_and_validate_caps() and then the per-event validation. Streams are
+ * the seed corpus descriptor x events combinations, scaled up to the requested
+ * number of events, and generated streams of a single event type. Handshake
+ * alone is measured separately, per handshake.
+ *
+ * The result is the best time out of several runs, in ns/event. With
+ * --baseline, results are compared to a previously saved file (see
+ * --update-baseline) and the exit code is 1 if any stream got slower than the
+ * tolerance allows.
+ */
+
+#include <unistd.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <fcntl.h>
+#include <getopt.h>
+#include <time.h>
+#include <dirent.h>
+#include "common.h"
+
+#ifndef FUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION
+#error "This file is meant only for fuzzing build"
+#endif
+
+/* too lazy to create one-line header file */
+int input_proxy_receiver_main(int argc, char **argv);
+
+#define MAX_RESULTS 64
+
+struct bench_options {
+    const char *corpus_dir;
+    const char *baseline_path;
+    const char *update_baseline_path;
+    unsigned long events;
+    int repeat;
+    double tolerance;
+};
+
+struct result {
+    char name[128];
+    double ns;
+};
+
+struct results {
+    struct result r[MAX_RESULTS];
+    int count;
+};
+
+struct blob {
+    char *data;
+    size_t size;
+};
+
+/* the real stdout, fd 1 is replaced for the receiver */
+static FILE *report;
+/* put in place of the receiver's stdin/stdout between runs */
+static int devnull = -1;
+
+static int load_file(const char *dir, const char *name, struct blob *blob) {
+    char path[4096];
+    FILE *f;
+    long size;
+
+    snprintf(path, sizeof(path), "%s/%s", dir, name);
+    f = fopen(path, "rb");
+    if (!f) {
+        perror(path);
+        return -1;
+    }
+    if (fseek(f, 0, SEEK_END) == -1 || (size = ftell(f)) == -1 ||
+            fseek(f, 0, SEEK_SET) == -1) {
+        perror(path);
+        fclose(f);
+        return -1;
+    }
+    blob->data = malloc(size ? size : 1);
+    if (!blob->data) {
+        perror("malloc");
+        fclose(f);
+        return -1;
+    }
+    if (fread(blob->data, 1, size, f) != (size_t)size) {
+        perror(path);
+        free(blob->data);
+        fclose(f);
+        return -1;
+    }
+    blob->size = size;
+    fclose(f);
+    return 0;
+}
+
+/* write the descriptor followed by events repeated until at least count events
+ * are written; the file is left open for run_stream()
+ *
+ * returns: -1 on error, fd otherwise
+ */
+static int write_stream(const struct blob *descr, const struct input_event *ev,
+        size_t ev_count, unsigned long count) {
+    char path[] = "/tmp/input-proxy-bench-XXXXXX";
+    unsigned long written = 0;
+    int fd;
+
+    fd = mkstemp(path);
+    if (fd == -1) {
+        perror("mkstemp");
+        return -1;
+    }
+    unlink(path);
+    if (write_all(fd, descr->data, descr->size) == -1)
+        goto err;
+    while (ev_count && written < count) {
+        if (write_all(fd, ev, ev_count * sizeof(ev[0])) == -1)
+            goto err;
+        written += ev_count;
+    }
+    return fd;
+
+err:
+    perror("write stream");
+    close(fd);
+    return -1;
+}
+
+static double elapsed_ns(const struct timespec *start,
+        const struct timespec *end) {
+    return (end->tv_sec - start->tv_sec) * 1e9 +
+        (end->tv_nsec - start->tv_nsec);
+}
+
+/* feed the stream to the receiver repeat times
+ *
+ * returns: -1 on error, the best run time in ns otherwise
+ */
+static double run_stream(int stream_fd, int repeat) {
+    char *argv[] = {
+        "input-proxy-receiver",
+        "--mouse",
+        "--keyboard",
+        "--tablet",
+        "--autorepeat",
+        "--quiet",
+    };
+    struct timespec start, end;
+    double best = -1, ns;
+    int i, rc;
+
+    for (i = 0; i < repeat; i++) {
+        if (lseek(stream_fd, 0, SEEK_SET) == -1 ||
+                dup2(stream_fd, 0) == -1 || dup2(devnull, 1) == -1) {
+            perror("prepare stdin/stdout");
+            best = -1;
+            break;
+        }
+        /* restart getopt for each call of the receiver main */
+        optind = 1;
+        clock_gettime(CLOCK_MONOTONIC, &start);
+        rc = input_proxy_receiver_main(sizeof(argv)/sizeof(argv[0]), argv);
+        clock_gettime(CLOCK_MONOTONIC, &end);
+        dup2(devnull, 0);
+        dup2(devnull, 1);
+        if (rc != 0) {
+            fprintf(stderr, "receiver rejected the stream\n");
+            best = -1;
+            break;
+        }
+        ns = elapsed_ns(&start, &end);
+        if (best < 0 || ns < best)
+            best = ns;
+    }
+    return best;
+}
+
+static int add_result(struct results *results, const char *name, double ns) {
+    struct result *r;
+
+    if (results->count == MAX_RESULTS) {
+        fprintf(stderr, "Too many results\n");
+        return -1;
+    }
+    r = &results->r[results->count++];
+    snprintf(r->name, sizeof(r->name), "%s", name);
+    r->ns = ns;
+    return 0;
+}
+
+/* measure one stream and record ns per unit (event or handshake) */
+static int bench_stream(const struct bench_options *opt,
+        struct results *results, const char *name, const struct blob *descr,
+        const struct input_event *ev, size_t ev_count, unsigned long count) {
+    unsigned long units;
+    double ns;
+    int fd;
+
+    fd = write_stream(descr, ev, ev_count, count);
+    if (fd == -1)
+        return -1;
+    /* a handshake alone is too short to measure it reliably in few runs */
+    ns = run_stream(fd, ev_count ? opt->repeat : opt->repeat * 100);
+    close(fd);
+    if (ns < 0) {
+        fprintf(stderr, "Stream %s failed\n", name);
+        return -1;
+    }
+    /* events actually written, rounded up to whole repetitions */
+    units = ev_count ? (count + ev_count - 1) / ev_count * ev_count : 1;
+    return add_result(results, name, ns / units);
+}
+
+#define EV(t, c, v) { .type = (t), .code = (c), .value = (v) }
+
+/* single event type streams, on top of the descriptor that supports them */
+static const struct input_event gen_rel[] = {
+    EV(EV_REL, REL_X, 3), EV(EV_REL, REL_Y, -2), EV(EV_SYN, SYN_REPORT, 0),
+    EV(EV_REL, REL_X, -3), EV(EV_REL, REL_Y, 2), EV(EV_SYN, SYN_REPORT, 0),
+};
+static const struct input_event gen_key[] = {
+    EV(EV_KEY, KEY_A, 1), EV(EV_SYN, SYN_REPORT, 0),
+    EV(EV_KEY, KEY_A, 0), EV(EV_SYN, SYN_REPORT, 0),
+};
+static const struct input_event gen_abs[] = {
+    EV(EV_ABS, ABS_X, 1000), EV(EV_ABS, ABS_Y, 1000),
+    EV(EV_SYN, SYN_REPORT, 0),
+    EV(EV_ABS, ABS_X, 1010), EV(EV_ABS, ABS_Y, 990),
+    EV(EV_SYN, SYN_REPORT, 0),
+};
+static const struct input_event gen_syn[] = {
+    EV(EV_SYN, SYN_REPORT, 0),
+};
+
+struct generated {
+    const char *name;
+    const char *descr;
+    const struct input_event *ev;
+    size_t ev_count;
+};
+
+static const struct generated generated[] = {
+    { "gen-rel", "descriptor-mouse.bin", gen_rel,
+        sizeof(gen_rel)/sizeof(gen_rel[0]) },
+    { "gen-key", "descriptor-keyboard-old.bin", gen_key,
+        sizeof(gen_key)/sizeof(gen_key[0]) },
+    { "gen-abs", "descriptor-tablet-new.bin", gen_abs,
+        sizeof(gen_abs)/sizeof(gen_abs[0]) },
+    { "gen-syn", "descriptor-mouse.bin", gen_syn,
+        sizeof(gen_syn)/sizeof(gen_syn[0]) },
+};
+
+static int name_cmp(const void *a, const void *b) {
+    return strcmp(*(char * const *)a, *(char * const *)b);
+}
+
+/* list corpus files starting with prefix, sorted
+ *
+ * returns: -1 on error, number of files otherwise
+ */
+static int list_corpus(const char *dir, const char *prefix, char ***names) {
+    DIR *d;
+    struct dirent *de;
+    char **list = NULL, **new_list;
+    int count = 0;
+
+    d = opendir(dir);
+    if (!d) {
+        perror(dir);
+        return -1;
+    }
+    while ((de = readdir(d))) {
+        if (strncmp(de->d_name, prefix, strlen(prefix)) != 0)
+            continue;
+        new_list = realloc(list, (count + 1) * sizeof(list[0]));
+        if (!new_list || !(new_list[count] = strdup(de->d_name))) {
+            perror("alloc");
+            free(new_list);
+            closedir(d);
+            return -1;
+        }
+        list = new_list;
+        count++;
+    }
+    closedir(d);
+    qsort(list, count, sizeof(list[0]), name_cmp);
+    *names = list;
+    return count;
+}
+
+static void free_list(char **list, int count) {
+    while (count > 0)
+        free(list[--count]);
+    free(list);
+}
+
+static int bench_corpus(const struct bench_options *opt,
+        struct results *results) {
+    char **descrs = NULL, **events = NULL;
+    int descr_count, events_count;
+    struct blob descr, ev;
+    char name[128];
+    int i, j, rc = -1;
+
+    descr_count = list_corpus(opt->corpus_dir, "descriptor", &descrs);
+    if (descr_count == -1)
+        return -1;
+    events_count = list_corpus(opt->corpus_dir, "events", &events);
+    if (events_count == -1)
+        goto out;
+
+    for (i = 0; i < descr_count; i++) {
+        if (load_file(opt->corpus_dir, descrs[i], &descr) == -1)
+            goto out;
+        snprintf(name, sizeof(name), "caps-%s", descrs[i]);
+        if (bench_stream(opt, results, name, &descr, NULL, 0, 0) == -1) {
+            free(descr.data);
+            goto out;
+        }
+        for (j = 0; j < events_count; j++) {
+            if (load_file(opt->corpus_dir, events[j], &ev) == -1) {
+                free(descr.data);
+                goto out;
+            }
+            snprintf(name, sizeof(name), "%s-%s", descrs[i], events[j]);
+            rc = bench_stream(opt, results, name, &descr,
+                    (struct input_event *)ev.data,
+                    ev.size / sizeof(struct input_event), opt->events);
+            free(ev.data);
+            if (rc == -1) {
+                free(descr.data);
+                goto out;
+            }
+        }
+        free(descr.data);
+    }
+    rc = 0;
+out:
+    free_list(descrs, descr_count);
+    if (events_count > 0)
+        free_list(events, events_count);
+    return rc;
+}
+
+static int bench_generated(const struct bench_options *opt,
+        struct results *results) {
+    struct blob descr;
+    size_t i;
+    int rc;
+
+    for (i = 0; i < sizeof(generated)/sizeof(generated[0]); i++) {
+        if (load_file(opt->corpus_dir, generated[i].descr, &descr) == -1)
+            return -1;
+        rc = bench_stream(opt, results, generated[i].name, &descr,
+                generated[i].ev, generated[i].ev_count, opt->events);
+        free(descr.data);
+        if (rc == -1)
+            return -1;
+    }
+    return 0;
+}
+
+/* baseline file format: one "name ns" pair per line */
+static int load_baseline(const char *path, struct results *baseline) {
+    FILE *f;
+    char name[128];
+    double ns;
+
+    f = fopen(path, "r");
+    if (!f) {
+        perror(path);
+        return -1;
+    }
+    while (fscanf(f, "%127s %lf", name, &ns) == 2) {
+        if (add_result(baseline, name, ns) == -1) {
+            fclose(f);
+            return -1;
+        }
+    }
+    fclose(f);
+    return 0;
+}
+
+static int save_baseline(const char *path, const struct results *results) {
+    FILE *f;
+    int i;
+
+    f = fopen(path, "w");
+    if (!f) {
+        perror(path);
+        return -1;
+    }
+    for (i = 0; i < results->count; i++)
+        fprintf(f, "%s %.2f\n", results->r[i].name, results->r[i].ns);
+    if (fclose(f) == EOF) {
+        perror(path);
+        return -1;
+    }
+    return 0;
+}
+
+static const struct result *find_result(const struct results *results,
+        const char *name) {
+    int i;
+
+    for (i = 0; i < results->count; i++) {
+        if (strcmp(results->r[i].name, name) == 0)
+            return &results->r[i];
+    }
+    return NULL;
+}
+
+/* print results, compare them with the baseline, if any
+ *
+ * returns: number of results above the baseline
+ */
+static int report_results(const struct bench_options *opt,
+        const struct results *results, const struct results *baseline) {
+    const struct result *base;
+    int i, regressions = 0;
+    double limit;
+
+    for (i = 0; i < results->count; i++) {
+        base = baseline ? find_result(baseline, results->r[i].name) : NULL;
+        fprintf(report, "%-60s %10.2f ns/%s", results->r[i].name,
+                results->r[i].ns,
+                strncmp(results->r[i].name, "caps-", 5) ? "event" : "handshake");
+        if (base) {
+            limit = base->ns * (1 + opt->tolerance / 100);
+            fprintf(report, "  (baseline %.2f, %+.1f%%)%s",
+                    base->ns, (results->r[i].ns / base->ns - 1) * 100,
+                    results->r[i].ns > limit ? "  REGRESSION" : "");
+            if (results->r[i].ns > limit)
+                regressions++;
+        }
+        fprintf(report, "\n");
+    }
+    return regressions;
+}
+
+static void usage(const char *argv0) {
+    fprintf(stderr, "Usage: %s [options]\n", argv0);
+    fprintf(stderr, "   --corpus=DIR - descriptors and events (default: seed-corpus-in)\n");
+    fprintf(stderr, "   --events=N - events in each stream (default: 1000000)\n");
+    fprintf(stderr, "   --repeat=N - runs of each stream, the best one counts (default: 5)\n");
+    fprintf(stderr, "   --baseline=FILE - compare results with FILE, fail on regression\n");
+    fprintf(stderr, "   --tolerance=PERCENT - allowed slowdown over the baseline (default: 20)\n");
+    fprintf(stderr, "   --update-baseline=FILE - save results to FILE\n");
+}
+
+#define OPT_CORPUS 128
+#define OPT_EVENTS 129
+#define OPT_REPEAT 130
+#define OPT_BASELINE 131
+#define OPT_TOLERANCE 132
+#define OPT_UPDATE_BASELINE 133
+
+static int parse_options(struct bench_options *opt, int argc, char **argv) {
+    struct option opts[] = {
+        { "corpus",    1, 0, OPT_CORPUS },
+        { "events",    1, 0, OPT_EVENTS },
+        { "repeat",    1, 0, OPT_REPEAT },
+        { "baseline",  1, 0, OPT_BASELINE },
+        { "tolerance", 1, 0, OPT_TOLERANCE },
+        { "update-baseline", 1, 0, OPT_UPDATE_BASELINE },
+        { "help",      0, 0, 'h' },
+        { 0, 0, 0, 0 },
+    };
+    int o;
+
+    opt->corpus_dir = "seed-corpus-in";
+    opt->events = 1000000;
+    opt->repeat = 5;
+    opt->tolerance = 20;
+
+    while ((o = getopt_long(argc, argv, "h", opts, NULL)) != -1) {
+        switch (o) {
+            case OPT_CORPUS:
+                opt->corpus_dir = optarg;
+                break;
+            case OPT_EVENTS:
+                opt->events = strtoul(optarg, NULL, 10);
+                break;
+            case OPT_REPEAT:
+                opt->repeat = atoi(optarg);
+                break;
+            case OPT_BASELINE:
+                opt->baseline_path = optarg;
+                break;
+            case OPT_TOLERANCE:
+                opt->tolerance = atof(optarg);
+                break;
+            case OPT_UPDATE_BASELINE:
+                opt->update_baseline_path = optarg;
+                break;
+            case 'h':
+                usage(argv[0]);
+                exit(0);
+            default:
+                usage(argv[0]);
+                return -1;
+        }
+    }
+    if (optind < argc || !opt->events || opt->repeat <= 0 ||
+            opt->tolerance < 0) {
+        usage(argv[0]);
+        return -1;
+    }
+    return 0;
+}
+
+int main(int argc, char **argv) {
+    struct bench_options opt = { 0 };
+    static struct results results, baseline;
+    int regressions;
+    int stdout_fd;
+
+    if (parse_options(&opt, argc, argv) == -1)
+        return 2;
+
+    if (opt.baseline_path && load_baseline(opt.baseline_path, &baseline) == -1)
+        return 2;
+
+    /* stdout is given to the receiver (as /dev/null) while it runs */
+    stdout_fd = dup(1);
+    if (stdout_fd == -1 || !(report = fdopen(stdout_fd, "w"))) {
+        perror("dup stdout");
+        return 2;
+    }
+    devnull = open("/dev/null", O_RDWR);
+    if (devnull == -1) {
+        perror("open /dev/null");
+        return 2;
+    }
+
+    if (bench_corpus(&opt, &results) == -1 ||
+            bench_generated(&opt, &results) == -1)
+        return 2;
+
+    regressions = report_results(&opt, &results,
+            opt.baseline_path ? &baseline : NULL);
+    fflush(report);
+
+    if (opt.update_baseline_path &&
+            save_baseline(opt.update_baseline_path, &results) == -1)
+        return 2;
+
+    if (regressions) {
+        fprintf(stderr, "%d stream(s) slower than the baseline\n", regressions);
+        return 1;
+    }
+    return 0;
+}
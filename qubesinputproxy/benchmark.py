@@ -0,0 +1,457 @@
+#!/usr/bin/python
+# vim: fileencoding=utf-8
+
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""End-to-end benchmark of input-proxy-sender and input-proxy-receiver.
+
+Both tools run locally, connected with a socketpair in place of qrexec. The
+sender reads a virtual source device (created with uinput), the receiver
+creates its own output device, which is read back here. For each workload it
+reports events/s, end-to-end latency (from writing a frame to the source
+device to the kernel timestamp of the same frame on the output device) and CPU
+time used by both tools per event. Results are written as JSON, so they can be
+compared between builds.
+
+It needs access to /dev/uinput and /dev/input/event*, so usually root. The
+devices are real input devices for the rest of the system too, so better run
+it where nothing uses them (no X server etc), for example::
+
+    sudo python3 -m qubesinputproxy.benchmark --build-dir=src \\
+        --output=results.json mouse keyboard tablet
+"""
+
+import argparse
+import json
+import os
+import platform
+import select
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from qubesinputproxy import evdev
+
+# frames in flight when not paced (--rate=0), to not overflow evdev buffers
+UNPACED_WINDOW = 16
+
+# give up waiting for the remaining frames after that many seconds
+RECEIVE_TIMEOUT = 2
+
+
+class Workload:
+    """Synthetic event stream of a single device type"""
+    #: codes of the source device
+    codes = []
+    #: absinfo of the source device
+    absinfo = {}
+    props = ()
+    #: receiver options for this device type
+    receiver_args = []
+    #: frames per second by default
+    rate = 0
+    #: event code whose value in frame i is i + 1 - to match output frames
+    #: with input ones, even if something is lost on the way; None if
+    #: frames are matched by order
+    marker = None
+
+    def frames(self, count):
+        """Generate count frames, each a list of (type, code, value),
+        without SYN_REPORT"""
+        raise NotImplementedError
+
+    def schedule(self, count, rate):
+        """When to send each frame, in seconds from the start"""
+        if not rate:
+            return [0] * count
+        return [i / rate for i in range(count)]
+
+
+class MouseWorkload(Workload):
+    """1 kHz gaming mouse: motion in every frame, a click now and then"""
+    codes = ['REL_X', 'REL_Y', 'REL_WHEEL', 'BTN_LEFT', 'BTN_RIGHT',
+             'BTN_MIDDLE']
+    receiver_args = ['--mouse']
+    rate = 1000
+    marker = evdev.lookup('REL_X')
+
+    def frames(self, count):
+        rel_x = evdev.lookup('REL_X')
+        rel_y = evdev.lookup('REL_Y')
+        btn_left = evdev.lookup('BTN_LEFT')
+        for i in range(count):
+            frame = [rel_x + (i + 1,), rel_y + (1 if i % 2 else -1,)]
+            if i % 100 == 50:
+                frame.append(btn_left + (1,))
+            elif i % 100 == 60:
+                frame.append(btn_left + (0,))
+            yield frame
+
+
+class KeyboardWorkload(Workload):
+    """Bursts of typing: 20 keys pressed and released back to back, then a
+    pause; rate is the average"""
+    codes = ['KEY_' + c for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'] + ['MSC_SCAN']
+    receiver_args = ['--keyboard']
+    rate = 400
+    burst = 40
+
+    def frames(self, count):
+        msc_scan = evdev.lookup('MSC_SCAN')
+        keys = [evdev.lookup(code) for code in self.codes[:-1]]
+        for i in range(count):
+            key = keys[(i // 2) % len(keys)]
+            yield [msc_scan + (0x70004 + key[1],), key + ((i + 1) % 2,)]
+
+    def schedule(self, count, rate):
+        if not rate:
+            return [0] * count
+        return [(i // self.burst) * self.burst / rate for i in range(count)]
+
+
+class TabletWorkload(Workload):
+    """Touchscreen with two fingers moving, 240 frames/s"""
+    codes = ['ABS_X', 'ABS_Y', 'ABS_MT_SLOT', 'ABS_MT_TRACKING_ID',
+             'ABS_MT_POSITION_X', 'ABS_MT_POSITION_Y', 'BTN_TOUCH']
+    absinfo = {
+        # wide enough for the marker
+        'ABS_X': (0, 2**30),
+        'ABS_Y': (0, 4095),
+        'ABS_MT_SLOT': (0, 9),
+        'ABS_MT_TRACKING_ID': (0, 65535),
+        'ABS_MT_POSITION_X': (0, 4095),
+        'ABS_MT_POSITION_Y': (0, 4095),
+    }
+    props = (evdev.INPUT_PROP_DIRECT,)
+    receiver_args = ['--tablet']
+    rate = 240
+    marker = evdev.lookup('ABS_X')
+    fingers = 2
+
+    def frames(self, count):
+        abs_x = evdev.lookup('ABS_X')
+        abs_y = evdev.lookup('ABS_Y')
+        slot = evdev.lookup('ABS_MT_SLOT')
+        tracking_id = evdev.lookup('ABS_MT_TRACKING_ID')
+        pos_x = evdev.lookup('ABS_MT_POSITION_X')
+        pos_y = evdev.lookup('ABS_MT_POSITION_Y')
+        btn_touch = evdev.lookup('BTN_TOUCH')
+        for i in range(count):
+            frame = []
+            for finger in range(self.fingers):
+                frame.append(slot + (finger,))
+                if i == 0:
+                    frame.append(tracking_id + (finger,))
+                frame.append(pos_x + (100 + finger * 1000 + i % 2000,))
+                frame.append(pos_y + (100 + finger * 1000 + i % 1000,))
+            if i == 0:
+                frame.append(btn_touch + (1,))
+            frame.append(abs_x + (i + 1,))
+            frame.append(abs_y + (100 + i % 1000,))
+            yield frame
+
+
+WORKLOADS = {
+    'mouse': MouseWorkload,
+    'keyboard': KeyboardWorkload,
+    'tablet': TabletWorkload,
+}
+
+
+def cpu_time(pid):
+    """CPU time used by the process so far, in seconds"""
+    try:
+        with open('/proc/{}/schedstat'.format(pid)) as f:
+            return int(f.read().split()[0]) / 1e9
+    except FileNotFoundError:
+        # kernel without CONFIG_SCHED_INFO
+        with open('/proc/{}/stat'.format(pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / \
+            os.sysconf('SC_CLK_TCK')
+
+
+def percentile_us(values, percent):
+    """Percentile of sorted values in seconds, converted to microseconds"""
+    if not values:
+        return None
+    return values[round(percent / 100 * (len(values) - 1))] * 1e6
+
+
+def stddev_us(values):
+    """Standard deviation of values in seconds, in microseconds"""
+    if len(values) < 2:
+        return None
+    return statistics.pstdev(values) * 1e6
+
+
+class BackgroundLoad:
+    """Busy processes competing for CPU with the tools, to see how much
+    scheduling adds to the latency (see --low-latency of both tools)"""
+
+    def __init__(self, count):
+        self.procs = [subprocess.Popen([sys.executable, '-c',
+                                        'while True: pass'])
+                      for _ in range(count)]
+
+    def close(self):
+        for proc in self.procs:
+            proc.terminate()
+            proc.wait()
+
+
+class ProxyPair:
+    """input-proxy-sender and input-proxy-receiver, connected with a
+    socketpair instead of qrexec, or with the shm transport"""
+
+    def __init__(self, build_dir, source_path, sender_args, receiver_args,
+                 transport='stdio'):
+        def tool(name):
+            if build_dir:
+                return os.path.join(build_dir, name)
+            return name
+        env = os.environ.copy()
+        # name the output device exactly as given with --name
+        env.pop('QREXEC_REMOTE_DOMAIN', None)
+        self.tmpdir = None
+        if transport == 'shm':
+            self.tmpdir = tempfile.TemporaryDirectory()
+            transport_arg = '--transport=shm:' + os.path.join(
+                self.tmpdir.name, 'sock')
+            self.receiver = subprocess.Popen(
+                [tool('input-proxy-receiver')] + receiver_args +
+                [transport_arg],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, env=env)
+            self.sender = subprocess.Popen(
+                [tool('input-proxy-sender')] + sender_args +
+                [transport_arg, source_path],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, env=env)
+            return
+        sender_sock, receiver_sock = socket.socketpair()
+        with sender_sock, receiver_sock:
+            self.receiver = subprocess.Popen(
+                [tool('input-proxy-receiver')] + receiver_args,
+                stdin=receiver_sock, stdout=receiver_sock, env=env)
+            self.sender = subprocess.Popen(
+                [tool('input-proxy-sender')] + sender_args + [source_path],
+                stdin=sender_sock, stdout=sender_sock, env=env)
+
+    def close(self):
+        for proc in (self.sender, self.receiver):
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+        if self.tmpdir:
+            self.tmpdir.cleanup()
+
+
+def run_workload(workload, build_dir, duration, rate,
+                 sender_args=(), receiver_args=(), transport='stdio'):
+    """Run a single workload, returns a dict with the results"""
+    count = max(1, int(duration * (rate or workload.rate)))
+    # prepare everything upfront, to not measure that
+    frames = [evdev.pack_frame(frame) for frame in workload.frames(count)]
+    schedule = workload.schedule(count, rate)
+
+    name = 'input-proxy benchmark {} {}'.format(type(workload).__name__,
+                                                os.getpid())
+    receiver_args = list(workload.receiver_args) + list(receiver_args) + \
+        ['--name=' + name]
+    source = evdev.UInput(name + ' source', workload.codes,
+                          workload.absinfo, workload.props)
+    proxy = None
+    output_fd = None
+    try:
+        source_path = evdev.wait_for_device(source.name, 5)
+        if not source_path:
+            raise RuntimeError('Source device did not appear')
+        proxy = ProxyPair(build_dir, source_path, list(sender_args),
+                          receiver_args, transport)
+        output_path = evdev.wait_for_device(name, 5)
+        if not output_path:
+            raise RuntimeError('Output device did not appear')
+        output_fd = os.open(output_path, os.O_RDONLY | os.O_NONBLOCK)
+        poll = select.poll()
+        poll.register(output_fd, select.POLLIN)
+
+        cpu_start = {'sender': cpu_time(proxy.sender.pid),
+                     'receiver': cpu_time(proxy.receiver.pid)}
+        sent_time = [None] * count
+        latency = []
+        buffer = b''
+        sent = received = events = dropped = 0
+        marker_value = 0
+        last_progress = start = time.monotonic()
+        while received < count:
+            now = time.monotonic()
+            if now - last_progress > RECEIVE_TIMEOUT:
+                break
+            # send everything that is due
+            while sent < count and start + schedule[sent] <= now and \
+                    (rate or sent - received < UNPACED_WINDOW):
+                sent_time[sent] = time.time()
+                source.write(frames[sent])
+                sent += 1
+            if sent < count and (rate or sent - received < UNPACED_WINDOW):
+                timeout = max(0, start + schedule[sent] - time.monotonic())
+            else:
+                timeout = RECEIVE_TIMEOUT
+            if not poll.poll(timeout * 1000):
+                continue
+            try:
+                buffer += os.read(output_fd, evdev.EVENT_SIZE * 1024)
+            except BlockingIOError:
+                continue
+            output, buffer = evdev.unpack_events(buffer)
+            for ev in output:
+                if ev.type == evdev.EV_SYN:
+                    if ev.code == evdev.SYN_DROPPED:
+                        dropped += 1
+                    elif ev.code == evdev.SYN_REPORT:
+                        index = received
+                        received += 1
+                        last_progress = time.monotonic()
+                        if workload.marker is not None:
+                            index = marker_value - 1
+                            marker_value = 0
+                        if 0 <= index < sent:
+                            latency.append(ev.sec + ev.usec / 1e6 -
+                                           sent_time[index])
+                    continue
+                events += 1
+                if (ev.type, ev.code) == workload.marker:
+                    marker_value = ev.value
+        elapsed = time.monotonic() - start
+        cpu = {tool: cpu_time(getattr(proxy, tool).pid) - cpu_start[tool]
+               for tool in cpu_start}
+    finally:
+        if output_fd is not None:
+            os.close(output_fd)
+        if proxy:
+            proxy.close()
+        source.close()
+
+    latency.sort()
+    return {
+        'workload': type(workload).__name__,
+        'rate': rate,
+        'sender_args': list(sender_args),
+        'receiver_args': receiver_args[:-1],
+        'transport': transport,
+        'frames_sent': sent,
+        'frames_received': received,
+        'syn_dropped': dropped,
+        'events': events,
+        'duration': elapsed,
+        'events_per_sec': events / elapsed if elapsed else None,
+        'latency_us': {
+            'p50': percentile_us(latency, 50),
+            'p99': percentile_us(latency, 99),
+            'max': percentile_us(latency, 100),
+            'stddev': stddev_us(latency),
+        },
+        'cpu_ns_per_event': {
+            tool: cpu[tool] / events * 1e9 if events else None
+            for tool in cpu
+        },
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark input-proxy-sender and input-proxy-receiver')
+    parser.add_argument('--build-dir',
+                        help='where to find the tools (default: $PATH)')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='how long to run each workload, in seconds '
+                             '(at the nominal rate)')
+    parser.add_argument('--rate', type=float,
+                        help='frames per second, 0 to send as fast as '
+                             'possible (default: depends on the workload)')
+    parser.add_argument('--sender-arg', action='append', default=[],
+                        help='additional input-proxy-sender option')
+    parser.add_argument('--receiver-arg', action='append', default=[],
+                        help='additional input-proxy-receiver option')
+    parser.add_argument('--transport', choices=('stdio', 'shm'),
+                        default='stdio',
+                        help='how to connect the tools: a socketpair as '
+                             'their stdin/stdout, or --transport=shm')
+    parser.add_argument('--load', type=int, default=0,
+                        help='run that many busy processes meanwhile')
+    parser.add_argument('--compare-low-latency', action='store_true',
+                        help='run each workload also with --low-latency '
+                             'of both tools, to compare latency jitter')
+    parser.add_argument('--output',
+                        help='write results there instead of stdout')
+    parser.add_argument('workload', nargs='*',
+                        help='workloads to run: {} (default: all)'.format(
+                            ', '.join(WORKLOADS)))
+    args = parser.parse_args(args)
+    for name in args.workload:
+        if name not in WORKLOADS:
+            parser.error('unknown workload: {}'.format(name))
+
+    variants = [([], '')]
+    if args.compare_low_latency:
+        variants.append((['--low-latency'], ' (low latency)'))
+
+    results = []
+    load = BackgroundLoad(args.load)
+    try:
+        for name in args.workload or list(WORKLOADS):
+            for extra_args, suffix in variants:
+                workload = WORKLOADS[name]()
+                rate = workload.rate if args.rate is None else args.rate
+                result = run_workload(workload, args.build_dir, args.duration,
+                                      rate, args.sender_arg + extra_args,
+                                      args.receiver_arg + extra_args,
+                                      args.transport)
+                result['name'] = name
+                results.append(result)
+                print('{name}{suffix}: {events_per_sec:.0f} events/s, '
+                      'latency p50 {latency_us[p50]} us '
+                      'p99 {latency_us[p99]} us '
+                      'stddev {latency_us[stddev]} us, '
+                      'frames {frames_received}/{frames_sent}'.format(
+                          suffix=suffix, **result),
+                      file=sys.stderr)
+    finally:
+        load.close()
+
+    report = {
+        'time': time.time(),
+        'kernel': platform.release(),
+        'load': args.load,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    return 0 if all(r['frames_received'] == r['frames_sent']
+                    for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,519 @@
+#!/usr/bin/python
+# vim: fileencoding=utf-8
+
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""Minimal evdev access, without any external library: event code names,
+reading struct input_event records from /dev/input/eventN, waiting for
+a device to appear and creating virtual devices with /dev/uinput."""
+
+import collections
+import fcntl
+import os
+import select
+import socket
+import struct
+import subprocess
+import time
+
+# struct input_event: struct timeval time; __u16 type; __u16 code; __s32 value
+EVENT_FORMAT = 'llHHi'
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+InputEvent = collections.namedtuple('InputEvent',
+                                    ['sec', 'usec', 'type', 'code', 'value'])
+
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_REL = 0x02
+EV_ABS = 0x03
+EV_MSC = 0x04
+EV_SW = 0x05
+EV_LED = 0x11
+EV_SND = 0x12
+EV_REP = 0x14
+EV_FF = 0x15
+EV_PWR = 0x16
+EV_FF_STATUS = 0x17
+
+SYN_REPORT = 0
+SYN_DROPPED = 3
+
+INPUT_PROP_DIRECT = 0x01
+
+BUS_VIRTUAL = 0x06
+
+EV = {
+    'EV_SYN': EV_SYN,
+    'EV_KEY': EV_KEY,
+    'EV_REL': EV_REL,
+    'EV_ABS': EV_ABS,
+    'EV_MSC': EV_MSC,
+    'EV_SW': EV_SW,
+    'EV_LED': EV_LED,
+    'EV_SND': EV_SND,
+    'EV_REP': EV_REP,
+    'EV_FF': EV_FF,
+    'EV_PWR': EV_PWR,
+    'EV_FF_STATUS': EV_FF_STATUS,
+}
+
+SYN = {
+    'SYN_REPORT': 0x00,
+    'SYN_CONFIG': 0x01,
+    'SYN_MT_REPORT': 0x02,
+    'SYN_DROPPED': 0x03,
+}
+
+KEY = {
+    'KEY_ESC': 1,
+    'KEY_MINUS': 12,
+    'KEY_EQUAL': 13,
+    'KEY_BACKSPACE': 14,
+    'KEY_TAB': 15,
+    'KEY_LEFTBRACE': 26,
+    'KEY_RIGHTBRACE': 27,
+    'KEY_ENTER': 28,
+    'KEY_LEFTCTRL': 29,
+    'KEY_SEMICOLON': 39,
+    'KEY_APOSTROPHE': 40,
+    'KEY_GRAVE': 41,
+    'KEY_LEFTSHIFT': 42,
+    'KEY_BACKSLASH': 43,
+    'KEY_COMMA': 51,
+    'KEY_DOT': 52,
+    'KEY_SLASH': 53,
+    'KEY_RIGHTSHIFT': 54,
+    'KEY_KPASTERISK': 55,
+    'KEY_LEFTALT': 56,
+    'KEY_SPACE': 57,
+    'KEY_CAPSLOCK': 58,
+    'KEY_NUMLOCK': 69,
+    'KEY_SCROLLLOCK': 70,
+    'KEY_F11': 87,
+    'KEY_F12': 88,
+    'KEY_RIGHTCTRL': 97,
+    'KEY_RIGHTALT': 100,
+    'KEY_HOME': 102,
+    'KEY_UP': 103,
+    'KEY_PAGEUP': 104,
+    'KEY_LEFT': 105,
+    'KEY_RIGHT': 106,
+    'KEY_END': 107,
+    'KEY_DOWN': 108,
+    'KEY_PAGEDOWN': 109,
+    'KEY_INSERT': 110,
+    'KEY_DELETE': 111,
+    'KEY_LEFTMETA': 125,
+    'KEY_RIGHTMETA': 126,
+    'BTN_LEFT': 0x110,
+    'BTN_RIGHT': 0x111,
+    'BTN_MIDDLE': 0x112,
+    'BTN_SIDE': 0x113,
+    'BTN_EXTRA': 0x114,
+    'BTN_FORWARD': 0x115,
+    'BTN_BACK': 0x116,
+    'BTN_TASK': 0x117,
+    'BTN_TOOL_PEN': 0x140,
+    'BTN_TOOL_RUBBER': 0x141,
+    'BTN_TOOL_BRUSH': 0x142,
+    'BTN_TOOL_PENCIL': 0x143,
+    'BTN_TOOL_AIRBRUSH': 0x144,
+    'BTN_TOOL_FINGER': 0x145,
+    'BTN_TOOL_MOUSE': 0x146,
+    'BTN_TOOL_LENS': 0x147,
+    'BTN_TOOL_QUINTTAP': 0x148,
+    'BTN_STYLUS3': 0x149,
+    'BTN_TOUCH': 0x14a,
+    'BTN_STYLUS': 0x14b,
+    'BTN_STYLUS2': 0x14c,
+    'BTN_TOOL_DOUBLETAP': 0x14d,
+    'BTN_TOOL_TRIPLETAP': 0x14e,
+    'BTN_TOOL_QUADTAP': 0x14f,
+}
+# KEY_1 .. KEY_9, KEY_0
+KEY.update(('KEY_{}'.format((i + 1) % 10), 2 + i) for i in range(10))
+# letters, in keyboard rows
+for _row, _first in (('QWERTYUIOP', 16), ('ASDFGHJKL', 30), ('ZXCVBNM', 44)):
+    KEY.update(('KEY_' + c, _first + i) for i, c in enumerate(_row))
+# KEY_F1 .. KEY_F10
+KEY.update(('KEY_F{}'.format(i + 1), 59 + i) for i in range(10))
+
+REL = {
+    'REL_X': 0x00,
+    'REL_Y': 0x01,
+    'REL_Z': 0x02,
+    'REL_RX': 0x03,
+    'REL_RY': 0x04,
+    'REL_RZ': 0x05,
+    'REL_HWHEEL': 0x06,
+    'REL_DIAL': 0x07,
+    'REL_WHEEL': 0x08,
+    'REL_MISC': 0x09,
+    'REL_WHEEL_HI_RES': 0x0b,
+    'REL_HWHEEL_HI_RES': 0x0c,
+}
+
+ABS = {
+    'ABS_X': 0x00,
+    'ABS_Y': 0x01,
+    'ABS_Z': 0x02,
+    'ABS_RX': 0x03,
+    'ABS_RY': 0x04,
+    'ABS_RZ': 0x05,
+    'ABS_THROTTLE': 0x06,
+    'ABS_RUDDER': 0x07,
+    'ABS_WHEEL': 0x08,
+    'ABS_GAS': 0x09,
+    'ABS_BRAKE': 0x0a,
+    'ABS_PRESSURE': 0x18,
+    'ABS_DISTANCE': 0x19,
+    'ABS_TILT_X': 0x1a,
+    'ABS_TILT_Y': 0x1b,
+    'ABS_TOOL_WIDTH': 0x1c,
+    'ABS_VOLUME': 0x20,
+    'ABS_MISC': 0x28,
+    'ABS_MT_SLOT': 0x2f,
+    'ABS_MT_TOUCH_MAJOR': 0x30,
+    'ABS_MT_TOUCH_MINOR': 0x31,
+    'ABS_MT_WIDTH_MAJOR': 0x32,
+    'ABS_MT_WIDTH_MINOR': 0x33,
+    'ABS_MT_ORIENTATION': 0x34,
+    'ABS_MT_POSITION_X': 0x35,
+    'ABS_MT_POSITION_Y': 0x36,
+    'ABS_MT_TOOL_TYPE': 0x37,
+    'ABS_MT_BLOB_ID': 0x38,
+    'ABS_MT_TRACKING_ID': 0x39,
+    'ABS_MT_PRESSURE': 0x3a,
+    'ABS_MT_DISTANCE': 0x3b,
+    'ABS_MT_TOOL_X': 0x3c,
+    'ABS_MT_TOOL_Y': 0x3d,
+}
+
+MSC = {
+    'MSC_SERIAL': 0x00,
+    'MSC_PULSELED': 0x01,
+    'MSC_GESTURE': 0x02,
+    'MSC_RAW': 0x03,
+    'MSC_SCAN': 0x04,
+    'MSC_TIMESTAMP': 0x05,
+}
+
+LED = {
+    'LED_NUML': 0x00,
+    'LED_CAPSL': 0x01,
+    'LED_SCROLLL': 0x02,
+    'LED_COMPOSE': 0x03,
+    'LED_KANA': 0x04,
+}
+
+REP = {
+    'REP_DELAY': 0x00,
+    'REP_PERIOD': 0x01,
+}
+
+# event type -> code names
+CODES = {
+    EV_SYN: SYN,
+    EV_KEY: KEY,
+    EV_REL: REL,
+    EV_ABS: ABS,
+    EV_MSC: MSC,
+    EV_LED: LED,
+    EV_REP: REP,
+}
+
+_type_names = {v: k for k, v in EV.items()}
+_code_names = {ev_type: {v: k for k, v in codes.items()}
+               for ev_type, codes in CODES.items()}
+# name -> (type, code)
+_codes_by_name = {name: (ev_type, code)
+                  for ev_type, codes in CODES.items()
+                  for name, code in codes.items()}
+
+
+def type_name(ev_type):
+    return _type_names.get(ev_type, '{:#x}'.format(ev_type))
+
+
+def code_name(ev_type, code):
+    """Name of the event code, like KEY_A; codes without a name are
+    formatted as TYPE_0xNN, for example KEY_0x2f0"""
+    try:
+        return _code_names[ev_type][code]
+    except KeyError:
+        return '{}_{:#x}'.format(type_name(ev_type)[3:], code)
+
+
+def lookup(name):
+    """Get (type, code) of an event code name, like KEY_A"""
+    return _codes_by_name[name]
+
+
+def pack_event(ev_type, code, value, sec=0, usec=0):
+    return struct.pack(EVENT_FORMAT, sec, usec, ev_type, code, value)
+
+
+def pack_frame(frame):
+    """Pack a frame - (type, code, value) events - followed by SYN_REPORT"""
+    return b''.join(pack_event(*ev) for ev in frame) + \
+        pack_event(EV_SYN, SYN_REPORT, 0)
+
+
+def unpack_events(data):
+    """Unpack complete events from data, returns (events, remaining bytes)"""
+    count = len(data) // EVENT_SIZE
+    events = [InputEvent(*struct.unpack_from(EVENT_FORMAT, data,
+                                             i * EVENT_SIZE))
+              for i in range(count)]
+    return events, data[count * EVENT_SIZE:]
+
+
+class EventReader:
+    """Read events from /dev/input/eventN - directly, or with sudo if not
+    accessible"""
+
+    def __init__(self, path):
+        self.proc = None
+        if os.access(path, os.R_OK):
+            self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        else:
+            # report when the device is open, so no event is missed
+            self.proc = subprocess.Popen(
+                ['sudo', 'sh', '-c', 'exec 3<"$1" && echo && exec cat <&3',
+                 'sh', path],
+                stdout=subprocess.PIPE)
+            self.fd = self.proc.stdout.fileno()
+            if os.read(self.fd, 1) != b'\n':
+                self.close()
+                raise OSError('Failed to open {}'.format(path))
+        os.set_blocking(self.fd, False)
+        self.poll = select.poll()
+        self.poll.register(self.fd, select.POLLIN)
+        self.buffer = b''
+        self.events = collections.deque()
+
+    def close(self):
+        if self.proc:
+            self.proc.terminate()
+            self.proc.stdout.close()
+            self.proc.wait()
+            self.proc = None
+        elif self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+
+    def _fill(self, deadline):
+        """Wait for more events, until the deadline (time.monotonic());
+        returns False on timeout"""
+        while True:
+            timeout = max(0, deadline - time.monotonic())
+            if not self.poll.poll(timeout * 1000):
+                return False
+            try:
+                data = os.read(self.fd, EVENT_SIZE * 64)
+            except BlockingIOError:
+                continue
+            if not data:
+                raise EOFError('Event device closed')
+            events, self.buffer = unpack_events(self.buffer + data)
+            self.events.extend(events)
+            if events:
+                return True
+
+    def read_event(self, timeout):
+        """Read a single event, returns None on timeout (in seconds)"""
+        deadline = time.monotonic() + timeout
+        if not self.events and not self._fill(deadline):
+            return None
+        return self.events.popleft()
+
+    def read_frame(self, timeout):
+        """Read events up to the next SYN_REPORT, returns them as a list of
+        (code name, value), without the SYN_REPORT itself; returns None if no
+        complete frame arrived within the timeout (in seconds)"""
+        deadline = time.monotonic() + timeout
+        frame = []
+        for ev in self.events:
+            if ev.type == EV_SYN and ev.code == SYN_REPORT:
+                break
+        else:
+            while True:
+                if not self._fill(deadline):
+                    return None
+                if any(ev.type == EV_SYN and ev.code == SYN_REPORT
+                       for ev in self.events):
+                    break
+        while True:
+            ev = self.events.popleft()
+            if ev.type == EV_SYN and ev.code == SYN_REPORT:
+                return frame
+            frame.append((code_name(ev.type, ev.code), ev.value))
+
+
+def list_devices():
+    """Returns a dict of event device paths and their names"""
+    devices = {}
+    for entry in os.listdir('/sys/class/input'):
+        if not entry.startswith('event'):
+            continue
+        try:
+            with open('/sys/class/input/{}/device/name'.format(entry)) as f:
+                devices['/dev/input/' + entry] = f.read().rstrip('\n')
+        except FileNotFoundError:
+            # removed meanwhile
+            continue
+    return devices
+
+
+def device_vendor(path):
+    """Vendor ID of an event device, or None if it's gone"""
+    try:
+        with open('/sys/class/input/{}/device/id/vendor'.format(
+                os.path.basename(path))) as f:
+            return int(f.read(), 16)
+    except FileNotFoundError:
+        return None
+
+
+def find_device(name, vendor=None, prefix=False):
+    """Returns the path of the newest event device with the given name (or,
+    with prefix set, a name starting with it; and vendor ID, if given), or
+    None"""
+    paths = [path for path, dev_name in list_devices().items()
+             if (dev_name.startswith(name) if prefix else dev_name == name) and
+             os.path.exists(path) and
+             (vendor is None or device_vendor(path) == vendor)]
+    if not paths:
+        return None
+    return max(paths, key=lambda path: int(path[len('/dev/input/event'):]))
+
+
+def wait_for_device(name, timeout, vendor=None, prefix=False):
+    """Wait for an event device with the given name (and vendor ID, if
+    given; see find_device()), returns its path or None on timeout (in
+    seconds); it's woken up by kernel uevents, instead of polling"""
+    NETLINK_KOBJECT_UEVENT = 15
+    sock = socket.socket(socket.AF_NETLINK,
+                         socket.SOCK_DGRAM | socket.SOCK_CLOEXEC,
+                         NETLINK_KOBJECT_UEVENT)
+    deadline = time.monotonic() + timeout
+    with sock:
+        # kernel events, no privileges needed
+        sock.bind((0, 1))
+        sock.setblocking(False)
+        while True:
+            # check only after subscribing, to not miss the device
+            path = find_device(name, vendor, prefix)
+            if path:
+                return path
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or \
+                    not select.select([sock], [], [], remaining)[0]:
+                return None
+            try:
+                while sock.recv(65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+
+def _IOW(ioc_type, nr, size):
+    return (1 << 30) | (size << 16) | (ord(ioc_type) << 8) | nr
+
+
+# struct uinput_setup: struct input_id id; char name[80]; __u32 ff_effects_max
+UINPUT_SETUP_FORMAT = 'HHHH80sI'
+# struct uinput_abs_setup: __u16 code; struct input_absinfo absinfo
+UINPUT_ABS_SETUP_FORMAT = 'Hxx6i'
+
+UI_DEV_CREATE = 0x5501
+UI_DEV_DESTROY = 0x5502
+UI_DEV_SETUP = _IOW('U', 3, struct.calcsize(UINPUT_SETUP_FORMAT))
+UI_ABS_SETUP = _IOW('U', 4, struct.calcsize(UINPUT_ABS_SETUP_FORMAT))
+UI_SET_EVBIT = _IOW('U', 100, 4)
+UI_SET_PROPBIT = _IOW('U', 110, 4)
+_ui_set_bit = {
+    EV_KEY: _IOW('U', 101, 4),
+    EV_REL: _IOW('U', 102, 4),
+    EV_ABS: _IOW('U', 103, 4),
+    EV_MSC: _IOW('U', 104, 4),
+    EV_LED: _IOW('U', 105, 4),
+}
+
+
+class UInput:
+    """Virtual input device, created with /dev/uinput (which needs to be
+    writable)"""
+
+    def __init__(self, name, codes, absinfo=None, props=(),
+                 vendor=0xffff, product=0xffff):
+        """codes - names of supported event codes, like REL_X or BTN_LEFT;
+        absinfo - (minimum, maximum) of absolute axes, by name; props -
+        INPUT_PROP_* numbers"""
+        self.name = name
+        self.fd = os.open('/dev/uinput', os.O_WRONLY | os.O_CLOEXEC)
+        try:
+            types = set()
+            for code_name in codes:
+                ev_type, code = lookup(code_name)
+                if ev_type not in types:
+                    fcntl.ioctl(self.fd, UI_SET_EVBIT, ev_type)
+                    types.add(ev_type)
+                fcntl.ioctl(self.fd, _ui_set_bit[ev_type], code)
+            for prop in props:
+                fcntl.ioctl(self.fd, UI_SET_PROPBIT, prop)
+            fcntl.ioctl(self.fd, UI_DEV_SETUP, struct.pack(
+                UINPUT_SETUP_FORMAT, BUS_VIRTUAL, vendor, product, 1,
+                name.encode(), 0))
+            for code_name, (minimum, maximum) in (absinfo or {}).items():
+                fcntl.ioctl(self.fd, UI_ABS_SETUP, struct.pack(
+                    UINPUT_ABS_SETUP_FORMAT, lookup(code_name)[1],
+                    0, minimum, maximum, 0, 0, 0))
+            fcntl.ioctl(self.fd, UI_DEV_CREATE)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def write(self, data):
+        """Write packed events (see pack_event()), all at once"""
+        os.write(self.fd, data)
+
+    def emit_frames(self, frames, rate=None):
+        """Emit frames of (type, code, value) events, each followed by
+        SYN_REPORT. Without rate, everything is written at once; otherwise
+        frames are paced at rate frames per second, frames that are already
+        due are written together (so it catches up after a delay)"""
+        packed = [pack_frame(frame) for frame in frames]
+        if not rate:
+            self.write(b''.join(packed))
+            return
+        start = time.monotonic()
+        sent = 0
+        while sent < len(packed):
+            due = min(len(packed),
+                      int((time.monotonic() - start) * rate) + 1)
+            if due > sent:
+                self.write(b''.join(packed[sent:due]))
+                sent = due
+            else:
+                time.sleep(max(0, start + sent / rate - time.monotonic()))
+
+    def close(self):
+        fcntl.ioctl(self.fd, UI_DEV_DESTROY)
+        os.close(self.fd)
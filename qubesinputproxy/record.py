@@ -0,0 +1,480 @@
+#!/usr/bin/python
+# vim: fileencoding=utf-8
+
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""Record and replay input-proxy streams.
+
+The stream input-proxy-sender sends - hello, device capabilities message,
+then struct input_event records - is recorded to a compact trace file: the
+hello and capabilities are kept as they were, events are stored with
+timestamps delta-encoded and fields as variable-length integers, without the
+padding of struct input_event (about 4 bytes per event instead of 24).
+
+Recording wraps either tool as a transparent proxy, for example as the
+command of /etc/qubes-rpc/qubes.InputMouse in dom0::
+
+    python3 -m qubesinputproxy.record record /tmp/mouse.qit -- \\
+        input-proxy-receiver --mouse
+
+(or with --sender, wrapping input-proxy-sender in the VM with the device).
+Without a command, a raw stream is read from stdin, for example one of
+fuzz/seed-corpus-in/descriptor*.bin followed by events*.bin.
+
+Replaying feeds a trace into input-proxy-receiver, acting as the sender, at
+the original speed, N times faster (--speed=N) or as fast as possible
+(--speed=0)::
+
+    sudo python3 -m qubesinputproxy.record replay --speed=2 /tmp/mouse.qit \\
+        -- input-proxy-receiver --mouse
+
+Without a command, the raw stream is written to stdout. Event timestamps are
+shifted to when each event is sent, so latency measured by the receiver
+(--stats) is meaningful.
+"""
+
+import argparse
+import collections
+import os
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from qubesinputproxy import evdev
+
+TRACE_MAGIC = b'QIPTRACE'
+TRACE_VERSION = 1
+
+# struct input_proxy_hello
+HELLO_FORMAT = 'II'
+HELLO_SIZE = struct.calcsize(HELLO_FORMAT)
+# struct input_proxy_device_caps: bitmaps of codes of each type (0 for
+# propbit, 'EV' for evbit) and their sizes in bits, stored as unsigned longs
+CAPS_FIELDS = [
+    (0, 0x20),
+    ('EV', 0x20),
+    (evdev.EV_KEY, 0x300),
+    (evdev.EV_REL, 0x10),
+    (evdev.EV_ABS, 0x40),
+    (evdev.EV_MSC, 0x08),
+    (evdev.EV_LED, 0x10),
+    (evdev.EV_SND, 0x08),
+    (evdev.EV_FF, 0x80),
+    (evdev.EV_SW, 0x11),
+]
+LONG_SIZE = struct.calcsize('L')
+CAPS_SIZE = sum((bits + LONG_SIZE * 8 - 1) // (LONG_SIZE * 8) * LONG_SIZE
+                for _, bits in CAPS_FIELDS)
+NAME_SIZE = 128
+# struct input_absinfo
+ABSINFO_FORMAT = '6i'
+
+Trace = collections.namedtuple('Trace', ['descriptor', 'events'])
+Trace.__doc__ = """Recorded stream: descriptor is hello and the capabilities
+message as sent, events a list of evdev.InputEvent"""
+
+
+def encode_varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return data
+
+
+def decode_varint(data, pos):
+    """Returns (value, position after it)"""
+    value = shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError('Truncated trace')
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+    return value // 2 if not value & 1 else -(value + 1) // 2
+
+
+def event_time_us(ev):
+    return ev.sec * 1000000 + ev.usec
+
+
+def descriptor_name(descriptor):
+    """Device name from the capabilities message, if any"""
+    offset = HELLO_SIZE + CAPS_SIZE
+    name = descriptor[offset:offset + NAME_SIZE]
+    return name.split(b'\0', 1)[0].decode(errors='replace')
+
+
+class TraceWriter:
+    """Write a trace file; the header is written when the descriptor is
+    known, see write_descriptor()"""
+
+    def __init__(self, f):
+        self.f = f
+        # the first event is stored relative to 0
+        self.last_time = 0
+
+    def write_descriptor(self, descriptor):
+        self.f.write(TRACE_MAGIC + bytes([TRACE_VERSION]) +
+                     encode_varint(len(descriptor)) + descriptor)
+
+    def write_events(self, events):
+        data = bytearray()
+        for ev in events:
+            ev_time = event_time_us(ev)
+            data += encode_varint(zigzag(ev_time - self.last_time))
+            self.last_time = ev_time
+            data.append(ev.type)
+            data += encode_varint(ev.code)
+            data += encode_varint(zigzag(ev.value))
+        self.f.write(data)
+
+
+def decode_trace(data):
+    """Parse the whole trace file content, returns Trace"""
+    if not data.startswith(TRACE_MAGIC):
+        raise ValueError('Not a trace file')
+    pos = len(TRACE_MAGIC)
+    if len(data) <= pos or data[pos] != TRACE_VERSION:
+        raise ValueError('Unsupported trace version')
+    length, pos = decode_varint(data, pos + 1)
+    descriptor = bytes(data[pos:pos + length])
+    if len(descriptor) != length:
+        raise ValueError('Truncated trace')
+    pos += length
+    events = []
+    ev_time = 0
+    while pos < len(data):
+        delta, pos = decode_varint(data, pos)
+        ev_time += unzigzag(delta)
+        if pos >= len(data):
+            raise ValueError('Truncated trace')
+        ev_type = data[pos]
+        code, pos = decode_varint(data, pos + 1)
+        value, pos = decode_varint(data, pos)
+        events.append(evdev.InputEvent(ev_time // 1000000, ev_time % 1000000,
+                                       ev_type, code, unzigzag(value)))
+    return Trace(descriptor, events)
+
+
+def read_trace(path):
+    with open(path, 'rb') as f:
+        return decode_trace(f.read())
+
+
+def write_trace(path, trace):
+    with open(path, 'wb') as f:
+        writer = TraceWriter(f)
+        writer.write_descriptor(trace.descriptor)
+        writer.write_events(trace.events)
+
+
+def make_descriptor(name, codes, absinfo=None, version=3):
+    """Build hello and capabilities message of a device with codes - names
+    like REL_X; absinfo maps ABS_* names to (min, max, fuzz, flat); for
+    tests"""
+    caps = bytearray(CAPS_SIZE)
+    offsets = {}
+    offset = 0
+    for field, bits in CAPS_FIELDS:
+        offsets[field] = offset
+        offset += (bits + LONG_SIZE * 8 - 1) // (LONG_SIZE * 8) * LONG_SIZE
+
+    def set_bit(field, bit):
+        caps[offsets[field] + bit // 8] |= 1 << (bit % 8)
+
+    set_bit('EV', evdev.EV_SYN)
+    abs_codes = []
+    for code_name in codes:
+        ev_type, code = evdev.lookup(code_name)
+        set_bit('EV', ev_type)
+        set_bit(ev_type, code)
+        if ev_type == evdev.EV_ABS:
+            abs_codes.append(code)
+    msg = bytes(caps) + name.encode()[:NAME_SIZE - 1].ljust(NAME_SIZE, b'\0')
+    # since version 2, only axes set in absbit, in order
+    for code in sorted(abs_codes):
+        minimum, maximum, fuzz, flat = (absinfo or {}).get(
+            evdev.code_name(evdev.EV_ABS, code), (0, 0, 0, 0))
+        msg += struct.pack(ABSINFO_FORMAT, 0, minimum, maximum, fuzz, flat, 0)
+    return struct.pack(HELLO_FORMAT, version, len(msg)) + msg
+
+
+def make_trace(descriptor, frames, rate):
+    """Build a trace of frames - lists of (event name, value) - each followed
+    by SYN_REPORT, at rate frames per second; for tests"""
+    events = []
+    for i, frame in enumerate(frames):
+        ev_time = int(i * 1000000 / rate)
+        for name, value in frame + [('SYN_REPORT', 0)]:
+            ev_type, code = evdev.lookup(name)
+            events.append(evdev.InputEvent(ev_time // 1000000,
+                                           ev_time % 1000000,
+                                           ev_type, code, value))
+    return Trace(descriptor, events)
+
+
+class StreamRecorder:
+    """Parse a raw stream, as sent by input-proxy-sender, and write it to a
+    TraceWriter as it comes"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.buffer = b''
+        self.descriptor_done = False
+        self.events = 0
+
+    def feed(self, data):
+        self.buffer += data
+        if not self.descriptor_done:
+            if len(self.buffer) < HELLO_SIZE:
+                return
+            _version, caps_size = struct.unpack_from(HELLO_FORMAT,
+                                                     self.buffer)
+            if len(self.buffer) < HELLO_SIZE + caps_size:
+                return
+            self.writer.write_descriptor(
+                self.buffer[:HELLO_SIZE + caps_size])
+            self.buffer = self.buffer[HELLO_SIZE + caps_size:]
+            self.descriptor_done = True
+        events, self.buffer = evdev.unpack_events(self.buffer)
+        if events:
+            self.writer.write_events(events)
+            self.events += len(events)
+        self.writer.f.flush()
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def record(output, command=None, sender=False):
+    """Record the stream read from stdin (or, with sender set, the output of
+    command) to output; with command given, pass everything through between
+    it and stdin/stdout. Returns the exit code of command, or 0."""
+    with open(output, 'wb') as f:
+        recorder = StreamRecorder(TraceWriter(f))
+        if not command:
+            while True:
+                data = os.read(0, 65536)
+                if not data:
+                    return 0
+                recorder.feed(data)
+
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        # source fd -> (destination fd, whether to record)
+        routes = {
+            0: (proc.stdin.fileno(), not sender),
+            proc.stdout.fileno(): (1, sender),
+        }
+        sel = selectors.DefaultSelector()
+        for fd in routes:
+            sel.register(fd, selectors.EVENT_READ)
+        try:
+            while True:
+                for key, _ in sel.select():
+                    dst, recorded = routes[key.fd]
+                    data = os.read(key.fd, 65536)
+                    if not data and key.fd != 0:
+                        # the command is done
+                        return proc.wait()
+                    if not data:
+                        sel.unregister(0)
+                        proc.stdin.close()
+                        continue
+                    if recorded:
+                        recorder.feed(data)
+                    try:
+                        write_all(dst, data)
+                    except BrokenPipeError:
+                        # the other side is gone, the stream ends here
+                        return proc.wait()
+        finally:
+            if not proc.stdin.closed:
+                proc.stdin.close()
+
+
+def replay(trace, fd, speed=1.0, delay=0):
+    """Write the stream of trace to fd: events at their original pace divided
+    by speed, or as fast as possible if speed is 0, starting delay seconds
+    after the descriptor; timestamps are shifted to when each event is sent.
+    Returns the number of events sent."""
+    write_all(fd, trace.descriptor)
+    if not trace.events:
+        return 0
+    # let the new device get picked up first, events sent before that are
+    # lost
+    time.sleep(delay)
+    first_time = event_time_us(trace.events[0])
+    start = time.monotonic()
+    wall_start = time.time()
+    sent = 0
+    while sent < len(trace.events):
+        now = time.monotonic()
+        batch = []
+        while sent < len(trace.events):
+            ev = trace.events[sent]
+            offset = 0
+            if speed:
+                offset = (event_time_us(ev) - first_time) / 1e6 / speed
+                if start + offset > now:
+                    break
+            else:
+                offset = now - start
+            ev_time = int((wall_start + offset) * 1e6)
+            batch.append(evdev.pack_event(ev.type, ev.code, ev.value,
+                                          ev_time // 1000000,
+                                          ev_time % 1000000))
+            sent += 1
+        if batch:
+            write_all(fd, b''.join(batch))
+        if sent < len(trace.events):
+            offset = (event_time_us(trace.events[sent]) - first_time) / \
+                1e6 / speed
+            time.sleep(max(0, start + offset - time.monotonic()))
+    return sent
+
+
+def replay_to_command(trace, command, speed=1.0, delay=0, env=None):
+    """Run command (usually input-proxy-receiver) connected with a socketpair
+    in place of qrexec, replay trace into it and wait for it to exit; returns
+    its exit code"""
+    sock, proc_sock = socket.socketpair()
+    with proc_sock:
+        proc = subprocess.Popen(command, stdin=proc_sock, stdout=proc_sock,
+                                env=env)
+
+    def drain():
+        # announce and negotiated capabilities, not needed here
+        try:
+            while sock.recv(65536):
+                pass
+        except OSError:
+            pass
+
+    drain_thread = threading.Thread(target=drain, daemon=True)
+    drain_thread.start()
+    try:
+        replay(trace, sock.fileno(), speed, delay)
+    except BrokenPipeError:
+        pass
+    finally:
+        sock.shutdown(socket.SHUT_WR)
+    code = proc.wait()
+    sock.close()
+    drain_thread.join()
+    return code
+
+
+def info(trace):
+    """Summary of the trace, as a dict"""
+    version, _caps_size = struct.unpack_from(HELLO_FORMAT, trace.descriptor)
+    duration = 0
+    if trace.events:
+        duration = (event_time_us(trace.events[-1]) -
+                    event_time_us(trace.events[0])) / 1e6
+    frames = sum(1 for ev in trace.events
+                 if ev.type == evdev.EV_SYN and ev.code == evdev.SYN_REPORT)
+    types = collections.Counter(evdev.type_name(ev.type)
+                                for ev in trace.events)
+    return {
+        'name': descriptor_name(trace.descriptor),
+        'protocol_version': version,
+        'events': len(trace.events),
+        'frames': frames,
+        'duration': duration,
+        # duration spans frames - 1 intervals between them
+        'frames_per_sec': (frames - 1) / duration
+                          if duration and frames > 1 else None,
+        'types': dict(types),
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Record and replay input-proxy streams')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    record_parser = subparsers.add_parser(
+        'record', help='record a stream to a trace file')
+    record_parser.add_argument('--sender', action='store_true',
+                               help='command is input-proxy-sender, record '
+                                    'its output instead of stdin')
+    record_parser.add_argument('output', help='trace file to write')
+    record_parser.add_argument('command', nargs=argparse.REMAINDER,
+                               help='command to pass the stream through')
+
+    replay_parser = subparsers.add_parser(
+        'replay', help='replay a trace file')
+    replay_parser.add_argument('--speed', type=float, default=1,
+                               help='how many times faster than recorded, '
+                                    '0 for as fast as possible (default: 1)')
+    replay_parser.add_argument('--delay', type=float, default=1,
+                               help='seconds to wait for the device to get '
+                                    'picked up before sending events '
+                                    '(default: 1)')
+    replay_parser.add_argument('trace', help='trace file to replay')
+    replay_parser.add_argument('command', nargs=argparse.REMAINDER,
+                               help='command to replay into, usually '
+                                    'input-proxy-receiver (default: write '
+                                    'the stream to stdout)')
+
+    info_parser = subparsers.add_parser(
+        'info', help='print summary of a trace file')
+    info_parser.add_argument('trace', help='trace file')
+
+    args = parser.parse_args(args)
+    command = getattr(args, 'command', None)
+    if command and command[0] == '--':
+        command = command[1:]
+
+    if args.action == 'record':
+        return record(args.output, command, args.sender)
+
+    trace = read_trace(args.trace)
+    if args.action == 'info':
+        for key, value in info(trace).items():
+            print('{}: {}'.format(key, value))
+        return 0
+    if args.speed < 0:
+        parser.error('--speed must not be negative')
+    if command:
+        return replay_to_command(trace, command, args.speed, args.delay)
+    replay(trace, 1, args.speed, args.delay)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
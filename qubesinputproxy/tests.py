@@ -21,6 +21,7 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
+import itertools
 import os
 import string
 try:
@@ -30,21 +31,13 @@ except ImportError:
     import unittest
     ExtraTestCase = unittest.TestCase
 import subprocess
+import threading
 import time
-import select
+import zlib
 
-try:
-    # python3
-    from unittest.mock import ANY
-except ImportError:
-    # python2
-    class _ANY(object):
-        def __eq__(self, other): return True
-
-        def __ne__(self, other): return False
+from qubesinputproxy import evdev
+from qubesinputproxy import record
 
-        def __repr__(self): return '<ANY>'
-    ANY = _ANY()
 try:
     # for core3 only
     import asyncio
@@ -67,6 +60,33 @@ tablet_events = [
     'ABS_MT_TOOL_Y + (0, 768, 0, 0)',
     'ABS_PRESSURE + (0, 511, 0, 0)']
 
+# to make device names unique, so that tests can run in parallel
+device_ids = itertools.count()
+
+# defined in the device process, see TC_00_InputProxy.emit_frames(); frames
+# are lists of (event, value), each one is followed by SYN_REPORT
+emit_frames_helper = """
+import time
+def emit_frames(frames, rate):
+    start = time.monotonic()
+    for i, frame in enumerate(frames):
+        if rate:
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        for event, value in frame:
+            dev.emit(event, value, syn=False)
+        dev.syn()
+"""
+
+
+def local_cmd_prefix():
+    """Prefer executables from source directory"""
+    if os.path.exists('src/input-proxy-sender') \
+            and os.path.exists('src/input-proxy-receiver'):
+        return 'src/'
+    return ''
+
 
 class TC_00_InputProxy(ExtraTestCase):
     template = None
@@ -98,10 +118,8 @@ class TC_00_InputProxy(ExtraTestCase):
             self.service_opts = []
 
     def tearDown(self):
-        if hasattr(self, 'event_listener'):
-            self.event_listener.terminate()
-            self.event_listener.stdout.close()
-            self.event_listener.wait()
+        if hasattr(self, 'event_reader'):
+            self.event_reader.close()
         if hasattr(self, 'device_pipe'):
             self.destroyDevice()
         if hasattr(self, 'device_proxy'):
@@ -114,7 +132,22 @@ class TC_00_InputProxy(ExtraTestCase):
         if hasattr(self, 'device_proc'):
             self.device_proc.wait()
 
-    def setUpDevice(self, events, name="Test input device", vendor="0x1234"):
+    def setUpDeviceName(self, name=None, vendor=None):
+        """Set the test device name and vendor ID, by default unique to this
+        test, so that tests running in parallel (in the same or separate
+        qubes) can find exactly their devices"""
+        if name is None:
+            name = 'Test input device {}-{}'.format(os.getpid(),
+                                                     next(device_ids))
+        if vendor is None:
+            vendor = zlib.crc32(name.encode()) & 0x7fff
+        self.device_name = name
+        self.device_vendor = vendor
+
+    def setUpDevice(self, events, name=None, vendor=None):
+        """Create the test device, see setUpDeviceName() for name and
+        vendor"""
+        self.setUpDeviceName(name, vendor)
         if self.template is not None:
             p = self.vm.run('python3 -i >/dev/null', user="root",
                 passio_popen=True, gui=False)
@@ -128,11 +161,13 @@ class TC_00_InputProxy(ExtraTestCase):
         self.device_pipe = p.stdin
         self.device_pipe.write(b'from uinput import *\n')
         self.device_pipe.write(
-            'dev = Device([{}], name="{}", vendor={})\n'.format(
+            'dev = Device([{}], name="{}", vendor={:#x})\n'.format(
                 ','.join(events),
                 name,
                 vendor,
             ).encode())
+        self.device_pipe.write(
+            'exec({!r})\n'.format(emit_frames_helper).encode())
 
         try:
             self.device_pipe.flush()
@@ -140,24 +175,18 @@ class TC_00_InputProxy(ExtraTestCase):
             self.loop.run_until_complete(self.device_pipe.drain())
 
         if self.template is None:
-            dev_event_path = None
-            while not dev_event_path:
-                dev_event_path = subprocess.check_output(
-                    'ls -d /sys/devices/virtual/input/*/event* 2>/dev/null| '
-                    'tail -1',
-                    shell=True)
-                dev_event_path = dev_event_path.decode().strip()
-            dev_event_path = '/dev/input/' + os.path.basename(dev_event_path)
+            dev_event_path = evdev.wait_for_device(name, timeout=10,
+                                                   vendor=vendor)
+            self.assertIsNotNone(dev_event_path,
+                "Device '{}' not created".format(name))
 
             call_env = os.environ.copy()
-            # prefer executables from source directory
-            if os.path.exists('src/input-proxy-sender') \
-                    and os.path.exists('src/input-proxy-receiver'):
-                cmd_prefix = 'src/'
-            else:
-                cmd_prefix = ''
+            cmd_prefix = local_cmd_prefix()
 
             call_env['QREXEC_REMOTE_DOMAIN'] = 'remote'
+            # the same vendor ID on the output, see
+            # find_device_and_start_listener()
+            self.service_opts.append('--vendor={:x}'.format(vendor))
             self.device_proxy = subprocess.Popen([
                 'sudo', '-E', 'socat',
                 'exec:{}input-proxy-sender {}'.format(cmd_prefix,
@@ -167,145 +196,84 @@ class TC_00_InputProxy(ExtraTestCase):
                     ' '.join(self.service_opts))],
                 env=call_env)
 
-    def emit_event(self, event, value):
-        self.device_pipe.write('dev.emit({}, {})\n'.format(event, value).encode())
+    def emit_frames(self, frames, rate=None):
+        """Emit a sequence of frames - lists of (event name, value) - each
+        followed by SYN_REPORT, with a single command to the device process;
+        with rate given, frames are paced at that many frames per second,
+        otherwise sent as fast as possible. Returns without waiting for the
+        frames to be emitted."""
+        self.device_pipe.write('emit_frames([{}], {})\n'.format(
+            ','.join('[{}]'.format(','.join(
+                '({}, {})'.format(event, value) for event, value in frame))
+                for frame in frames),
+            rate or 0).encode())
         try:
             self.device_pipe.flush()
         except AttributeError:
             self.loop.run_until_complete(self.device_pipe.drain())
 
+    def emit_event(self, event, value):
+        self.emit_frames([[(event, value)]])
+
     def emit_click(self, key):
         # don't use dev.emit_click, python-uinput 0.10.1 is buggy (do not
         # send EV_SYN in between - X server driver ignore such events)
-        self.device_pipe.write('dev.emit({}, 1)\n'.format(key).encode())
-        self.device_pipe.write('dev.emit({}, 0)\n'.format(key).encode())
-        try:
-            self.device_pipe.flush()
-        except AttributeError:
-            self.loop.run_until_complete(self.device_pipe.drain())
-
-    def parse_one_event(self):
-        event_type = None
-        ignore = False
-        in_event_data = False
-        flags = {}
-        detail = '0'
-        for line in iter(
-                lambda: self.event_listener.stdout.readline(), ''):
-            line = line.decode().rstrip()
-            if not line:
-                break
-            if line.startswith('EVENT'):
-                # EVENT type 17 (RawMotion)
-                event_type = line.split()[3].strip('()')
-                ignore = False
-            elif ignore:
-                pass
-            elif not line.startswith('    '):
-                # non-event packet - for example device discovery, ignore
-                ignore = True
-            elif line.startswith('    detail:'):
-                detail = line.split(':')[1].strip()
-            elif line.startswith('    flags:'):
-                in_event_data = True
-            elif line.startswith('    valuators:'):
-                in_event_data = True
-            elif line.startswith('        '):
-                #         0: 120.34 (105.00)
-                #         1: -25.21 (-22.0)
-                if in_event_data:
-                    key, value = line.strip().split(':')
-                    # use raw value
-                    value = value.split()[1].strip('()')
-                    # round the value (to combat Xorg's float usage) and
-                    # convert back to %.2f (to keep the format)
-                    value = '{:.2f}'.format(round(float(value)))
-                    flags[key] = value
-                else:
-                    pass
-            elif line.startswith('    '):
-                # other fields - ignore
-                in_event_data = False
-
-        if ignore:
-            # retry
-            return None
-        # xinput in fc20 didn't included unchanged values
-        if '0' in flags and '1' not in flags:
-            flags['1'] = '0.00'
-        if '1' in flags and '0' not in flags:
-            flags['0'] = '0.00'
-        return [event_type, detail, flags]
+        self.emit_frames([[(key, 1)], [(key, 0)]])
 
     def assertNoEvent(self, msg=None, timeout=3000):
-        # wait for events with timeout
-        poll = select.poll()
-        poll.register(self.event_listener.stdout.fileno())
-        if poll.poll(timeout):
-            event = self.parse_one_event()
-            if event is None:
-                # ignored event
-                self.assertNoEvent(msg, timeout)
-            else:
-                self.fail("Received unexpected {} event{}".format(
-                    event,
-                    (": " + msg) if msg else ""
-                ))
+        frame = self.event_reader.read_frame(timeout / 1000)
+        if frame is not None:
+            self.fail("Received unexpected {} event{}".format(
+                frame,
+                (": " + msg) if msg else ""
+            ))
 
     def get_event(self, timeout=3000):
-        # wait for events with timeout
-        poll = select.poll()
-        poll.register(self.event_listener.stdout.fileno())
-        if not poll.poll(timeout):
-            self.fail("Didn't received event within 3 sec timeout")
-        event = self.parse_one_event()
-        if event is None:
-            # retry
-            return self.get_event(timeout)
-        return event
+        """Get the next frame of events, as a list of (code name, value)"""
+        frame = self.event_reader.read_frame(timeout / 1000)
+        if frame is None:
+            self.fail("Didn't received event within {} sec timeout".format(
+                timeout / 1000))
+        return frame
 
     def assertEvent(self, expected_event, timeout=3000):
         event = self.get_event(timeout)
         self.assertEqual(event, expected_event)
 
+    def receive_motion(self, timeout):
+        """Sum up REL_X and REL_Y until BTN_LEFT press, returns (x, y)"""
+        total_x = total_y = 0
+        while True:
+            event = self.get_event(timeout=timeout)
+            if event == [('BTN_LEFT', 1)]:
+                return total_x, total_y
+            for name, value in event:
+                if name == 'REL_X':
+                    total_x += value
+                elif name == 'REL_Y':
+                    total_y += value
+                else:
+                    self.fail('Unexpected event {}'.format(event))
+
     def find_device_and_start_listener(self, expected_name=None):
+        vendor = None
         if expected_name is None:
             if hasattr(self, 'vm'):
+                # the VM name is unique already
                 expected_name = '{}: {}'.format(
-                    self.vm.name, 'Test input device')
+                    self.vm.name, self.device_name)
             else:
-                expected_name = 'remote: Test input device'
-        device_id = None
-        try_count = 20
-        while device_id is None and try_count > 0:
-            try:
-                with open(os.devnull, 'w') as null:
-                    device_id = subprocess.check_output(
-                        ['xinput', 'list', '--id-only', expected_name],
-                        stderr=null
-                    ).strip()
-            except subprocess.CalledProcessError:
-                try_count -= 1
-                if hasattr(self, 'loop'):
-                    # core3 uses asyncio
-                    self.loop.run_until_complete(asyncio.sleep(0.2))
-                else:
-                    time.sleep(0.2)
-
-        self.assertIsNotNone(device_id,
+                expected_name = 'remote: ' + self.device_name
+                vendor = self.device_vendor
+        dev_path = evdev.wait_for_device(expected_name, timeout=10,
+                                         vendor=vendor)
+        self.assertIsNotNone(dev_path,
             "Device '{}' not found".format(expected_name))
-        device_id = device_id.decode()
-
-        # terminate old listener if there was one
-        if hasattr(self, 'event_listener'):
-            self.event_listener.terminate()
-            self.event_listener.stdout.close()
-            self.event_listener.wait()
-        self.event_listener = subprocess.Popen(
-            ['xinput', 'test-xi2', '--root', device_id],
-            stdout=subprocess.PIPE, bufsize=0)
-        # wait for the listener to really listen for events
-        time.sleep(0.5)
+
+        # close old listener if there was one
+        if hasattr(self, 'event_reader'):
+            self.event_reader.close()
+        self.event_reader = evdev.EventReader(dev_path)
 
     def allow_service(self, service):
         if hasattr(self, 'vm'):
@@ -333,12 +301,12 @@ class TC_00_InputProxy(ExtraTestCase):
         self.emit_event('REL_Y', 1)
         self.emit_click('BTN_LEFT')
 
-        self.assertEvent(['RawMotion', '0', {'0': '1.00', '1': '0.00'}])
-        self.assertEvent(['RawMotion', '0', {'0': '1.00', '1': '0.00'}])
-        self.assertEvent(['RawMotion', '0', {'1': '1.00', '0': '0.00'}])
-        self.assertEvent(['RawMotion', '0', {'1': '1.00', '0': '0.00'}])
-        self.assertEvent(['RawButtonPress', '1', {}])
-        self.assertEvent(['RawButtonRelease', '1', {}])
+        self.assertEvent([('REL_X', 1)])
+        self.assertEvent([('REL_X', 1)])
+        self.assertEvent([('REL_Y', 1)])
+        self.assertEvent([('REL_Y', 1)])
+        self.assertEvent([('BTN_LEFT', 1)])
+        self.assertEvent([('BTN_LEFT', 0)])
 
     def test_010_mouse_deny_keyboard(self):
         """Mouse trying to send keyboard events"""
@@ -362,12 +330,12 @@ class TC_00_InputProxy(ExtraTestCase):
         self.emit_event('REL_Y', 1)
         self.emit_click('BTN_LEFT')
 
-        self.assertEvent(['RawMotion', '0', {'0': '1.00', '1': '0.00'}])
-        self.assertEvent(['RawMotion', '0', {'0': '1.00', '1': '0.00'}])
-        self.assertEvent(['RawMotion', '0', {'1': '1.00', '0': '0.00'}])
-        self.assertEvent(['RawMotion', '0', {'1': '1.00', '0': '0.00'}])
-        self.assertEvent(['RawButtonPress', '1', {}])
-        self.assertEvent(['RawButtonRelease', '1', {}])
+        self.assertEvent([('REL_X', 1)])
+        self.assertEvent([('REL_X', 1)])
+        self.assertEvent([('REL_Y', 1)])
+        self.assertEvent([('REL_Y', 1)])
+        self.assertEvent([('BTN_LEFT', 1)])
+        self.assertEvent([('BTN_LEFT', 0)])
 
         self.emit_event('KEY_A', 1)
         self.emit_event('KEY_B', 1)
@@ -387,36 +355,31 @@ class TC_00_InputProxy(ExtraTestCase):
         for _ in range(4):
             self.emit_click('KEY_BACKSPACE')
 
-        for key in ('38', '56', '54', '40'):
-            self.assertEvent(['RawKeyPress', key, {}])
-            self.assertEvent(['RawKeyRelease', key, {}])
+        for key in ('KEY_A', 'KEY_B', 'KEY_C', 'KEY_D'):
+            self.assertEvent([(key, 1)])
+            self.assertEvent([(key, 0)])
         for _ in range(4):
-            self.assertEvent(['RawKeyPress', '22', {}])
-            self.assertEvent(['RawKeyRelease', '22', {}])
+            self.assertEvent([('KEY_BACKSPACE', 1)])
+            self.assertEvent([('KEY_BACKSPACE', 0)])
 
     def test_040_mouse_keyboard(self):
         """Mouse and keyboard combined device"""
         self.allow_service('qubes.InputMouse')
         self.allow_service('qubes.InputKeyboard')
         self.setUpDevice(mouse_events + keyboard_events)
-        dev_name = '{}: {}'.format(
-            self.vm.name if hasattr(self, 'vm') else 'remote',
-            'Test input device')
-        self.find_device_and_start_listener('pointer:' + dev_name)
+        self.find_device_and_start_listener()
         self.emit_event('REL_X', 1)
         self.emit_event('REL_X', 1)
         self.emit_event('REL_Y', 1)
         self.emit_event('REL_Y', 1)
         self.emit_click('BTN_LEFT')
 
-        self.assertEvent(['RawMotion', '0', {'0': '1.00', '1': '0.00'}])
-        self.assertEvent(['RawMotion', '0', {'0': '1.00', '1': '0.00'}])
-        self.assertEvent(['RawMotion', '0', {'1': '1.00', '0': '0.00'}])
-        self.assertEvent(['RawMotion', '0', {'1': '1.00', '0': '0.00'}])
-        self.assertEvent(['RawButtonPress', '1', {}])
-        self.assertEvent(['RawButtonRelease', '1', {}])
-
-        self.find_device_and_start_listener('keyboard:' + dev_name)
+        self.assertEvent([('REL_X', 1)])
+        self.assertEvent([('REL_X', 1)])
+        self.assertEvent([('REL_Y', 1)])
+        self.assertEvent([('REL_Y', 1)])
+        self.assertEvent([('BTN_LEFT', 1)])
+        self.assertEvent([('BTN_LEFT', 0)])
 
         self.emit_click('KEY_A')
         self.emit_click('KEY_B')
@@ -425,12 +388,12 @@ class TC_00_InputProxy(ExtraTestCase):
         for _ in range(4):
             self.emit_click('KEY_BACKSPACE')
 
-        for key in ('38', '56', '54', '40'):
-            self.assertEvent(['RawKeyPress', key, {}])
-            self.assertEvent(['RawKeyRelease', key, {}])
+        for key in ('KEY_A', 'KEY_B', 'KEY_C', 'KEY_D'):
+            self.assertEvent([(key, 1)])
+            self.assertEvent([(key, 0)])
         for _ in range(4):
-            self.assertEvent(['RawKeyPress', '22', {}])
-            self.assertEvent(['RawKeyRelease', '22', {}])
+            self.assertEvent([('KEY_BACKSPACE', 1)])
+            self.assertEvent([('KEY_BACKSPACE', 0)])
 
     def test_050_mouse_late_attach(self):
         """Test reattach at user login/GUI start - #1930"""
@@ -456,12 +419,12 @@ class TC_00_InputProxy(ExtraTestCase):
         self.emit_event('REL_Y', 1)
         self.emit_click('BTN_LEFT')
 
-        self.assertEvent(['RawMotion', '0', {'0': '1.00', '1': '0.00'}])
-        self.assertEvent(['RawMotion', '0', {'0': '1.00', '1': '0.00'}])
-        self.assertEvent(['RawMotion', '0', {'1': '1.00', '0': '0.00'}])
-        self.assertEvent(['RawMotion', '0', {'1': '1.00', '0': '0.00'}])
-        self.assertEvent(['RawButtonPress', '1', {}])
-        self.assertEvent(['RawButtonRelease', '1', {}])
+        self.assertEvent([('REL_X', 1)])
+        self.assertEvent([('REL_X', 1)])
+        self.assertEvent([('REL_Y', 1)])
+        self.assertEvent([('REL_Y', 1)])
+        self.assertEvent([('BTN_LEFT', 1)])
+        self.assertEvent([('BTN_LEFT', 0)])
 
     def test_060_tablet(self):
         """Test tablet events (absolute axis)"""
@@ -493,16 +456,125 @@ class TC_00_InputProxy(ExtraTestCase):
         self.emit_event('REL_Y', 1)
         self.emit_event('REL_Y', 1)
 
-        self.assertEvent(['RawTouchBegin', ANY,
-            {'0': '15000.00', '1': '15000.00'}])
-        self.assertEvent(['RawTouchUpdate', ANY,
-            {'0': '16000.00', '1': '15000.00'}])
-        self.assertEvent(['RawTouchUpdate', ANY,
-            {'0': '16000.00', '1': '16000.00'}])
-        # FIXME: really (0, 0)?
-        self.assertEvent(['RawTouchEnd', ANY, {'0': '0.00', '1': '0.00'}])
+        self.assertEvent([('ABS_X', 15000)])
+        self.assertEvent([('ABS_Y', 15000)])
+        self.assertEvent([('BTN_TOUCH', 1)])
+        self.assertEvent([('ABS_X', 16000)])
+        self.assertEvent([('ABS_Y', 16000)])
+        self.assertEvent([('BTN_TOUCH', 0)])
         self.assertNoEvent(msg="rel events should be ignored")
 
+    def test_070_mouse_high_rate(self):
+        """Mouse at 1000 reports/s, for a few seconds"""
+        self.allow_service('qubes.InputMouse')
+        self.setUpDevice(mouse_events)
+        self.find_device_and_start_listener()
+        count = 3000
+        self.emit_frames([[('REL_X', 1), ('REL_Y', -1)]] * count +
+                         [[('BTN_LEFT', 1)], [('BTN_LEFT', 0)]],
+                         rate=1000)
+
+        # motion may be merged on the way, but nothing should be lost
+        total = self.receive_motion(timeout=count + 3000)
+        self.assertEvent([('BTN_LEFT', 0)])
+        self.assertEqual(total, (count, -count))
+
+    def test_080_mouse_replay(self):
+        """Recorded mouse stream replayed directly into the receiver"""
+        if self.template is not None:
+            self.skipTest('needs the receiver running locally')
+        self.setUpDeviceName()
+        count = 3000
+        trace = record.make_trace(
+            record.make_descriptor(self.device_name, mouse_events),
+            [[('REL_X', 1), ('REL_Y', -1)]] * count +
+            [[('BTN_LEFT', 1)], [('BTN_LEFT', 0)]],
+            rate=1000)
+
+        call_env = os.environ.copy()
+        call_env['QREXEC_REMOTE_DOMAIN'] = 'remote'
+        replay = threading.Thread(
+            target=record.replay_to_command,
+            args=(trace, [
+                'sudo', '-E', local_cmd_prefix() + 'input-proxy-receiver',
+                '--mouse', '--vendor={:x}'.format(self.device_vendor)]),
+            kwargs={'delay': 3, 'env': call_env})
+        replay.start()
+        self.addCleanup(replay.join)
+        self.find_device_and_start_listener()
+
+        total = self.receive_motion(timeout=count + 3000)
+        self.assertEvent([('BTN_LEFT', 0)])
+        self.assertEqual(total, (count, -count))
+
+    def test_090_tablet_multitouch_rate_limit(self):
+        """Multi-touch stream above the absolute axis rate limit"""
+        if self.template is not None:
+            self.skipTest('needs the receiver running locally')
+        self.setUpDeviceName()
+        slots = 3
+        count = 300
+        descriptor = record.make_descriptor(self.device_name, [
+            'BTN_TOUCH', 'ABS_X', 'ABS_MT_SLOT', 'ABS_MT_TRACKING_ID',
+            'ABS_MT_POSITION_X', 'ABS_MT_POSITION_Y'], {
+                'ABS_X': (0, 65535, 0, 0),
+                'ABS_MT_SLOT': (0, slots - 1, 0, 0),
+                'ABS_MT_TRACKING_ID': (0, 65535, 0, 0),
+                'ABS_MT_POSITION_X': (0, 65535, 0, 0),
+                'ABS_MT_POSITION_Y': (0, 65535, 0, 0),
+            })
+        frames = [[('BTN_TOUCH', 1)] + [
+            event for slot in range(slots) for event in (
+                ('ABS_MT_SLOT', slot), ('ABS_MT_TRACKING_ID', slot + 1))]]
+        for i in range(count):
+            frames.append([('ABS_X', i)] + [
+                event for slot in range(slots) for event in (
+                    ('ABS_MT_SLOT', slot),
+                    ('ABS_MT_POSITION_X', i * slots + slot),
+                    ('ABS_MT_POSITION_Y', i * slots + slot + 1))])
+        frames.append([
+            event for slot in range(slots) for event in (
+                ('ABS_MT_SLOT', slot), ('ABS_MT_TRACKING_ID', -1))] +
+            [('BTN_TOUCH', 0)])
+        trace = record.make_trace(descriptor, frames, rate=1000)
+
+        call_env = os.environ.copy()
+        call_env['QREXEC_REMOTE_DOMAIN'] = 'remote'
+        # about 30 times less than the stream has
+        replay = threading.Thread(
+            target=record.replay_to_command,
+            args=(trace, [
+                'sudo', '-E', local_cmd_prefix() + 'input-proxy-receiver',
+                '--mouse', '--tablet', '--rate-limit-abs=300',
+                '--vendor={:x}'.format(self.device_vendor)]),
+            kwargs={'delay': 3, 'env': call_env})
+        replay.start()
+        self.addCleanup(replay.join)
+        self.find_device_and_start_listener()
+
+        def per_slot(frames):
+            """Multi-touch events grouped by slot, ABS_MT_SLOT itself is
+            left out - the kernel sends it only when the slot changes"""
+            result = {}
+            slot = 0
+            for frame in frames:
+                for name, value in frame:
+                    if name == 'ABS_MT_SLOT':
+                        slot = value
+                    elif name.startswith('ABS_MT_'):
+                        result.setdefault(slot, []).append((name, value))
+            return result
+
+        # ABS_X is coalesced, its latest value may come after the rest
+        received = []
+        events = []
+        while ('BTN_TOUCH', 0) not in events or \
+                ('ABS_X', count - 1) not in events:
+            received.append(self.get_event())
+            events.extend(received[-1])
+        # nothing of multi-touch may be dropped
+        self.assertEqual(per_slot(received), per_slot(frames))
+
 class TC_01_InputProxyExclude(ExtraTestCase):
     template = None
     def setUp(self):
@@ -513,21 +585,8 @@ class TC_01_InputProxyExclude(ExtraTestCase):
             self.skipTest('No input proxy on whonix')
 
     def find_device(self):
-        try_count = 20
-        for try_no in range(try_count):
-            try:
-                xinput_list = subprocess.check_output(
-                    ['xinput', 'list', '--name-only'],
-                    stderr=subprocess.DEVNULL
-                )
-                for line in xinput_list.decode().splitlines():
-                    if line.startswith(self.vm.name + ':'):
-                        return line
-            except subprocess.CalledProcessError:
-                pass
-            self.loop.run_until_complete(asyncio.sleep(0.2))
-
-        return None
+        return evdev.wait_for_device(self.vm.name + ':', timeout=4,
+                                     prefix=True)
 
     def test_000_qemu_tablet(self):
         self.vm = self.create_vms(["input"])[0]
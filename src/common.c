@@ -1,4 +1,14 @@
+#define _GNU_SOURCE
 #include <unistd.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stdint.h>
+#include <sched.h>
+#include <malloc.h>
+#include <sys/mman.h>
+#include <sys/resource.h>
+#include "common.h"
 
 int read_all(int fd, void *buf, size_t size) {
     size_t pos = 0;
@@ -13,7 +23,7 @@ int read_all(int fd, void *buf, size_t size) {
     return pos;
 }
 
-int write_all(int fd, void *buf, size_t size) {
+int write_all(int fd, const void *buf, size_t size) {
     size_t pos = 0;
     int ret;
     
@@ -25,3 +35,321 @@ int write_all(int fd, void *buf, size_t size) {
     }
     return pos;
 }
+
+/* read and throw away size bytes
+ *
+ * returns: -1 on error, 0 on EOF, >0 on success
+ */
+int discard_all(int fd, size_t size) {
+    char discard_buffer[128];
+    int rc = 1;
+
+    while (size) {
+        if (size < sizeof(discard_buffer))
+            rc = read_all(fd, discard_buffer, size);
+        else
+            rc = read_all(fd, discard_buffer, sizeof(discard_buffer));
+        if (rc <= 0)
+            return rc;
+        size -= rc;
+    }
+    return rc;
+}
+
+/* count events up to and including the last SYN_REPORT */
+size_t complete_frames(const struct input_event *ev, size_t count) {
+    size_t i;
+
+    for (i = count; i > 0; i--) {
+        if (ev[i-1].type == EV_SYN && ev[i-1].code == SYN_REPORT)
+            return i;
+    }
+    return 0;
+}
+
+/* relative axes that can be summed up between frames */
+int is_coalescable_rel(const struct input_event *ev) {
+    if (ev->type != EV_REL)
+        return 0;
+    switch (ev->code) {
+        case REL_X:
+        case REL_Y:
+        case REL_WHEEL:
+        case REL_HWHEEL:
+#ifdef REL_WHEEL_HI_RES
+        case REL_WHEEL_HI_RES:
+#endif
+#ifdef REL_HWHEEL_HI_RES
+        case REL_HWHEEL_HI_RES:
+#endif
+            return 1;
+    }
+    return 0;
+}
+
+/* merge consecutive frames that contain only relative motion (see
+ * is_coalescable_rel()) into one, summing deltas of the same axis; frames with
+ * any other event (key, button, absolute axis etc) are kept intact and in
+ * order, and nothing is merged across them; ev should contain only complete
+ * frames
+ *
+ * returns: new events count; the number of events removed is added to *merged
+ */
+size_t coalesce_rel_frames(struct input_event *ev, size_t count,
+        unsigned long *merged) {
+    size_t in = 0, out = 0;
+    /* where the last frame written starts, if it can be merged into */
+    size_t last_start = 0;
+    int last_mergeable = 0;
+    size_t start, end, j, k;
+    int mergeable;
+    long long sum;
+
+    while (in < count) {
+        start = in;
+        mergeable = 1;
+        for (end = start; end < count; end++) {
+            if (ev[end].type == EV_SYN && ev[end].code == SYN_REPORT)
+                break;
+            if (!is_coalescable_rel(&ev[end]))
+                mergeable = 0;
+        }
+        if (end == count) {
+            /* incomplete frame, keep it as is */
+            end = count - 1;
+            mergeable = 0;
+        }
+
+        if (mergeable && last_mergeable) {
+            /* drop SYN_REPORT of the previous frame */
+            out--;
+            (*merged)++;
+            for (j = start; j < end; j++) {
+                for (k = last_start; k < out; k++) {
+                    if (ev[k].code == ev[j].code)
+                        break;
+                }
+                if (k < out) {
+                    sum = (long long)ev[k].value + ev[j].value;
+                    if (sum > INT32_MAX)
+                        sum = INT32_MAX;
+                    if (sum < INT32_MIN)
+                        sum = INT32_MIN;
+                    ev[k].value = sum;
+                    (*merged)++;
+                } else {
+                    ev[out++] = ev[j];
+                }
+            }
+            ev[out++] = ev[end];
+        } else {
+            if (out != start)
+                memmove(ev + out, ev + start,
+                        (end - start + 1) * sizeof(ev[0]));
+            last_start = out;
+            out += end - start + 1;
+        }
+        last_mergeable = mergeable;
+        in = end + 1;
+    }
+    return out;
+}
+
+/* coalesce relative motion (see coalesce_rel_frames()) in complete frames in
+ * the buffer, the incomplete frame at the end is left untouched */
+void coalesce_event_buffer(struct event_buffer *buf, unsigned long *merged) {
+    size_t frames_count, new_count;
+
+    frames_count = complete_frames(buf->ev, buf->len / sizeof(buf->ev[0]));
+    new_count = coalesce_rel_frames(buf->ev, frames_count, merged);
+    if (new_count == frames_count)
+        return;
+    memmove(buf->ev + new_count, buf->ev + frames_count,
+            buf->len - frames_count * sizeof(buf->ev[0]));
+    buf->len -= (frames_count - new_count) * sizeof(buf->ev[0]);
+}
+
+/* remove key repeats (EV_KEY with value 2) from the buffer, together with
+ * frames that contained nothing else; the buffer should start at a frame
+ * boundary; *removed tells whether anything was removed from the incomplete
+ * frame at the end, keep it between calls and clear it when that frame is
+ * sent before its end */
+void drop_key_repeats(struct event_buffer *buf, int *removed) {
+    struct input_event *ev = buf->ev;
+    size_t count = buf->len / sizeof(ev[0]);
+    size_t in, out = 0, frame_start = 0;
+
+    for (in = 0; in < count; in++) {
+        if (ev[in].type == EV_KEY && ev[in].value == 2) {
+            *removed = 1;
+            continue;
+        }
+        if (ev[in].type == EV_SYN && ev[in].code == SYN_REPORT) {
+            if (*removed && out == frame_start) {
+                *removed = 0;
+                continue;
+            }
+            *removed = 0;
+            ev[out++] = ev[in];
+            frame_start = out;
+            continue;
+        }
+        ev[out++] = ev[in];
+    }
+    if (out == count)
+        return;
+    /* keep partial event, if any */
+    memmove(ev + out, ev + count, buf->len - count * sizeof(ev[0]));
+    buf->len -= (count - out) * sizeof(ev[0]);
+}
+
+/* start with a full bucket */
+void token_bucket_init(struct token_bucket *tb, unsigned int rate,
+        unsigned int burst) {
+    tb->rate = rate;
+    tb->burst = burst ? burst : 1;
+    tb->tokens = tb->burst;
+    clock_gettime(CLOCK_MONOTONIC, &tb->last);
+}
+
+/* tokens available at the time now */
+static double token_bucket_level(const struct token_bucket *tb,
+        const struct timespec *now) {
+    double tokens;
+
+    tokens = tb->tokens + ((now->tv_sec - tb->last.tv_sec) +
+            (now->tv_nsec - tb->last.tv_nsec) / 1e9) * tb->rate;
+    if (tokens > tb->burst)
+        tokens = tb->burst;
+    return tokens;
+}
+
+/* take a single token, if available
+ *
+ * returns: 1 if taken (or there is no limit), 0 if over the limit
+ */
+int token_bucket_take(struct token_bucket *tb, const struct timespec *now) {
+    if (!tb->rate)
+        return 1;
+    tb->tokens = token_bucket_level(tb, now);
+    tb->last = *now;
+    if (tb->tokens < 1)
+        return 0;
+    tb->tokens -= 1;
+    return 1;
+}
+
+/* how long until a token is available, in milliseconds, rounded up */
+int token_bucket_delay(const struct token_bucket *tb,
+        const struct timespec *now) {
+    double tokens;
+
+    if (!tb->rate)
+        return 0;
+    tokens = token_bucket_level(tb, now);
+    if (tokens >= 1)
+        return 0;
+    return (1 - tokens) * 1000 / tb->rate + 1;
+}
+
+/* parse --low-latency argument, an optional SCHED_FIFO priority
+ *
+ * returns: -1 on error, 0 on success
+ */
+int parse_low_latency(const char *arg, int *priority) {
+    char *end;
+    long value;
+
+    if (!arg) {
+        *priority = LOW_LATENCY_DEFAULT_PRIORITY;
+        return 0;
+    }
+    value = strtol(arg, &end, 10);
+    if (*arg == '\0' || *end != '\0' ||
+            value < sched_get_priority_min(SCHED_FIFO) ||
+            value > sched_get_priority_max(SCHED_FIFO)) {
+        fprintf(stderr, "Invalid real-time priority: %s\n", arg);
+        return -1;
+    }
+    *priority = value;
+    return 0;
+}
+
+/* parse --cpu argument
+ *
+ * returns: -1 on error, 0 on success
+ */
+int parse_cpu(const char *arg, int *cpu) {
+    char *end;
+    long value;
+
+    value = strtol(arg, &end, 10);
+    if (*arg == '\0' || *end != '\0' || value < 0 || value >= CPU_SETSIZE) {
+        fprintf(stderr, "Invalid CPU number: %s\n", arg);
+        return -1;
+    }
+    *cpu = value;
+    return 0;
+}
+
+/* touch the stack the process may need, so it's faulted in (and locked)
+ * upfront */
+static void __attribute__((noinline)) prefault_stack(void) {
+    volatile char stack[LOW_LATENCY_STACK_SIZE];
+    size_t i;
+
+    for (i = 0; i < sizeof(stack); i += 4096)
+        stack[i] = 0;
+}
+
+/* fault in and keep some heap, so later allocations (like devices in daemon
+ * mode) don't page fault or call into the kernel */
+static void prefault_heap(void) {
+    char *reserve;
+
+    /* never give heap memory back, and never use mmap() for allocations */
+    mallopt(M_TRIM_THRESHOLD, -1);
+    mallopt(M_MMAP_MAX, 0);
+    reserve = malloc(LOW_LATENCY_HEAP_RESERVE);
+    if (!reserve)
+        return;
+    memset(reserve, 0, LOW_LATENCY_HEAP_RESERVE);
+    free(reserve);
+}
+
+/* move the process out of the way of other load on the system: pin it to a
+ * CPU (if cpu >= 0) and, if priority > 0, run it with SCHED_FIFO (or at least
+ * a lower nice value) with all its memory locked; failing to get elevated
+ * priority or to lock memory is only reported, since usually it means missing
+ * privileges, but the process still works
+ *
+ * returns: -1 on error, 0 on success
+ */
+int set_low_latency(int priority, int cpu) {
+    struct sched_param param = { .sched_priority = priority };
+    cpu_set_t cpus;
+
+    if (cpu >= 0) {
+        CPU_ZERO(&cpus);
+        CPU_SET(cpu, &cpus);
+        if (sched_setaffinity(0, sizeof(cpus), &cpus) == -1) {
+            perror("sched_setaffinity");
+            return -1;
+        }
+    }
+    if (priority <= 0)
+        return 0;
+
+    if (sched_setscheduler(0, SCHED_FIFO | SCHED_RESET_ON_FORK, &param) == -1) {
+        perror("sched_setscheduler");
+        if (setpriority(PRIO_PROCESS, 0, LOW_LATENCY_NICE) == -1)
+            perror("setpriority");
+    }
+    if (mlockall(MCL_CURRENT | MCL_FUTURE) == -1) {
+        perror("mlockall");
+        return 0;
+    }
+    prefault_stack();
+    prefault_heap();
+    return 0;
+}
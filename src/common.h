@@ -1,2 +1,48 @@
+#include <stddef.h>
+#include <time.h>
+#include <linux/input.h>
+
+/* how many events are read/written at once */
+#define EVENT_BUFFER_SIZE 64
+
+/* --low-latency: SCHED_FIFO priority if not given, nice value used when
+ * SCHED_FIFO is not allowed, stack and heap faulted in upfront */
+#define LOW_LATENCY_DEFAULT_PRIORITY 10
+#define LOW_LATENCY_NICE -10
+#define LOW_LATENCY_STACK_SIZE (128 * 1024)
+#define LOW_LATENCY_HEAP_RESERVE (1024 * 1024)
+
+struct event_buffer {
+    struct input_event ev[EVENT_BUFFER_SIZE];
+    /* in bytes, may include partial event at the end */
+    size_t len;
+};
+
+/* token bucket rate limiter, one token per event */
+struct token_bucket {
+    /* tokens added per second, 0 means no limit */
+    unsigned int rate;
+    /* max tokens accumulated */
+    unsigned int burst;
+    double tokens;
+    /* CLOCK_MONOTONIC of the last refill */
+    struct timespec last;
+};
+
 int write_all(int fd, const void *buf, size_t size);
 int read_all(int fd, void *buf, size_t size);
+int discard_all(int fd, size_t size);
+size_t complete_frames(const struct input_event *ev, size_t count);
+int is_coalescable_rel(const struct input_event *ev);
+size_t coalesce_rel_frames(struct input_event *ev, size_t count,
+        unsigned long *merged);
+void coalesce_event_buffer(struct event_buffer *buf, unsigned long *merged);
+void drop_key_repeats(struct event_buffer *buf, int *removed);
+void token_bucket_init(struct token_bucket *tb, unsigned int rate,
+        unsigned int burst);
+int token_bucket_take(struct token_bucket *tb, const struct timespec *now);
+int token_bucket_delay(const struct token_bucket *tb,
+        const struct timespec *now);
+int parse_low_latency(const char *arg, int *priority);
+int parse_cpu(const char *arg, int *cpu);
+int set_low_latency(int priority, int cpu);
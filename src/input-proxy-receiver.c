@@ -1,15 +1,24 @@
+#define _GNU_SOURCE
 #include <unistd.h>
 #include <getopt.h>
 #include <errno.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <stddef.h>
+#include <stdarg.h>
 #include <string.h>
 #include <poll.h>
 #include <fcntl.h>
+#include <signal.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <sys/epoll.h>
 #include <linux/input.h>
 #include <linux/uinput.h>
 #include "protocol.h"
 #include "common.h"
+#include "stats.h"
+#include "transport.h"
 
 #define UINPUT_DEVICE "/dev/uinput"
 
@@ -22,16 +31,149 @@
  * - useful for testing */
 // #define FUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION
 
+/* accepted EV_REP values (ms) - for the delay and the period */
+#define REP_VALUE_MAX 10000
+
+/* max length of qrexec service descriptor sent to socket-based services */
+#define SERVICE_DESCRIPTOR_MAX 256
+
+/* event classes with a separate rate limit */
+enum rate_class {
+    /* EV_REL */
+    RATE_MOTION,
+    /* EV_KEY (except releases), EV_MSC, EV_LED, EV_SND, EV_SW, EV_REP */
+    RATE_KEYS,
+    /* EV_ABS */
+    RATE_ABS,
+    RATE_CLASS_COUNT,
+};
+
+/* what to do with events above the rate limit */
+enum rate_action {
+    /* hold back relative motion (summed up) and absolute position (the
+     * latest), forward them when the limit allows; drop everything else */
+    RATE_ACTION_COALESCE,
+    RATE_ACTION_DROP,
+    RATE_ACTION_DISCONNECT,
+};
+
+/* distinct (type, code) pairs counted between drop log summaries, the rest is
+ * counted only in the totals */
+#define DROP_LOG_CODES 16
+
+struct drop_log_entry {
+    uint16_t type;
+    uint16_t code;
+    unsigned long count;
+};
+
+/* events ignored by validate_event(), logged as a periodic summary instead of
+ * a message per event, see log_dropped_events() */
+struct drop_log {
+    unsigned long total;
+    unsigned long types[EV_CNT];
+    /* only with --verbose */
+    struct drop_log_entry codes[DROP_LOG_CODES];
+    int codes_count;
+    /* CLOCK_MONOTONIC, when the summary is due; set at the first event */
+    struct timespec due;
+};
+
 struct options {
     char *name;
     int vendor;
     int product;
     int log_level;
+    /* serve many connections on this socket, instead of stdin/stdout */
+    char *listen_path;
+    /* merge pending relative motion frames */
+    int coalesce;
+    /* capabilities allowed for remote devices */
+    struct input_proxy_device_caps caps;
+    /* NULL if disabled */
+    struct stats *stats;
+    /* events per second, with a burst of one second; 0 means no limit */
+    unsigned int rate_limit[RATE_CLASS_COUNT];
+    enum rate_action rate_limit_action;
+    /* keep uinput devices of closed connections for reuse for that many
+     * seconds, daemon mode only */
+    int keep_devices;
+    /* seconds between summaries of ignored events */
+    int drop_log_interval;
+    /* SCHED_FIFO priority, 0 if disabled, see set_low_latency() */
+    int low_latency;
+    /* -1 if not pinned to a CPU */
+    int cpu;
+    /* see transport_open(), standalone mode only */
+    const char *transport;
+};
+
+/* connection setup state, used only in daemon mode; in the standalone mode
+ * receive_and_validate_caps() does the same with blocking reads */
+struct handshake {
+    /* "service+arg source-domain" */
+    char descriptor[SERVICE_DESCRIPTOR_MAX];
+    size_t descriptor_len;
+    int descriptor_done;
+    struct input_proxy_hello hello;
+    size_t hello_len;
+    struct input_proxy_device_caps_msg caps_msg;
+    struct input_proxy_version_proposal proposal;
+    /* including discarded bytes */
+    size_t caps_len;
+};
+
+struct device;
+
+/* what epoll_event.data.ptr points at */
+struct device_fd {
+    struct device *dev;
+    int fd;
+};
+
+/* state of a single forwarded device */
+struct device {
+    /* the same fd in daemon mode */
+    int in_fd;
+    int out_fd;
+    /* in_fd/out_fd are closed by device_free(); not set for stdin/stdout */
+    int owns_fds;
+    /* in_fd/out_fd, unless another transport was given */
+    struct transport *remote;
+    int uinput_fd;
+    /* source domain, if known */
+    char *domain;
+    char *name;
+    /* protocol version used by the remote end */
+    int version;
+    /* capabilities negotiated with the remote end */
     struct input_proxy_device_caps caps;
     struct input_absinfo absinfo[ABS_CNT];
+    struct event_buffer in;
+    struct event_buffer out;
+    /* events removed by coalescing */
+    unsigned long merged;
+    struct token_bucket rate[RATE_CLASS_COUNT];
+    /* events held back by RATE_ACTION_COALESCE */
+    int held[RATE_CLASS_COUNT];
+    int32_t held_rel[REL_CNT];
+    unsigned long held_relbit[BITS_TO_LONGS(REL_CNT)];
+    int32_t held_abs[ABS_CNT];
+    unsigned long held_absbit[BITS_TO_LONGS(ABS_CNT)];
+    /* events dropped above the rate limit */
+    unsigned long rate_limited;
+    struct drop_log drop_log;
+    /* keys currently pressed */
+    unsigned long keys_down[BITS_TO_LONGS(KEY_CNT)];
+    /* daemon mode only */
+    struct handshake *handshake;
+    struct device_fd stream_src;
+    struct device_fd uinput_src;
+    /* CLOCK_MONOTONIC, when a parked device is destroyed */
+    struct timespec expires;
 };
 
-void long_and(unsigned long *dst, unsigned long *src, size_t longs_count) {
+void long_and(unsigned long *dst, const unsigned long *src, size_t longs_count) {
     size_t i;
 
     for (i = 0; i < longs_count; i++)
@@ -39,7 +181,7 @@ void long_and(unsigned long *dst, unsigned long *src, size_t longs_count) {
 }
 #define LONG_AND(dst, src) long_and(dst, src, sizeof(dst)/sizeof(dst[0]))
 
-int long_test_bit(unsigned long *bitfield, int bit, size_t bitfield_size) {
+int long_test_bit(const unsigned long *bitfield, int bit, size_t bitfield_size) {
     if (bit / BITS_PER_LONG >= bitfield_size)
         return 0;
     return (bitfield[bit / BITS_PER_LONG] &
@@ -57,74 +199,34 @@ void long_set_bit(unsigned long *bitfield, int bit, size_t bitfield_size) {
 #define LONG_SET_BIT(bitfield, bit) long_set_bit(bitfield, bit, \
         sizeof(bitfield)/sizeof(bitfield[0]))
 
+void long_clear_bit(unsigned long *bitfield, int bit, size_t bitfield_size) {
+    if (bit / BITS_PER_LONG >= bitfield_size)
+        return;
 
-/* receive hello and device caps, then process according to opt->caps - allow
- * only those set there, then adjust opt->caps to have only really supported
- * capabilities by remote end
- *
- * returns: -1 on error, 0 on EOF, 1 on success
- */
-int receive_and_validate_caps(struct options *opt) {
-    struct input_proxy_device_caps_msg untrusted_caps_msg;
-    struct input_proxy_hello untrusted_hello;
-    size_t caps_size, i;
-    int rc;
-
-    rc = read_all(0, &untrusted_hello, sizeof(untrusted_hello));
-    if (rc == 0)
-        return 0;
-    if (rc == -1) {
-        perror("read hello");
-        return -1;
-    }
-
-    if (untrusted_hello.version != INPUT_PROXY_PROTOCOL_VERSION) {
-        if (opt->log_level >= 1)
-            fprintf(stderr, "Incompatible remote protocol version: %d\n",
-                    untrusted_hello.version);
-        return -1;
-    }
+    bitfield[bit / BITS_PER_LONG] &= ~(1UL<<(bit & (BITS_PER_LONG-1)));
+}
+#define LONG_CLEAR_BIT(bitfield, bit) long_clear_bit(bitfield, bit, \
+        sizeof(bitfield)/sizeof(bitfield[0]))
 
-    caps_size = untrusted_hello.caps_size;
-    if (caps_size > sizeof(untrusted_caps_msg))
-        caps_size = sizeof(untrusted_caps_msg);
-    memset(&untrusted_caps_msg, 0, sizeof(untrusted_caps_msg));
 
-    rc = read_all(0, &untrusted_caps_msg, caps_size);
-    if (rc == 0)
-        return 0;
-    if (rc == -1) {
-        perror("read caps");
-        return -1;
-    }
-    if (untrusted_hello.caps_size > sizeof(untrusted_caps_msg)) {
-        /* discard the rest (if any); this will work, because we already
-         * checked protocol version - in case of not compatible protocol
-         * change, the version would be different */
-        size_t to_discard = untrusted_hello.caps_size - sizeof(untrusted_caps_msg);
-        char discard_buffer[128];
-        while (to_discard) {
-            if (to_discard < sizeof(discard_buffer))
-                rc = read_all(0, discard_buffer, to_discard);
-            else
-                rc = read_all(0, discard_buffer, sizeof(discard_buffer));
-            if (rc == 0)
-                return 0;
-            if (rc == -1) {
-                perror("discard caps");
-                return -1;
-            }
-            to_discard -= rc;
-        }
-    }
+/* process untrusted device caps according to opt->caps - allow only those set
+ * there, then set dev->caps to have only really supported capabilities by
+ * remote end
+ *
+ * returns: -1 on error, 1 on success
+ */
+int validate_caps(const struct options *opt, struct device *dev,
+        const struct input_proxy_device_caps_msg *untrusted_caps_msg) {
+    size_t i;
 
-    LONG_AND(opt->caps.propbit, untrusted_caps_msg.caps.propbit);
-    LONG_AND(opt->caps.evbit,   untrusted_caps_msg.caps.evbit);
+    dev->caps = opt->caps;
+    LONG_AND(dev->caps.propbit, untrusted_caps_msg->caps.propbit);
+    LONG_AND(dev->caps.evbit,   untrusted_caps_msg->caps.evbit);
 #define APPLY_BITS(_evflag, _field) \
-    if (LONG_TEST_BIT(opt->caps.evbit, _evflag)) \
-        LONG_AND(opt->caps._field, untrusted_caps_msg.caps._field); \
+    if (LONG_TEST_BIT(dev->caps.evbit, _evflag)) \
+        LONG_AND(dev->caps._field, untrusted_caps_msg->caps._field); \
     else \
-        memset(opt->caps._field, 0, sizeof(opt->caps._field));
+        memset(dev->caps._field, 0, sizeof(dev->caps._field));
 
     APPLY_BITS(EV_KEY, keybit);
     APPLY_BITS(EV_REL, relbit);
@@ -137,18 +239,20 @@ int receive_and_validate_caps(struct options *opt) {
 #undef APPLY_BITS
 
     /* use VM-provided name only if not already specified */
-    if (!opt->name && untrusted_caps_msg.name[0]) {
+    if (opt->name) {
+        dev->name = strdup(opt->name);
+    } else if (untrusted_caps_msg->name[0]) {
         unsigned i;
 
-        opt->name = calloc(1, sizeof(untrusted_caps_msg.name));
-        for (i = 0; i < sizeof(untrusted_caps_msg.name); i++) {
-            if (untrusted_caps_msg.name[i] == 0)
-                /* opt->name initially zero-ed, so no need to copy that \0 */
+        dev->name = calloc(1, sizeof(untrusted_caps_msg->name));
+        for (i = 0; i < sizeof(untrusted_caps_msg->name); i++) {
+            if (untrusted_caps_msg->name[i] == 0)
+                /* dev->name initially zero-ed, so no need to copy that \0 */
                 break;
             /* allow only ASCII, excluding control characters */
-            if (untrusted_caps_msg.name[i] >= 0x20 && 
-                    untrusted_caps_msg.name[i] < 0x7f)
-                opt->name[i] = untrusted_caps_msg.name[i];
+            if (untrusted_caps_msg->name[i] >= 0x20 && 
+                    untrusted_caps_msg->name[i] < 0x7f)
+                dev->name[i] = untrusted_caps_msg->name[i];
             else {
                 if (opt->log_level >= 1)
                     fprintf(stderr, "Invalid characters in device name\n");
@@ -156,35 +260,187 @@ int receive_and_validate_caps(struct options *opt) {
             }
         }
         /* make sure the name is terminated with \0 */
-        opt->name[sizeof(untrusted_caps_msg.name)-1] = 0;
+        dev->name[sizeof(untrusted_caps_msg->name)-1] = 0;
     }
+    if (!dev->name)
+        dev->name = strdup("Forwarded input device");
 
     /* copy input_absinfo for EV_ABS; if given info is missing, disable that
      * axis */
     for (i = 0; i < ABS_CNT; i++) {
-        if (LONG_TEST_BIT(opt->caps.absbit, i)) {
-            if (!untrusted_caps_msg.absinfo[i].minimum &&
-                    !untrusted_caps_msg.absinfo[i].maximum) {
+        if (LONG_TEST_BIT(dev->caps.absbit, i)) {
+            if (!untrusted_caps_msg->absinfo[i].minimum &&
+                    !untrusted_caps_msg->absinfo[i].maximum) {
                 /* no axis limits are provided, disable it */
-                opt->caps.absbit[i / BITS_PER_LONG] &= ~(1UL<<(i & (BITS_PER_LONG-1)));
+                dev->caps.absbit[i / BITS_PER_LONG] &= ~(1UL<<(i & (BITS_PER_LONG-1)));
                 continue;
             }
             /* here is place for some validation of axis data, if we come up
              * with any - in addition to those done by Linux kernel, and later
              * input driver */
-            opt->absinfo[i].value = untrusted_caps_msg.absinfo[i].value;
-            opt->absinfo[i].minimum = untrusted_caps_msg.absinfo[i].minimum;
-            opt->absinfo[i].maximum = untrusted_caps_msg.absinfo[i].maximum;
-            opt->absinfo[i].resolution =
-                untrusted_caps_msg.absinfo[i].resolution;
-            opt->absinfo[i].fuzz = untrusted_caps_msg.absinfo[i].fuzz;
-            opt->absinfo[i].flat = untrusted_caps_msg.absinfo[i].flat;
+            dev->absinfo[i].value = untrusted_caps_msg->absinfo[i].value;
+            dev->absinfo[i].minimum = untrusted_caps_msg->absinfo[i].minimum;
+            dev->absinfo[i].maximum = untrusted_caps_msg->absinfo[i].maximum;
+            dev->absinfo[i].resolution =
+                untrusted_caps_msg->absinfo[i].resolution;
+            dev->absinfo[i].fuzz = untrusted_caps_msg->absinfo[i].fuzz;
+            dev->absinfo[i].flat = untrusted_caps_msg->absinfo[i].flat;
         }
     }
 
     return 1;
 }
 
+/* convert absinfo of version 2 caps message (entries only for axes set in
+ * absbit) to the version 1 layout, in place; caps_size is how much of the
+ * message was received, the rest is zeroed */
+void expand_sparse_absinfo(struct input_proxy_device_caps_msg *untrusted_caps_msg,
+        size_t caps_size) {
+    struct input_absinfo absinfo[ABS_CNT];
+    size_t offset = offsetof(struct input_proxy_device_caps_msg, absinfo);
+    size_t count = 0, n = 0;
+    int i;
+
+    if (caps_size > offset)
+        count = (caps_size - offset) / sizeof(absinfo[0]);
+    memset(absinfo, 0, sizeof(absinfo));
+    for (i = 0; i < ABS_CNT && n < count; i++) {
+        if (LONG_TEST_BIT(untrusted_caps_msg->caps.absbit, i))
+            absinfo[i] = untrusted_caps_msg->absinfo[n++];
+    }
+    memcpy(untrusted_caps_msg->absinfo, absinfo, sizeof(absinfo));
+}
+
+/* protocol version to use with a sender, from the version in its hello and
+ * the one it proposed after the caps message (0 if none), see
+ * INPUT_PROXY_ANNOUNCE_CODE */
+int negotiate_version(uint32_t hello_version, uint32_t proposed) {
+    if (hello_version != 1 || proposed <= 1)
+        return hello_version;
+    if (proposed > INPUT_PROXY_PROTOCOL_VERSION)
+        return INPUT_PROXY_PROTOCOL_VERSION;
+    return proposed;
+}
+
+/* tell the remote end which protocol version we support, see
+ * INPUT_PROXY_ANNOUNCE_CODE */
+int send_announce(struct transport *remote) {
+    struct input_event ev = {
+        .type = EV_SYN,
+        .code = INPUT_PROXY_ANNOUNCE_CODE,
+        .value = INPUT_PROXY_PROTOCOL_VERSION,
+    };
+
+#ifndef FUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION
+    if (remote->write(remote, &ev, sizeof(ev)) == -1) {
+        perror("write announce");
+        return -1;
+    }
+#else
+    (void)remote;
+    (void)ev;
+#endif
+    return 0;
+}
+
+/* since protocol version 3, tell the remote end which capabilities were
+ * accepted */
+int send_negotiated_caps(struct device *dev) {
+    struct input_proxy_hello hello = {
+        .version = dev->version,
+        .caps_size = sizeof(dev->caps),
+    };
+
+    if (dev->version < 3)
+        return 0;
+#ifndef FUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION
+    if (dev->remote->write(dev->remote, &hello, sizeof(hello)) == -1 ||
+            dev->remote->write(dev->remote, &dev->caps,
+                sizeof(dev->caps)) == -1) {
+        perror("write negotiated caps");
+        return -1;
+    }
+#else
+    (void)hello;
+#endif
+    return 0;
+}
+
+/* receive hello and device caps, then validate them with validate_caps()
+ *
+ * returns: -1 on error, 0 on EOF, 1 on success
+ */
+int receive_and_validate_caps(const struct options *opt, struct device *dev) {
+    struct input_proxy_device_caps_msg untrusted_caps_msg;
+    struct input_proxy_version_proposal untrusted_proposal = { 0 };
+    struct input_proxy_hello untrusted_hello;
+    size_t caps_size, rest;
+    int rc;
+
+    rc = transport_read_all(dev->remote, &untrusted_hello,
+            sizeof(untrusted_hello));
+    if (rc == 0)
+        return 0;
+    if (rc == -1) {
+        perror("read hello");
+        return -1;
+    }
+
+    if (untrusted_hello.version < INPUT_PROXY_PROTOCOL_VERSION_MIN ||
+            untrusted_hello.version > INPUT_PROXY_PROTOCOL_VERSION) {
+        if (opt->log_level >= 1)
+            fprintf(stderr, "Incompatible remote protocol version: %d\n",
+                    untrusted_hello.version);
+        return -1;
+    }
+
+    caps_size = untrusted_hello.caps_size;
+    if (caps_size > sizeof(untrusted_caps_msg))
+        caps_size = sizeof(untrusted_caps_msg);
+    memset(&untrusted_caps_msg, 0, sizeof(untrusted_caps_msg));
+
+    rc = transport_read_all(dev->remote, &untrusted_caps_msg, caps_size);
+    if (rc == 0)
+        return 0;
+    if (rc == -1) {
+        perror("read caps");
+        return -1;
+    }
+    rest = 0;
+    if (untrusted_hello.caps_size > sizeof(untrusted_caps_msg))
+        rest = untrusted_hello.caps_size - sizeof(untrusted_caps_msg);
+    if (rest >= sizeof(untrusted_proposal)) {
+        rc = transport_read_all(dev->remote, &untrusted_proposal,
+                sizeof(untrusted_proposal));
+        if (rc == 0)
+            return 0;
+        if (rc == -1) {
+            perror("read version proposal");
+            return -1;
+        }
+        rest -= sizeof(untrusted_proposal);
+    }
+    if (rest) {
+        /* discard the rest (if any); this will work, because we already
+         * checked protocol version - in case of not compatible protocol
+         * change, the version would be different */
+        rc = transport_discard_all(dev->remote, rest);
+        if (rc == 0)
+            return 0;
+        if (rc == -1) {
+            perror("discard caps");
+            return -1;
+        }
+    }
+    dev->version = negotiate_version(untrusted_hello.version,
+            untrusted_proposal.version);
+
+    if (untrusted_hello.version >= 2)
+        expand_sparse_absinfo(&untrusted_caps_msg, caps_size);
+
+    return validate_caps(opt, dev, &untrusted_caps_msg);
+}
+
 int send_bits(int fd, int ioctl_num, unsigned long *bits, size_t bits_count) {
     size_t i;
 
@@ -220,47 +476,42 @@ int send_absinfo(int fd,
 }
 #endif
 
-int register_device(struct options *opt, int fd) {
+int register_device(const struct options *opt, struct device *dev) {
+    int fd = dev->uinput_fd;
 #if UINPUT_VERSION >= 5
     struct uinput_setup uinput_setup = { 0 };
 #endif
     struct uinput_user_dev uinput_dev = { 0 };
     int rc = 0;
-    char *domain_name = NULL;
 
     if (!rc)
-        rc = send_bits(fd, UI_SET_EVBIT, opt->caps.evbit, EV_CNT);
-    if (!rc && LONG_TEST_BIT(opt->caps.evbit, EV_KEY)) 
-        rc = send_bits(fd, UI_SET_KEYBIT, opt->caps.keybit, KEY_CNT);
-    if (!rc && LONG_TEST_BIT(opt->caps.evbit, EV_REL)) 
-        rc = send_bits(fd, UI_SET_RELBIT, opt->caps.relbit, REL_CNT);
-    if (!rc && LONG_TEST_BIT(opt->caps.evbit, EV_ABS)) 
-        rc = send_bits(fd, UI_SET_ABSBIT, opt->caps.absbit, ABS_CNT);
-    if (!rc && LONG_TEST_BIT(opt->caps.evbit, EV_MSC)) 
-        rc = send_bits(fd, UI_SET_MSCBIT, opt->caps.mscbit, MSC_CNT);
-    if (!rc && LONG_TEST_BIT(opt->caps.evbit, EV_LED)) 
-        rc = send_bits(fd, UI_SET_LEDBIT, opt->caps.ledbit, LED_CNT);
-    if (!rc && LONG_TEST_BIT(opt->caps.evbit, EV_SND)) 
-        rc = send_bits(fd, UI_SET_SNDBIT, opt->caps.sndbit, SND_CNT);
-    if (!rc && LONG_TEST_BIT(opt->caps.evbit, EV_FF)) 
-        rc = send_bits(fd, UI_SET_FFBIT, opt->caps.ffbit, FF_CNT);
-    if (!rc && LONG_TEST_BIT(opt->caps.evbit, EV_SW)) 
-        rc = send_bits(fd, UI_SET_SWBIT, opt->caps.swbit, SW_CNT);
-    if (rc == -1) {
-        close(fd);
+        rc = send_bits(fd, UI_SET_EVBIT, dev->caps.evbit, EV_CNT);
+    if (!rc && LONG_TEST_BIT(dev->caps.evbit, EV_KEY)) 
+        rc = send_bits(fd, UI_SET_KEYBIT, dev->caps.keybit, KEY_CNT);
+    if (!rc && LONG_TEST_BIT(dev->caps.evbit, EV_REL)) 
+        rc = send_bits(fd, UI_SET_RELBIT, dev->caps.relbit, REL_CNT);
+    if (!rc && LONG_TEST_BIT(dev->caps.evbit, EV_ABS)) 
+        rc = send_bits(fd, UI_SET_ABSBIT, dev->caps.absbit, ABS_CNT);
+    if (!rc && LONG_TEST_BIT(dev->caps.evbit, EV_MSC)) 
+        rc = send_bits(fd, UI_SET_MSCBIT, dev->caps.mscbit, MSC_CNT);
+    if (!rc && LONG_TEST_BIT(dev->caps.evbit, EV_LED)) 
+        rc = send_bits(fd, UI_SET_LEDBIT, dev->caps.ledbit, LED_CNT);
+    if (!rc && LONG_TEST_BIT(dev->caps.evbit, EV_SND)) 
+        rc = send_bits(fd, UI_SET_SNDBIT, dev->caps.sndbit, SND_CNT);
+    if (!rc && LONG_TEST_BIT(dev->caps.evbit, EV_FF)) 
+        rc = send_bits(fd, UI_SET_FFBIT, dev->caps.ffbit, FF_CNT);
+    if (!rc && LONG_TEST_BIT(dev->caps.evbit, EV_SW)) 
+        rc = send_bits(fd, UI_SET_SWBIT, dev->caps.swbit, SW_CNT);
+    if (rc == -1)
         return -1;
-    }
 
-    if (!opt->name)
-        opt->name = strdup("Forwarded input device");
-    domain_name = getenv("QREXEC_REMOTE_DOMAIN");
-    if (domain_name) {
+    if (dev->domain) {
         snprintf(uinput_dev.name, UINPUT_MAX_NAME_SIZE, "%s: %s",
-                domain_name, opt->name);
+                dev->domain, dev->name);
         /* make sure string is terminated, in case it was truncated */
         uinput_dev.name[UINPUT_MAX_NAME_SIZE-1] = 0;
     } else {
-        strncpy(uinput_dev.name, opt->name, UINPUT_MAX_NAME_SIZE - 1);
+        strncpy(uinput_dev.name, dev->name, UINPUT_MAX_NAME_SIZE - 1);
     }
 
     uinput_dev.id.bustype = BUS_USB;
@@ -281,13 +532,13 @@ int register_device(struct options *opt, int fd) {
         size_t i;
 
         /* fallback to old uinput_user_dev method */
-        if (LONG_TEST_BIT(opt->caps.evbit, EV_ABS)) {
+        if (LONG_TEST_BIT(dev->caps.evbit, EV_ABS)) {
             for (i = 0; i < ABS_CNT; i++) {
-                if (LONG_TEST_BIT(opt->caps.absbit, i)) {
-                    uinput_dev.absmax[i] = opt->absinfo[i].maximum;
-                    uinput_dev.absmin[i] = opt->absinfo[i].minimum;
-                    uinput_dev.absfuzz[i] = opt->absinfo[i].fuzz;
-                    uinput_dev.absflat[i] = opt->absinfo[i].flat;
+                if (LONG_TEST_BIT(dev->caps.absbit, i)) {
+                    uinput_dev.absmax[i] = dev->absinfo[i].maximum;
+                    uinput_dev.absmin[i] = dev->absinfo[i].minimum;
+                    uinput_dev.absfuzz[i] = dev->absinfo[i].fuzz;
+                    uinput_dev.absflat[i] = dev->absinfo[i].flat;
                 }
             }
         }
@@ -297,8 +548,8 @@ int register_device(struct options *opt, int fd) {
 #if UINPUT_VERSION >= 5
     } else {
         /* new method worked, send absinfo using new method */
-        if (!rc && LONG_TEST_BIT(opt->caps.evbit, EV_ABS))
-            rc = send_absinfo(fd, opt->caps.absbit, opt->absinfo);
+        if (!rc && LONG_TEST_BIT(dev->caps.evbit, EV_ABS))
+            rc = send_absinfo(fd, dev->caps.absbit, dev->absinfo);
         if (rc == -1)
             return -1;
     }
@@ -310,164 +561,1297 @@ int register_device(struct options *opt, int fd) {
     return 0;
 }
 
-int validate_and_forward_event(struct options *opt, int src, int dst) {
-    struct input_event untrusted_event;
-    struct input_event ev = { 0 };
-    int rc;
-
-    rc = read_all(src, &untrusted_event, sizeof(untrusted_event));
-    if (rc == 0)
-        return 0;
-    if (rc == -1) {
-        perror("read event");
-        return -1;
-    }
-    /* ignore untrusted_event.time */;
+/* validate a single untrusted event according to dev->caps and store the
+ * sanitized version in *ev
+ *
+ * returns: -1 on invalid event, 0 if the event should be ignored, 1 if it
+ * should be forwarded
+ */
+int validate_event(const struct options *opt, const struct device *dev,
+        const struct input_event *untrusted_event,
+        struct input_event *ev) {
+    memset(ev, 0, sizeof(*ev));
+    /* ignore untrusted_event->time */;
 
-    if (LONG_TEST_BIT(opt->caps.evbit, untrusted_event.type) == 0)
-        return 1; /* ignore unsupported/disabled events */
-    ev.type = untrusted_event.type;
-    switch (ev.type) {
+    if (LONG_TEST_BIT(dev->caps.evbit, untrusted_event->type) == 0)
+        return 0; /* ignore unsupported/disabled events */
+    ev->type = untrusted_event->type;
+    switch (ev->type) {
         case EV_SYN:
-            if (untrusted_event.code > SYN_MAX)
+            if (untrusted_event->code > SYN_MAX)
                 return -1;
-            ev.code = untrusted_event.code;
-            ev.value = 0;
+            ev->code = untrusted_event->code;
+            ev->value = 0;
             break;
         case EV_KEY:
-            if (LONG_TEST_BIT(opt->caps.keybit, untrusted_event.code) == 0) {
-                if (opt->log_level >= 2)
-                    fprintf(stderr, "Ignoring event EV_KEY code %#x value %#x\n",
-                            untrusted_event.code, untrusted_event.value);
-                return 1; /* ignore unsupported/disabled key */
-            }
-            ev.code = untrusted_event.code;
-            /* XXX values: 0: release, 1: press, 2: repeat */
-            ev.value = untrusted_event.value;
+            if (LONG_TEST_BIT(dev->caps.keybit, untrusted_event->code) == 0)
+                return 0; /* ignore unsupported/disabled key */
+            /* values: 0: release, 1: press, 2: repeat; with EV_REP (see
+             * --autorepeat), the kernel generates repeats here */
+            if (untrusted_event->value == 2 &&
+                    LONG_TEST_BIT(dev->caps.evbit, EV_REP))
+                return 0;
+            ev->code = untrusted_event->code;
+            ev->value = untrusted_event->value;
             break;
         case EV_REL:
-            if (LONG_TEST_BIT(opt->caps.relbit, untrusted_event.code) == 0) {
-                if (opt->log_level >= 2)
-                    fprintf(stderr, "Ignoring event EV_REL code %#x value %#x\n",
-                            untrusted_event.code, untrusted_event.value);
-                return 1; /* ignore unsupported/disabled axis */
-            }
-            ev.code = untrusted_event.code;
-            ev.value = untrusted_event.value;
+            if (LONG_TEST_BIT(dev->caps.relbit, untrusted_event->code) == 0)
+                return 0; /* ignore unsupported/disabled axis */
+            ev->code = untrusted_event->code;
+            ev->value = untrusted_event->value;
             break;
         case EV_ABS:
-            if (LONG_TEST_BIT(opt->caps.absbit, untrusted_event.code) == 0) {
-                if (opt->log_level >= 2)
-                    fprintf(stderr, "Ignoring event EV_ABS code %#x value %#x\n",
-                            untrusted_event.code, untrusted_event.value);
-                return 1; /* ignore unsupported/disabled axis */
-            }
-            ev.code = untrusted_event.code;
-            ev.value = untrusted_event.value;
+            if (LONG_TEST_BIT(dev->caps.absbit, untrusted_event->code) == 0)
+                return 0; /* ignore unsupported/disabled axis */
+            ev->code = untrusted_event->code;
+            ev->value = untrusted_event->value;
             break;
         case EV_MSC:
-            if (LONG_TEST_BIT(opt->caps.mscbit, untrusted_event.code) == 0) {
-                if (opt->log_level >= 2)
-                    fprintf(stderr, "Ignoring event EV_MSC code %#x value %#x\n",
-                            untrusted_event.code, untrusted_event.value);
-                return 1; /* ignore unsupported/disabled */
-            }
-            ev.code = untrusted_event.code;
-            ev.value = untrusted_event.value;
+            if (LONG_TEST_BIT(dev->caps.mscbit, untrusted_event->code) == 0)
+                return 0; /* ignore unsupported/disabled */
+            ev->code = untrusted_event->code;
+            ev->value = untrusted_event->value;
             break;
         case EV_SW:
-            if (LONG_TEST_BIT(opt->caps.swbit, untrusted_event.code) == 0) {
-                if (opt->log_level >= 2)
-                    fprintf(stderr, "Ignoring event EV_SW code %#x value %#x\n",
-                            untrusted_event.code, untrusted_event.value);
-                return 1; /* ignore unsupported/disabled */
-            }
-            ev.code = untrusted_event.code;
-            ev.value = untrusted_event.value;
+            if (LONG_TEST_BIT(dev->caps.swbit, untrusted_event->code) == 0)
+                return 0; /* ignore unsupported/disabled */
+            ev->code = untrusted_event->code;
+            ev->value = untrusted_event->value;
             break;
         case EV_LED:
-            if (LONG_TEST_BIT(opt->caps.ledbit, untrusted_event.code) == 0) {
-                if (opt->log_level >= 2)
-                    fprintf(stderr, "Ignoring event EV_LED code %#x value %#x\n",
-                            untrusted_event.code, untrusted_event.value);
-                return 1; /* ignore unsupported/disabled */
-            }
-            ev.code = untrusted_event.code;
-            ev.value = untrusted_event.value;
+            if (LONG_TEST_BIT(dev->caps.ledbit, untrusted_event->code) == 0)
+                return 0; /* ignore unsupported/disabled */
+            ev->code = untrusted_event->code;
+            ev->value = untrusted_event->value;
             break;
         case EV_SND:
-            if (LONG_TEST_BIT(opt->caps.sndbit, untrusted_event.code) == 0) {
-                if (opt->log_level >= 2)
-                    fprintf(stderr, "Ignoring event EV_SND code %#x value %#x\n",
-                            untrusted_event.code, untrusted_event.value);
-                return 1; /* ignore unsupported/disabled */
-            }
-            ev.code = untrusted_event.code;
-            ev.value = untrusted_event.value;
+            if (LONG_TEST_BIT(dev->caps.sndbit, untrusted_event->code) == 0)
+                return 0; /* ignore unsupported/disabled */
+            ev->code = untrusted_event->code;
+            ev->value = untrusted_event->value;
             break;
         case EV_REP:
+            /* repeat delay and period of the source device */
+            if (untrusted_event->code > REP_MAX ||
+                    untrusted_event->value < 0 ||
+                    untrusted_event->value > REP_VALUE_MAX)
+                return 0;
+            ev->code = untrusted_event->code;
+            ev->value = untrusted_event->value;
+            break;
         case EV_FF:
         case EV_PWR:
         default:
             if (opt->log_level >= 1)
-                fprintf(stderr, "Unsupported event type %d\n", ev.type);
+                fprintf(stderr, "Unsupported event type %d\n", ev->type);
             return -1;
     }
 
+    return 1;
+}
+
+static const char *const event_type_names[EV_CNT] = {
+    [EV_SYN] = "EV_SYN",
+    [EV_KEY] = "EV_KEY",
+    [EV_REL] = "EV_REL",
+    [EV_ABS] = "EV_ABS",
+    [EV_MSC] = "EV_MSC",
+    [EV_SW] = "EV_SW",
+    [EV_LED] = "EV_LED",
+    [EV_SND] = "EV_SND",
+    [EV_REP] = "EV_REP",
+    [EV_FF] = "EV_FF",
+    [EV_PWR] = "EV_PWR",
+    [EV_FF_STATUS] = "EV_FF_STATUS",
+};
+
+/* count an event ignored by validate_event(), for the next summary */
+void record_dropped(const struct options *opt, struct device *dev,
+        const struct input_event *untrusted_event,
+        const struct timespec *now) {
+    struct drop_log *log = &dev->drop_log;
+    int i;
+
+    if (opt->log_level < 1)
+        return;
+    /* with --autorepeat these are dropped on purpose */
+    if (untrusted_event->type == EV_KEY && untrusted_event->value == 2 &&
+            LONG_TEST_BIT(dev->caps.evbit, EV_REP))
+        return;
+    if (!log->total) {
+        log->due = *now;
+        log->due.tv_sec += opt->drop_log_interval;
+    }
+    log->total++;
+    if (untrusted_event->type < EV_CNT)
+        log->types[untrusted_event->type]++;
+    /* event codes (like which keys) are sensitive */
+    if (opt->log_level < 2)
+        return;
+    for (i = 0; i < log->codes_count; i++) {
+        if (log->codes[i].type == untrusted_event->type &&
+                log->codes[i].code == untrusted_event->code) {
+            log->codes[i].count++;
+            return;
+        }
+    }
+    if (log->codes_count < DROP_LOG_CODES) {
+        log->codes[log->codes_count].type = untrusted_event->type;
+        log->codes[log->codes_count].code = untrusted_event->code;
+        log->codes[log->codes_count].count = 1;
+        log->codes_count++;
+    }
+}
+
+/* how long until the summary of ignored events is due, in milliseconds; -1 if
+ * there is nothing to log */
+int drop_log_timeout(const struct device *dev, const struct timespec *now) {
+    long long timeout;
+
+    if (!dev->drop_log.total)
+        return -1;
+    timeout = (dev->drop_log.due.tv_sec - now->tv_sec) * 1000LL +
+        (dev->drop_log.due.tv_nsec - now->tv_nsec) / 1000000;
+    if (timeout < 0)
+        return 0;
+    return timeout;
+}
+
+static void append_text(char *buf, size_t size, size_t *len,
+        const char *fmt, ...) {
+    va_list ap;
+    int rc;
+
+    if (*len >= size)
+        return;
+    va_start(ap, fmt);
+    rc = vsnprintf(buf + *len, size - *len, fmt, ap);
+    va_end(ap);
+    if (rc > 0)
+        *len += rc;
+}
+
+static void append_type_name(char *buf, size_t size, size_t *len, int type) {
+    if (type < EV_CNT && event_type_names[type])
+        append_text(buf, size, len, " %s", event_type_names[type]);
+    else
+        append_text(buf, size, len, " %#x", type);
+}
+
+/* log the summary of ignored events, as a single line, and start counting
+ * again */
+void log_dropped_events(const struct options *opt, struct device *dev) {
+    struct drop_log *log = &dev->drop_log;
+    unsigned long listed = 0;
+    char buf[1024];
+    size_t len = 0;
+    int i;
+
+    if (!log->total)
+        return;
+    append_text(buf, sizeof(buf), &len, "Ignored %lu events of '%s' from %s:",
+            log->total,
+            dev->name ? dev->name : "(unknown)",
+            dev->domain ? dev->domain : "(unknown)");
+    if (opt->log_level >= 2) {
+        for (i = 0; i < log->codes_count; i++) {
+            append_type_name(buf, sizeof(buf), &len, log->codes[i].type);
+            append_text(buf, sizeof(buf), &len, " 0x%x: %lu",
+                    log->codes[i].code, log->codes[i].count);
+            listed += log->codes[i].count;
+        }
+    } else {
+        for (i = 0; i < EV_CNT; i++) {
+            if (!log->types[i])
+                continue;
+            append_type_name(buf, sizeof(buf), &len, i);
+            append_text(buf, sizeof(buf), &len, ": %lu", log->types[i]);
+            listed += log->types[i];
+        }
+    }
+    if (listed < log->total)
+        append_text(buf, sizeof(buf), &len, " other: %lu",
+                log->total - listed);
+    fprintf(stderr, "%s\n", buf);
+    memset(log, 0, sizeof(*log));
+}
+
+void log_dropped_events_if_due(const struct options *opt, struct device *dev) {
+    struct timespec now;
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    if (drop_log_timeout(dev, &now) == 0)
+        log_dropped_events(opt, dev);
+}
+
+int validate_and_forward_event(const struct options *opt, struct device *dev,
+        int src, struct transport *dst) {
+    struct input_event untrusted_event;
+    struct input_event ev;
+    struct timespec now;
+    int rc;
+
+    rc = read_all(src, &untrusted_event, sizeof(untrusted_event));
+    if (rc == 0)
+        return 0;
+    if (rc == -1) {
+        perror("read event");
+        return -1;
+    }
+
+    rc = validate_event(opt, dev, &untrusted_event, &ev);
+    if (rc == -1)
+        return -1;
+    if (rc == 0) {
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        record_dropped(opt, dev, &untrusted_event, &now);
+        return 1; /* ignored */
+    }
+    /* repeat settings changed here apply only to the local device */
+    if (ev.type == EV_REP)
+        return 1;
+
 #ifndef FUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION
-    rc = write_all(dst, &ev, sizeof(ev));
+    rc = dst->write(dst, &ev, sizeof(ev));
     if (rc == -1)
         perror("write event");
 #else
+    (void)dst;
     rc = sizeof(ev);
 #endif
     return rc;
 }
 
-int process_events(struct options *opt, int fd) {
-    struct pollfd fds[] = {
-        { .fd = 0,  .events = POLLIN, .revents = 0, },
-#ifndef FUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION
-        { .fd = fd, .events = POLLIN, .revents = 0, }
-#endif
-    };
-    int rc = 0;
+/* write complete frames (up to the last SYN_REPORT) from the buffer with a
+ * single write, keep the rest for later; if the buffer is full, write
+ * everything
+ *
+ * returns: -1 on error, >0 on success
+ */
+int flush_frames(int fd, struct event_buffer *buf, struct stats *stats) {
+    size_t count, send_count;
+    int rc;
+
+    count = buf->len / sizeof(buf->ev[0]);
+    send_count = complete_frames(buf->ev, count);
+    if (!send_count && count == EVENT_BUFFER_SIZE)
+        send_count = count;
+    if (!send_count)
+        return 1;
 
-    while ((rc=poll(fds, sizeof(fds)/sizeof(fds[0]), -1)) > 0) {
-        if (fds[0].revents) {
-            rc = validate_and_forward_event(opt, 0, fd);
-            if (rc <= 0)
-                return rc;
-        }
 #ifndef FUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION
-        if (fds[1].revents) {
-            rc = validate_and_forward_event(opt, fd, 1);
-            if (rc <= 0)
-                return rc;
-        }
-#endif
-    }
+    rc = write_all(fd, buf->ev, send_count * sizeof(buf->ev[0]));
     if (rc == -1) {
-        perror("poll");
+        perror("write event");
         return -1;
     }
-    return 0;
+#else
+    (void)fd;
+    rc = send_count * sizeof(buf->ev[0]);
+#endif
+    stats_record_written(stats, buf->ev, send_count);
+    buf->len -= send_count * sizeof(buf->ev[0]);
+    memmove(buf->ev, buf->ev + send_count, buf->len);
+    return rc;
 }
 
-void usage() {
-    fprintf(stderr, "Usage: input-proxy-receiver [options...]\n");
-    fprintf(stderr, "       --mouse, -m - allow remote device act as mouse\n");
-    fprintf(stderr, "    --keyboard, -k - allow remote device act as keyboard\n");
-    fprintf(stderr, "      --tablet, -t - allow remote device act as tablet\n");
+void coalesce_output(const struct options *opt, struct device *dev) {
+    unsigned long merged = dev->merged;
+
+    coalesce_event_buffer(&dev->out, &dev->merged);
+    if (opt->stats)
+        opt->stats->merged += dev->merged - merged;
+}
+
+/* add an event to dev->out, write out the frames if it gets full
+ *
+ * returns: -1 on error, >0 on success
+ */
+int append_output(const struct options *opt, struct device *dev,
+        const struct input_event *ev) {
+    struct event_buffer *out = &dev->out;
+
+    out->ev[out->len / sizeof(out->ev[0])] = *ev;
+    out->len += sizeof(out->ev[0]);
+    if (out->len < sizeof(out->ev))
+        return 1;
+    if (opt->coalesce)
+        coalesce_output(opt, dev);
+    return flush_frames(dev->uinput_fd, out, opt->stats);
+}
+
+/* which rate limit applies to the event, -1 if none; key releases are never
+ * limited, so that nothing stays pressed */
+int rate_class(const struct input_event *ev) {
+    switch (ev->type) {
+        case EV_REL:
+            return RATE_MOTION;
+        case EV_ABS:
+            return RATE_ABS;
+        case EV_KEY:
+            if (ev->value == 0)
+                return -1;
+            return RATE_KEYS;
+        case EV_MSC:
+        case EV_LED:
+        case EV_SND:
+        case EV_SW:
+        case EV_REP:
+            return RATE_KEYS;
+    }
+    return -1;
+}
+
+int is_held(const struct device *dev, const struct input_event *ev) {
+    if (ev->type == EV_REL)
+        return LONG_TEST_BIT(dev->held_relbit, ev->code);
+    if (ev->type == EV_ABS)
+        return LONG_TEST_BIT(dev->held_absbit, ev->code);
+    return 0;
+}
+
+/* hold back an event above the rate limit - sum up relative motion, keep the
+ * latest absolute position; multi-touch axes never get here, see
+ * rate_limit_event()
+ *
+ * returns: 1 if held, 0 if the event can't be held
+ */
+int hold_event(struct device *dev, const struct input_event *ev) {
+    long long sum;
+
+    if (is_coalescable_rel(ev)) {
+        sum = ev->value;
+        if (LONG_TEST_BIT(dev->held_relbit, ev->code))
+            sum += dev->held_rel[ev->code];
+        if (sum > INT32_MAX)
+            sum = INT32_MAX;
+        if (sum < INT32_MIN)
+            sum = INT32_MIN;
+        dev->held_rel[ev->code] = sum;
+        LONG_SET_BIT(dev->held_relbit, ev->code);
+        dev->held[RATE_MOTION] = 1;
+        return 1;
+    }
+    if (ev->type == EV_ABS) {
+        dev->held_abs[ev->code] = ev->value;
+        LONG_SET_BIT(dev->held_absbit, ev->code);
+        dev->held[RATE_ABS] = 1;
+        return 1;
+    }
+    return 0;
+}
+
+/* apply the rate limit to a validated event
+ *
+ * returns: -1 if the device should be disconnected, 0 if the event was
+ * dropped or held back, 1 if it should be forwarded
+ */
+int rate_limit_event(const struct options *opt, struct device *dev,
+        const struct input_event *ev, const struct timespec *now) {
+    int class = rate_class(ev);
+
+    if (class == -1 || !opt->rate_limit[class])
+        return 1;
+    /* multi-touch axes count against the limit, but are always forwarded:
+     * without ABS_MT_SLOT the following axes would go to another contact,
+     * without ABS_MT_TRACKING_ID -1 a contact would stay down */
+    if (ev->type == EV_ABS && ev->code >= ABS_MT_SLOT) {
+        token_bucket_take(&dev->rate[class], now);
+        return 1;
+    }
+    /* an axis already held back is merged into, to keep the order */
+    if (!is_held(dev, ev) && token_bucket_take(&dev->rate[class], now))
+        return 1;
+
+    switch (opt->rate_limit_action) {
+        case RATE_ACTION_DISCONNECT:
+            if (opt->log_level >= 1)
+                fprintf(stderr, "Device '%s' exceeded the rate limit, "
+                        "disconnecting\n", dev->name);
+            return -1;
+        case RATE_ACTION_COALESCE:
+            if (hold_event(dev, ev))
+                return 0;
+            break;
+        case RATE_ACTION_DROP:
+            break;
+    }
+    dev->rate_limited++;
+    stats_record_dropped(opt->stats, ev);
+    return 0;
+}
+
+/* forward events held back by rate_limit_event(), as far as the limit allows
+ * now; they are added to the current frame
+ *
+ * returns: -1 on error, >0 on success
+ */
+int release_held_events(const struct options *opt, struct device *dev,
+        const struct timespec *now) {
+    struct input_event ev = { 0 };
+    int i;
+
+    if (dev->held[RATE_MOTION]) {
+        ev.type = EV_REL;
+        for (i = 0; i < REL_CNT; i++) {
+            if (!LONG_TEST_BIT(dev->held_relbit, i))
+                continue;
+            if (!token_bucket_take(&dev->rate[RATE_MOTION], now))
+                break;
+            LONG_CLEAR_BIT(dev->held_relbit, i);
+            ev.code = i;
+            ev.value = dev->held_rel[i];
+            if (append_output(opt, dev, &ev) == -1)
+                return -1;
+        }
+        dev->held[RATE_MOTION] = (i < REL_CNT);
+    }
+    if (dev->held[RATE_ABS]) {
+        ev.type = EV_ABS;
+        for (i = 0; i < ABS_CNT; i++) {
+            if (!LONG_TEST_BIT(dev->held_absbit, i))
+                continue;
+            if (!token_bucket_take(&dev->rate[RATE_ABS], now))
+                break;
+            LONG_CLEAR_BIT(dev->held_absbit, i);
+            ev.code = i;
+            ev.value = dev->held_abs[i];
+            if (append_output(opt, dev, &ev) == -1)
+                return -1;
+        }
+        dev->held[RATE_ABS] = (i < ABS_CNT);
+    }
+    return 1;
+}
+
+/* combine poll() timeouts, -1 meaning infinite */
+int min_timeout(int a, int b) {
+    if (a == -1)
+        return b;
+    if (b == -1)
+        return a;
+    return a < b ? a : b;
+}
+
+/* how long until held events can be forwarded, in milliseconds; -1 if there
+ * are none, or a frame is in progress - then they go with it */
+int held_timeout(const struct device *dev, const struct timespec *now) {
+    int timeout = -1;
+    int class;
+
+    if (dev->out.len)
+        return -1;
+    for (class = 0; class < RATE_CLASS_COUNT; class++) {
+        if (dev->held[class])
+            timeout = min_timeout(timeout,
+                    token_bucket_delay(&dev->rate[class], now));
+    }
+    return timeout;
+}
+
+/* forward held events in a frame of their own, when there is no other frame
+ * to add them to; see held_timeout()
+ *
+ * returns: -1 on error, >0 on success
+ */
+int flush_held_events(const struct options *opt, struct device *dev) {
+    struct input_event syn = { .type = EV_SYN, .code = SYN_REPORT };
+    struct timespec now;
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    if (held_timeout(dev, &now) != 0)
+        return 1;
+    if (release_held_events(opt, dev, &now) == -1)
+        return -1;
+    if (!dev->out.len)
+        return 1;
+    if (opt->stats) {
+        clock_gettime(CLOCK_REALTIME, &now);
+        syn.input_event_sec = now.tv_sec;
+        syn.input_event_usec = now.tv_nsec / 1000;
+    }
+    if (append_output(opt, dev, &syn) == -1)
+        return -1;
+    return flush_frames(dev->uinput_fd, &dev->out, opt->stats);
+}
+
+/* validate all the events buffered in dev->in and forward complete frames to
+ * uinput, with a single write
+ *
+ * returns: -1 on error, >0 on success
+ */
+int process_buffered_events(const struct options *opt, struct device *dev) {
+    struct event_buffer *in = &dev->in;
+    struct event_buffer *out = &dev->out;
+    struct input_event *untrusted_event;
+    struct input_event ev;
+    struct timespec now;
+    size_t count, i;
+    int rc;
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    count = in->len / sizeof(in->ev[0]);
+    for (i = 0; i < count; i++) {
+        untrusted_event = &in->ev[i];
+        rc = validate_event(opt, dev, untrusted_event, &ev);
+        if (rc == -1)
+            return -1;
+        if (rc == 0) {
+            stats_record_dropped(opt->stats, untrusted_event);
+            record_dropped(opt, dev, untrusted_event, &now);
+            continue;
+        }
+        rc = rate_limit_event(opt, dev, &ev, &now);
+        if (rc == -1)
+            return -1;
+        if (rc == 0)
+            continue;
+        if (ev.type == EV_SYN && ev.code == SYN_REPORT &&
+                release_held_events(opt, dev, &now) == -1)
+            return -1;
+        if (ev.type == EV_KEY) {
+            if (ev.value)
+                LONG_SET_BIT(dev->keys_down, ev.code);
+            else
+                LONG_CLEAR_BIT(dev->keys_down, ev.code);
+        }
+        if (opt->stats) {
+            /* used only for latency stats, uinput ignores it anyway */
+            ev.input_event_sec = untrusted_event->input_event_sec;
+            ev.input_event_usec = untrusted_event->input_event_usec;
+        }
+        if (append_output(opt, dev, &ev) == -1)
+            return -1;
+    }
+    /* keep partial event, if any */
+    in->len -= count * sizeof(in->ev[0]);
+    memmove(in->ev, in->ev + count, in->len);
+
+    if (opt->coalesce)
+        coalesce_output(opt, dev);
+    return flush_frames(dev->uinput_fd, out, opt->stats);
+}
+
+/* read whatever is available from the remote end, validate all of it and
+ * forward complete frames
+ *
+ * returns: -1 on error, 0 on EOF, >0 on success
+ */
+int validate_and_forward_events(const struct options *opt, struct device *dev) {
+    struct event_buffer *in = &dev->in;
+    int rc;
+
+    rc = dev->remote->read(dev->remote, (char *)in->ev + in->len,
+            sizeof(in->ev) - in->len);
+    if (rc == 0)
+        return 0;
+    if (rc == -1 && errno == EAGAIN)
+        return 1;
+    if (rc == -1) {
+        perror("read event");
+        return -1;
+    }
+    in->len += rc;
+
+    rc = process_buffered_events(opt, dev);
+    stats_record_wakeup(opt->stats);
+    return rc;
+}
+
+struct device *device_new(int in_fd, int out_fd) {
+    struct device *dev;
+
+    dev = calloc(1, sizeof(*dev));
+    if (!dev) {
+        perror("calloc");
+        return NULL;
+    }
+    dev->in_fd = in_fd;
+    dev->out_fd = out_fd;
+    dev->remote = transport_fd(in_fd, out_fd);
+    if (!dev->remote) {
+        free(dev);
+        return NULL;
+    }
+    dev->uinput_fd = -1;
+    dev->stream_src.dev = dev;
+    dev->stream_src.fd = in_fd;
+    dev->uinput_src.dev = dev;
+    return dev;
+}
+
+void device_free(const struct options *opt, struct device *dev) {
+    log_dropped_events(opt, dev);
+    if (dev->merged && opt->log_level >= 1)
+        fprintf(stderr, "Merged %lu relative motion events of '%s'\n",
+                dev->merged, dev->name);
+    if (dev->rate_limited && opt->log_level >= 1)
+        fprintf(stderr, "Dropped %lu events of '%s' above the rate limit\n",
+                dev->rate_limited, dev->name);
+    if (dev->uinput_fd != -1 && dev->uinput_fd != dev->out_fd)
+        close(dev->uinput_fd);
+    if (dev->owns_fds) {
+        if (dev->out_fd != dev->in_fd)
+            close(dev->out_fd);
+        close(dev->in_fd);
+    }
+    if (dev->remote)
+        dev->remote->close(dev->remote);
+    free(dev->handshake);
+    free(dev->domain);
+    free(dev->name);
+    free(dev);
+}
+
+/* called when forwarding starts */
+void init_rate_limits(const struct options *opt, struct device *dev) {
+    int class;
+
+    for (class = 0; class < RATE_CLASS_COUNT; class++)
+        token_bucket_init(&dev->rate[class], opt->rate_limit[class],
+                opt->rate_limit[class]);
+}
+
+/* create uinput device according to already negotiated dev->caps */
+int open_uinput_device(const struct options *opt, struct device *dev) {
+    init_rate_limits(opt, dev);
+#ifdef FUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION
+    (void)opt;
+    dev->uinput_fd = 1;
+#else
+    dev->uinput_fd = open(UINPUT_DEVICE, O_RDWR | O_CLOEXEC);
+    if (dev->uinput_fd == -1) {
+        perror("open " UINPUT_DEVICE);
+        return -1;
+    }
+
+    if (register_device(opt, dev) == -1)
+        return -1;
+#endif
+    return 0;
+}
+
+/* standalone mode - single device connected to stdin/stdout (or another
+ * transport) */
+int process_events(const struct options *opt, struct device *dev) {
+    struct pollfd fds[] = {
+        { .fd = dev->remote->poll_fd, .events = POLLIN, .revents = 0, },
+#ifndef FUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION
+        { .fd = dev->uinput_fd, .events = POLLIN, .revents = 0, }
+#endif
+    };
+    struct timespec now;
+    int timeout;
+    int rc = 0;
+
+    for (;;) {
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        timeout = min_timeout(stats_timeout(opt->stats),
+                held_timeout(dev, &now));
+        timeout = min_timeout(timeout, drop_log_timeout(dev, &now));
+        rc = poll(fds, sizeof(fds)/sizeof(fds[0]), timeout);
+        if (rc == -1)
+            break;
+        if (fds[0].revents) {
+            rc = validate_and_forward_events(opt, dev);
+            if (rc <= 0)
+                return rc;
+        }
+#ifndef FUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION
+        if (fds[1].revents) {
+            rc = validate_and_forward_event(opt, dev,
+                    dev->uinput_fd, dev->remote);
+            if (rc <= 0)
+                return rc;
+        }
+#endif
+        if (flush_held_events(opt, dev) == -1)
+            return -1;
+        log_dropped_events_if_due(opt, dev);
+        stats_dump_if_due(opt->stats);
+    }
+    perror("poll");
+    return -1;
+}
+
+/* daemon mode - serve many connections of a socket-based qrexec service in a
+ * single process; each connection starts with qrexec service descriptor
+ * ("service+arg source-domain\0"), followed by the usual hello and caps */
+
+/* take the source domain name from the service descriptor */
+int parse_service_descriptor(struct device *dev) {
+    const char *domain;
+    size_t i;
+
+    domain = strrchr(dev->handshake->descriptor, ' ');
+    if (!domain || !domain[1]) {
+        fprintf(stderr, "Invalid service descriptor\n");
+        return -1;
+    }
+    domain++;
+    for (i = 0; domain[i]; i++) {
+        if (!((domain[i] >= 'a' && domain[i] <= 'z') ||
+                    (domain[i] >= 'A' && domain[i] <= 'Z') ||
+                    (domain[i] >= '0' && domain[i] <= '9') ||
+                    domain[i] == '-' || domain[i] == '_' ||
+                    domain[i] == '.')) {
+            fprintf(stderr, "Invalid source domain name\n");
+            return -1;
+        }
+    }
+    dev->domain = strdup(domain);
+    if (!dev->domain) {
+        perror("strdup");
+        return -1;
+    }
+    return 0;
+}
+
+/* copy the part of n bytes of data (at data_offset in the stream) that
+ * overlaps field (at field_offset in the stream) */
+void copy_overlap(void *field, size_t field_offset, size_t field_size,
+        const char *data, size_t data_offset, size_t n) {
+    size_t start, end;
+
+    start = field_offset > data_offset ? field_offset : data_offset;
+    end = field_offset + field_size < data_offset + n ?
+        field_offset + field_size : data_offset + n;
+    if (start < end)
+        memcpy((char *)field + (start - field_offset),
+                data + (start - data_offset), end - start);
+}
+
+/* consume connection setup data buffered in dev->in, the same as
+ * receive_and_validate_caps() does but without blocking
+ *
+ * returns: -1 on error, 0 if more data is needed, 1 when done - the rest of
+ * dev->in contains events then
+ */
+int process_handshake(const struct options *opt, struct device *dev) {
+    struct handshake *hs = dev->handshake;
+    char *data = (char *)dev->in.ev;
+    size_t len = dev->in.len;
+    size_t pos = 0, n;
+
+    while (!hs->descriptor_done && pos < len) {
+        if (!data[pos]) {
+            hs->descriptor[hs->descriptor_len] = 0;
+            hs->descriptor_done = 1;
+        } else if (hs->descriptor_len == sizeof(hs->descriptor) - 1) {
+            fprintf(stderr, "Service descriptor too long\n");
+            return -1;
+        } else {
+            hs->descriptor[hs->descriptor_len++] = data[pos];
+        }
+        pos++;
+    }
+
+    if (hs->descriptor_done && hs->hello_len < sizeof(hs->hello)) {
+        n = sizeof(hs->hello) - hs->hello_len;
+        if (n > len - pos)
+            n = len - pos;
+        memcpy((char *)&hs->hello + hs->hello_len, data + pos, n);
+        hs->hello_len += n;
+        pos += n;
+        if (hs->hello_len == sizeof(hs->hello) &&
+                (hs->hello.version < INPUT_PROXY_PROTOCOL_VERSION_MIN ||
+                 hs->hello.version > INPUT_PROXY_PROTOCOL_VERSION)) {
+            if (opt->log_level >= 1)
+                fprintf(stderr, "Incompatible remote protocol version: %d\n",
+                        hs->hello.version);
+            return -1;
+        }
+    }
+
+    if (hs->hello_len == sizeof(hs->hello) &&
+            hs->caps_len < hs->hello.caps_size) {
+        n = hs->hello.caps_size - hs->caps_len;
+        if (n > len - pos)
+            n = len - pos;
+        /* anything above what we know is discarded, the same as in
+         * receive_and_validate_caps() */
+        copy_overlap(&hs->caps_msg, 0, sizeof(hs->caps_msg),
+                data + pos, hs->caps_len, n);
+        copy_overlap(&hs->proposal, sizeof(hs->caps_msg),
+                sizeof(hs->proposal), data + pos, hs->caps_len, n);
+        hs->caps_len += n;
+        pos += n;
+    }
+
+    dev->in.len -= pos;
+    memmove(dev->in.ev, data + pos, dev->in.len);
+
+    if (hs->hello_len < sizeof(hs->hello) ||
+            hs->caps_len < hs->hello.caps_size)
+        return 0;
+
+    if (parse_service_descriptor(dev) == -1)
+        return -1;
+    dev->version = negotiate_version(hs->hello.version,
+            hs->proposal.version);
+    if (hs->hello.version >= 2)
+        expand_sparse_absinfo(&hs->caps_msg,
+                hs->caps_len < sizeof(hs->caps_msg) ?
+                hs->caps_len : sizeof(hs->caps_msg));
+    return validate_caps(opt, dev, &hs->caps_msg);
+}
+
+/* with --keep-devices, uinput devices of closed connections are kept
+ * ("parked") for a while, and a new connection from the same source domain,
+ * with the same device name and capabilities, gets the existing device back -
+ * without another round of hotplug handling in udev, libinput, X server etc */
+
+int same_device(const struct device *a, const struct device *b) {
+    size_t i;
+
+    if (!a->domain || !b->domain || strcmp(a->domain, b->domain))
+        return 0;
+    if (strcmp(a->name, b->name))
+        return 0;
+    if (memcmp(&a->caps, &b->caps, sizeof(a->caps)))
+        return 0;
+    /* the current value doesn't matter */
+    for (i = 0; i < ABS_CNT; i++) {
+        if (a->absinfo[i].minimum != b->absinfo[i].minimum ||
+                a->absinfo[i].maximum != b->absinfo[i].maximum ||
+                a->absinfo[i].fuzz != b->absinfo[i].fuzz ||
+                a->absinfo[i].flat != b->absinfo[i].flat ||
+                a->absinfo[i].resolution != b->absinfo[i].resolution)
+            return 0;
+    }
+    return 1;
+}
+
+/* release everything still pressed and drop the incomplete frame, so
+ * nothing stays stuck while the device is parked
+ *
+ * returns: -1 on error, >0 on success
+ */
+int release_keys(const struct options *opt, struct device *dev) {
+    struct input_event ev = { .type = EV_KEY };
+    int i;
+
+    dev->out.len = 0;
+    for (i = 0; i < KEY_CNT; i++) {
+        if (!LONG_TEST_BIT(dev->keys_down, i))
+            continue;
+        ev.code = i;
+        if (append_output(opt, dev, &ev) == -1)
+            return -1;
+    }
+    if (!dev->out.len)
+        return 1;
+    ev.type = EV_SYN;
+    ev.code = SYN_REPORT;
+    if (append_output(opt, dev, &ev) == -1)
+        return -1;
+    return flush_frames(dev->uinput_fd, &dev->out, opt->stats);
+}
+
+/* keep the uinput device of a closed connection for reuse
+ *
+ * returns: -1 on error (dev should be freed then), 0 on success
+ */
+int park_device(const struct options *opt, int epoll_fd, struct device *dev,
+        struct device ***parked, size_t *parked_count) {
+    struct device **new_parked;
+
+    if (release_keys(opt, dev) == -1)
+        return -1;
+#ifndef FUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION
+    if (epoll_ctl(epoll_fd, EPOLL_CTL_DEL, dev->uinput_fd, NULL) == -1) {
+        perror("epoll_ctl");
+        return -1;
+    }
+#else
+    (void)epoll_fd;
+#endif
+    new_parked = realloc(*parked, (*parked_count + 1) * sizeof(**parked));
+    if (!new_parked) {
+        perror("realloc");
+        return -1;
+    }
+    *parked = new_parked;
+    clock_gettime(CLOCK_MONOTONIC, &dev->expires);
+    dev->expires.tv_sec += opt->keep_devices;
+    (*parked)[(*parked_count)++] = dev;
+    if (opt->log_level >= 2)
+        fprintf(stderr, "Device '%s' from %s parked\n", dev->name, dev->domain);
+    return 0;
+}
+
+/* take over the uinput device of a matching parked device, if there is one
+ *
+ * returns: 1 if found, 0 otherwise
+ */
+int unpark_device(const struct options *opt, struct device *dev,
+        struct device **parked, size_t *parked_count) {
+    size_t i;
+
+    for (i = 0; i < *parked_count; i++) {
+        if (!same_device(parked[i], dev))
+            continue;
+        dev->uinput_fd = parked[i]->uinput_fd;
+        parked[i]->uinput_fd = -1;
+        device_free(opt, parked[i]);
+        parked[i] = parked[--(*parked_count)];
+        return 1;
+    }
+    return 0;
+}
+
+/* destroy parked devices that weren't reused in time
+ *
+ * returns: time until the next one expires in milliseconds, -1 if none
+ */
+int expire_parked_devices(const struct options *opt,
+        struct device **parked, size_t *parked_count) {
+    struct timespec now;
+    long long timeout;
+    int next = -1;
+    size_t i;
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    for (i = 0; i < *parked_count; ) {
+        timeout = (parked[i]->expires.tv_sec - now.tv_sec) * 1000LL +
+            (parked[i]->expires.tv_nsec - now.tv_nsec) / 1000000;
+        if (timeout <= 0) {
+            if (opt->log_level >= 2)
+                fprintf(stderr, "Parked device '%s' from %s removed\n",
+                        parked[i]->name, parked[i]->domain);
+            device_free(opt, parked[i]);
+            parked[i] = parked[--(*parked_count)];
+            continue;
+        }
+        next = min_timeout(next, timeout);
+        i++;
+    }
+    return next;
+}
+
+/* handle data on the connection, until the handshake is done, then it's just
+ * validate_and_forward_events()
+ *
+ * returns: -1 on error, 0 on EOF, >0 on success
+ */
+int handle_connection(const struct options *opt, int epoll_fd,
+        struct device *dev, struct device **parked, size_t *parked_count) {
+    struct epoll_event ev = { .events = EPOLLIN };
+    int rc;
+
+    if (!dev->handshake)
+        return validate_and_forward_events(opt, dev);
+
+    rc = read(dev->in_fd, (char *)dev->in.ev + dev->in.len,
+            sizeof(dev->in.ev) - dev->in.len);
+    if (rc == 0)
+        return 0;
+    if (rc == -1 && errno == EAGAIN)
+        return 1;
+    if (rc == -1) {
+        perror("read");
+        return -1;
+    }
+    dev->in.len += rc;
+
+    rc = process_handshake(opt, dev);
+    if (rc == -1)
+        return -1;
+    if (rc == 0)
+        return 1;
+    free(dev->handshake);
+    dev->handshake = NULL;
+
+    if (send_negotiated_caps(dev) == -1)
+        return -1;
+    if (unpark_device(opt, dev, parked, parked_count)) {
+        init_rate_limits(opt, dev);
+        if (opt->log_level >= 2)
+            fprintf(stderr, "Reusing parked device '%s' from %s\n",
+                    dev->name, dev->domain);
+    } else if (open_uinput_device(opt, dev) == -1) {
+        return -1;
+    }
+#ifndef FUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION
+    dev->uinput_src.fd = dev->uinput_fd;
+    ev.data.ptr = &dev->uinput_src;
+    if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, dev->uinput_fd, &ev) == -1) {
+        perror("epoll_ctl");
+        return -1;
+    }
+#else
+    (void)epoll_fd;
+    (void)ev;
+#endif
+    if (opt->log_level >= 2)
+        fprintf(stderr, "Device '%s' connected from %s\n",
+                dev->name, dev->domain);
+
+    return process_buffered_events(opt, dev);
+}
+
+int accept_connection(const struct options *opt, int epoll_fd, int listen_fd,
+        struct device ***devices, size_t *devices_count) {
+    struct epoll_event ev = { .events = EPOLLIN };
+    struct device *dev, **new_devices;
+    int fd;
+
+    fd = accept4(listen_fd, NULL, NULL, SOCK_NONBLOCK | SOCK_CLOEXEC);
+    if (fd == -1) {
+        perror("accept");
+        /* not fatal, try again with the next one */
+        return 0;
+    }
+
+    dev = device_new(fd, fd);
+    if (!dev) {
+        close(fd);
+        return 0;
+    }
+    dev->owns_fds = 1;
+    dev->handshake = calloc(1, sizeof(*dev->handshake));
+    new_devices = realloc(*devices,
+            (*devices_count + 1) * sizeof(**devices));
+    if (new_devices)
+        *devices = new_devices;
+    if (!dev->handshake || !new_devices) {
+        perror("alloc");
+        device_free(opt, dev);
+        return 0;
+    }
+
+    /* the socket is fresh, so this will not block */
+    if (send_announce(dev->remote) == -1) {
+        device_free(opt, dev);
+        return 0;
+    }
+
+    ev.data.ptr = &dev->stream_src;
+    if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, fd, &ev) == -1) {
+        perror("epoll_ctl");
+        device_free(opt, dev);
+        return 0;
+    }
+    (*devices)[(*devices_count)++] = dev;
+    return 0;
+}
+
+int listen_socket(const char *path) {
+    struct sockaddr_un addr = { .sun_family = AF_UNIX };
+    int fd;
+
+    if (strlen(path) >= sizeof(addr.sun_path)) {
+        fprintf(stderr, "Socket path too long: %s\n", path);
+        return -1;
+    }
+    strcpy(addr.sun_path, path);
+
+    fd = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+    if (fd == -1) {
+        perror("socket");
+        return -1;
+    }
+    /* remove stale socket, if any */
+    if (unlink(path) == -1 && errno != ENOENT) {
+        perror("unlink");
+        close(fd);
+        return -1;
+    }
+    if (bind(fd, (struct sockaddr *)&addr, sizeof(addr)) == -1) {
+        perror("bind");
+        close(fd);
+        return -1;
+    }
+    if (listen(fd, 16) == -1) {
+        perror("listen");
+        close(fd);
+        return -1;
+    }
+    return fd;
+}
+
+#define MAX_EPOLL_EVENTS 32
+
+int run_daemon(const struct options *opt) {
+    struct epoll_event events[MAX_EPOLL_EVENTS];
+    struct epoll_event ev = { .events = EPOLLIN, .data.ptr = NULL };
+    /* all the connected devices */
+    struct device **devices = NULL;
+    size_t devices_count = 0;
+    /* see park_device() */
+    struct device **parked = NULL;
+    size_t parked_count = 0;
+    struct device_fd *src;
+    struct device *dev;
+    struct timespec now;
+    int listen_fd, epoll_fd;
+    int timeout;
+    int rc, n, i;
+    size_t j;
+
+    /* a connection closed by the remote end shouldn't kill all the others */
+    signal(SIGPIPE, SIG_IGN);
+
+    listen_fd = listen_socket(opt->listen_path);
+    if (listen_fd == -1)
+        return -1;
+
+    epoll_fd = epoll_create1(EPOLL_CLOEXEC);
+    if (epoll_fd == -1) {
+        perror("epoll_create1");
+        close(listen_fd);
+        return -1;
+    }
+    if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, listen_fd, &ev) == -1) {
+        perror("epoll_ctl");
+        goto out;
+    }
+
+    for (;;) {
+        timeout = min_timeout(stats_timeout(opt->stats),
+                expire_parked_devices(opt, parked, &parked_count));
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        for (j = 0; j < devices_count; j++) {
+            timeout = min_timeout(timeout, held_timeout(devices[j], &now));
+            timeout = min_timeout(timeout,
+                    drop_log_timeout(devices[j], &now));
+        }
+        n = epoll_wait(epoll_fd, events, MAX_EPOLL_EVENTS, timeout);
+        if (n == -1 && errno == EINTR)
+            continue;
+        if (n == -1) {
+            perror("epoll_wait");
+            goto out;
+        }
+
+        for (i = 0; i < n; i++) {
+            src = events[i].data.ptr;
+            if (!src) {
+                accept_connection(opt, epoll_fd, listen_fd,
+                        &devices, &devices_count);
+                continue;
+            }
+            dev = src->dev;
+            /* already disconnected while handling this batch */
+            if (dev->in_fd == -1)
+                continue;
+            if (src == &dev->uinput_src)
+                rc = validate_and_forward_event(opt, dev,
+                        dev->uinput_fd, dev->remote);
+            else
+                rc = handle_connection(opt, epoll_fd, dev,
+                        parked, &parked_count);
+            if (rc <= 0) {
+                if (opt->log_level >= 2)
+                    fprintf(stderr, "Device '%s' from %s disconnected\n",
+                            dev->name ? dev->name : "(unknown)",
+                            dev->domain ? dev->domain : "(unknown)");
+                /* closing fds removes them from epoll too */
+                close(dev->in_fd);
+                dev->in_fd = dev->out_fd = -1;
+            }
+        }
+
+        for (j = 0; j < devices_count; j++) {
+            dev = devices[j];
+            if (dev->in_fd != -1 && flush_held_events(opt, dev) == -1) {
+                close(dev->in_fd);
+                dev->in_fd = dev->out_fd = -1;
+            }
+            log_dropped_events_if_due(opt, dev);
+        }
+
+        /* free disconnected devices only now, other events in this batch
+         * may still refer to them */
+        for (j = 0; j < devices_count; ) {
+            if (devices[j]->in_fd == -1) {
+                log_dropped_events(opt, devices[j]);
+                if (!opt->keep_devices || devices[j]->uinput_fd == -1 ||
+                        park_device(opt, epoll_fd, devices[j],
+                            &parked, &parked_count) == -1)
+                    device_free(opt, devices[j]);
+                devices[j] = devices[--devices_count];
+            } else {
+                j++;
+            }
+        }
+
+        stats_dump_if_due(opt->stats);
+    }
+
+out:
+    for (j = 0; j < devices_count; j++)
+        device_free(opt, devices[j]);
+    free(devices);
+    for (j = 0; j < parked_count; j++)
+        device_free(opt, parked[j]);
+    free(parked);
+    close(epoll_fd);
+    close(listen_fd);
+    return -1;
+}
+
+void usage() {
+    fprintf(stderr, "Usage: input-proxy-receiver [options...]\n");
+    fprintf(stderr, "       --mouse, -m - allow remote device act as mouse\n");
+    fprintf(stderr, "    --keyboard, -k - allow remote device act as keyboard\n");
+    fprintf(stderr, "      --tablet, -t - allow remote device act as tablet\n");
     fprintf(stderr, "   --name=NAME, -n - set device name\n");
     fprintf(stderr, "   --vendor=ID,    - set device vendor ID (hex)\n");
     fprintf(stderr, "  --product=ID,    - set device product ID (hex)\n");
     fprintf(stderr, "  --quiet, -q      - mute messages about invalid data\n");
     fprintf(stderr, "  --verbose, -v,   - verbose logging, warning: may contain sensitive info\n");
+    fprintf(stderr, "  --drop-log-interval=SECONDS - how often to log a summary of ignored\n");
+    fprintf(stderr, "                     events (default: 10)\n");
+    fprintf(stderr, "  --listen=PATH    - serve all connections of socket-based qrexec service\n");
+    fprintf(stderr, "                     at PATH in a single process\n");
+    fprintf(stderr, "  --keep-devices=SECONDS - with --listen, keep devices of closed connections\n");
+    fprintf(stderr, "                     for reuse by a reconnect (default: 0)\n");
+    fprintf(stderr, "  --coalesce       - merge pending relative motion frames into one\n");
+    fprintf(stderr, "  --autorepeat     - generate key repeats locally, instead of receiving them\n");
+    fprintf(stderr, "  --stats=PATH     - periodically dump statistics to a file or UNIX socket\n");
+    fprintf(stderr, "  --stats-interval=SECONDS - how often to dump statistics (default: 10)\n");
+    fprintf(stderr, "  --rate-limit-motion=N - limit relative motion events per second\n");
+    fprintf(stderr, "  --rate-limit-keys=N   - limit key presses and other button-like events\n");
+    fprintf(stderr, "                          per second (releases are not limited)\n");
+    fprintf(stderr, "  --rate-limit-abs=N    - limit absolute axis events per second\n");
+    fprintf(stderr, "  --rate-limit-action=coalesce|drop|disconnect - what to do with events\n");
+    fprintf(stderr, "                          above the limit (default: coalesce)\n");
+    fprintf(stderr, "  --low-latency[=PRIORITY] - run with real-time priority (default: %d)\n",
+            LOW_LATENCY_DEFAULT_PRIORITY);
+    fprintf(stderr, "                     and locked memory\n");
+    fprintf(stderr, "  --cpu=N          - run only on CPU N\n");
+    fprintf(stderr, "  --transport=SPEC - how to talk to the sender: stdio (default) or\n");
+    fprintf(stderr, "                     shm:SOCKET-PATH, not with --listen\n");
 }
 
 #define OPT_VENDOR  128
 #define OPT_PRODUCT 129
+#define OPT_LISTEN  130
+#define OPT_COALESCE 131
+#define OPT_STATS   132
+#define OPT_STATS_INTERVAL 133
+#define OPT_RATE_LIMIT_MOTION 134
+#define OPT_RATE_LIMIT_KEYS 135
+#define OPT_RATE_LIMIT_ABS 136
+#define OPT_RATE_LIMIT_ACTION 137
+#define OPT_AUTOREPEAT 138
+#define OPT_KEEP_DEVICES 139
+#define OPT_DROP_LOG_INTERVAL 140
+#define OPT_LOW_LATENCY 141
+#define OPT_CPU 142
+#define OPT_TRANSPORT 143
+
+int parse_rate_limit(const char *arg, unsigned int *rate) {
+    int value = atoi(arg);
+
+    if (value < 0) {
+        fprintf(stderr, "Invalid rate limit: %s\n", arg);
+        return -1;
+    }
+    *rate = value;
+    return 0;
+}
 
 int parse_options(struct options *opt, int argc, char **argv) {
     struct option opts[] = {
@@ -479,14 +1863,33 @@ int parse_options(struct options *opt, int argc, char **argv) {
         { "product",   1, 0, OPT_PRODUCT },
         { "quiet",     0, 0, 'q' },
         { "verbose",   0, 0, 'v' },
+        { "listen",    1, 0, OPT_LISTEN },
+        { "coalesce",  0, 0, OPT_COALESCE },
+        { "stats",     1, 0, OPT_STATS },
+        { "stats-interval", 1, 0, OPT_STATS_INTERVAL },
+        { "rate-limit-motion", 1, 0, OPT_RATE_LIMIT_MOTION },
+        { "rate-limit-keys", 1, 0, OPT_RATE_LIMIT_KEYS },
+        { "rate-limit-abs", 1, 0, OPT_RATE_LIMIT_ABS },
+        { "rate-limit-action", 1, 0, OPT_RATE_LIMIT_ACTION },
+        { "autorepeat", 0, 0, OPT_AUTOREPEAT },
+        { "keep-devices", 1, 0, OPT_KEEP_DEVICES },
+        { "drop-log-interval", 1, 0, OPT_DROP_LOG_INTERVAL },
+        { "low-latency", 2, 0, OPT_LOW_LATENCY },
+        { "cpu",       1, 0, OPT_CPU },
+        { "transport", 1, 0, OPT_TRANSPORT },
         { 0 }
     };
+    char *stats_path = NULL;
+    int stats_interval = 10;
     int o;
 
     memset(opt, 0, sizeof(*opt));
     opt->name = NULL;
     opt->vendor = 0xffff;
     opt->product = 0xffff;
+    opt->drop_log_interval = 10;
+    opt->cpu = -1;
+    opt->transport = TRANSPORT_DEFAULT;
     LONG_SET_BIT(opt->caps.evbit, EV_SYN);
 
     while ((o = getopt_long(argc, argv, "mktn:v:p:qv", opts, NULL)) != -1) {
@@ -556,12 +1959,91 @@ int parse_options(struct options *opt, int argc, char **argv) {
             case 'v':
                 opt->log_level++;
                 break;
+            case OPT_LISTEN:
+                opt->listen_path = optarg;
+                break;
+            case OPT_COALESCE:
+                opt->coalesce = 1;
+                break;
+            case OPT_AUTOREPEAT:
+                LONG_SET_BIT(opt->caps.evbit, EV_REP);
+                break;
+            case OPT_KEEP_DEVICES:
+                opt->keep_devices = atoi(optarg);
+                if (opt->keep_devices < 0) {
+                    fprintf(stderr, "Invalid keep devices time: %s\n", optarg);
+                    return -1;
+                }
+                break;
+            case OPT_DROP_LOG_INTERVAL:
+                opt->drop_log_interval = atoi(optarg);
+                if (opt->drop_log_interval <= 0) {
+                    fprintf(stderr, "Invalid drop log interval: %s\n", optarg);
+                    return -1;
+                }
+                break;
+            case OPT_LOW_LATENCY:
+                if (parse_low_latency(optarg, &opt->low_latency) == -1)
+                    return -1;
+                break;
+            case OPT_CPU:
+                if (parse_cpu(optarg, &opt->cpu) == -1)
+                    return -1;
+                break;
+            case OPT_TRANSPORT:
+                opt->transport = optarg;
+                break;
+            case OPT_STATS:
+                stats_path = optarg;
+                break;
+            case OPT_STATS_INTERVAL:
+                stats_interval = atoi(optarg);
+                if (stats_interval <= 0) {
+                    fprintf(stderr, "Invalid stats interval: %s\n", optarg);
+                    return -1;
+                }
+                break;
+            case OPT_RATE_LIMIT_MOTION:
+                if (parse_rate_limit(optarg, &opt->rate_limit[RATE_MOTION]) == -1)
+                    return -1;
+                break;
+            case OPT_RATE_LIMIT_KEYS:
+                if (parse_rate_limit(optarg, &opt->rate_limit[RATE_KEYS]) == -1)
+                    return -1;
+                break;
+            case OPT_RATE_LIMIT_ABS:
+                if (parse_rate_limit(optarg, &opt->rate_limit[RATE_ABS]) == -1)
+                    return -1;
+                break;
+            case OPT_RATE_LIMIT_ACTION:
+                if (!strcmp(optarg, "coalesce"))
+                    opt->rate_limit_action = RATE_ACTION_COALESCE;
+                else if (!strcmp(optarg, "drop"))
+                    opt->rate_limit_action = RATE_ACTION_DROP;
+                else if (!strcmp(optarg, "disconnect"))
+                    opt->rate_limit_action = RATE_ACTION_DISCONNECT;
+                else {
+                    fprintf(stderr, "Invalid rate limit action: %s\n", optarg);
+                    return -1;
+                }
+                break;
             default:
                 usage();
                 return -1;
         }
     }
 
+    if (opt->listen_path && strcmp(opt->transport, TRANSPORT_DEFAULT) != 0) {
+        fprintf(stderr, "--transport can't be used with --listen\n");
+        return -1;
+    }
+
+    if (stats_path) {
+        opt->stats = stats_new(stats_path, stats_interval);
+        if (!opt->stats)
+            return -1;
+    }
+
     return 0;
 }
 
@@ -571,7 +2053,7 @@ int input_proxy_receiver_main(int argc, char **argv) {
 int main(int argc, char **argv) {
 #endif
     struct options opt = { 0 };
-    int fd = -1;
+    struct device *dev = NULL;
     int rc;
 
     /* defaults */
@@ -581,30 +2063,50 @@ int main(int argc, char **argv) {
     if (rc == -1)
         return 1;
 
-    rc = receive_and_validate_caps(&opt);
+    if (set_low_latency(opt.low_latency, opt.cpu) == -1)
+        return 1;
+
+    if (opt.listen_path)
+        return run_daemon(&opt) == -1;
+
+    dev = device_new(0, 1);
+    if (!dev)
+        return 1;
+    if (getenv("QREXEC_REMOTE_DOMAIN"))
+        dev->domain = strdup(getenv("QREXEC_REMOTE_DOMAIN"));
+
+    if (strcmp(opt.transport, TRANSPORT_DEFAULT) != 0) {
+        dev->remote->close(dev->remote);
+        dev->remote = transport_open(opt.transport, 1);
+        if (!dev->remote) {
+            rc = 1;
+            goto out;
+        }
+    }
+
+    if (send_announce(dev->remote) == -1) {
+        rc = 1;
+        goto out;
+    }
+
+    rc = receive_and_validate_caps(&opt, dev);
     if (rc <= 0) {
         rc = (rc == -1);
         goto out;
     }
 
-#ifdef FUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION
-    fd = 1;
-#else
-    fd = open(UINPUT_DEVICE, O_RDWR);
-    if (fd == -1) {
-        perror("open " UINPUT_DEVICE);
+    if (send_negotiated_caps(dev) == -1) {
         rc = 1;
         goto out;
     }
 
-    rc = register_device(&opt, fd);
+    rc = open_uinput_device(&opt, dev);
     if (rc == -1) {
         rc = 1;
         goto out;
     }
-#endif
 
-    rc = process_events(&opt, fd);
+    rc = process_events(&opt, dev);
     if (rc == -1) {
         rc = 1;
         goto out;
@@ -612,9 +2114,10 @@ int main(int argc, char **argv) {
 
     rc = 0;
 out:
-    if (fd != -1)
-        close(fd);
-    if (opt.name)
-        free(opt.name);
+    device_free(&opt, dev);
+    if (opt.stats) {
+        stats_dump(opt.stats);
+        free(opt.stats);
+    }
     return rc;
 }
@@ -4,20 +4,68 @@
 #include <unistd.h>
 #include <errno.h>
 #include <poll.h>
-#include <errno.h>
+#include <stdlib.h>
+#include <stddef.h>
+#include <getopt.h>
+#include <time.h>
 #include <linux/input.h>
 #include "protocol.h"
 #include "common.h"
+#include "stats.h"
+#include "transport.h"
+
+struct options {
+    char *device;
+    int batch;
+    int coalesce;
+    /* NULL if disabled */
+    struct stats *stats;
+    /* the receiver generates key repeats itself, don't send them */
+    int autorepeat;
+    /* SCHED_FIFO priority, 0 if disabled, see set_low_latency() */
+    int low_latency;
+    /* -1 if not pinned to a CPU */
+    int cpu;
+    /* see transport_open() */
+    const char *transport;
+    /* protocol version, 0 until the receiver announces it (see
+     * INPUT_PROXY_ANNOUNCE_CODE); with a receiver that doesn't, version 1 is
+     * used */
+    int version;
+    /* the caps message was sent with a version proposal, the announce
+     * settles the version then */
+    int proposed;
+};
+
+int is_announce(const struct input_event *ev) {
+    return ev->type == EV_SYN && ev->code == INPUT_PROXY_ANNOUNCE_CODE;
+}
+
+/* protocol version to use with a receiver that announced ev */
+int announced_version(const struct input_event *ev) {
+    if (ev->value > INPUT_PROXY_PROTOCOL_VERSION)
+        return INPUT_PROXY_PROTOCOL_VERSION;
+    if (ev->value < INPUT_PROXY_PROTOCOL_VERSION_MIN)
+        return INPUT_PROXY_PROTOCOL_VERSION_MIN;
+    return ev->value;
+}
 
-int send_caps(int fd) {
+/* send hello and the caps message; with proposed set (version is 1 then), the
+ * message is complete and followed by the version proposal, see
+ * INPUT_PROXY_ANNOUNCE_CODE */
+int send_caps(int fd, int version, int proposed, struct transport *dst) {
+    struct input_proxy_version_proposal proposal = {
+        .version = INPUT_PROXY_PROTOCOL_VERSION,
+    };
     struct input_proxy_device_caps_msg caps_msg = { 0 };
     struct input_proxy_device_caps caps = { 0 };
     struct input_proxy_hello hello = {
-        .version = INPUT_PROXY_PROTOCOL_VERSION,
-        .caps_size = sizeof caps_msg
+        .version = version,
+        .caps_size = offsetof(struct input_proxy_device_caps_msg, absinfo)
     };
+    struct input_absinfo *absinfo;
     int rc = 0;
-    int i;
+    int i, n = 0;
 
     if (rc != -1) rc = ioctl(fd, EVIOCGPROP(       sizeof caps.propbit), caps.propbit);
     if (rc != -1) rc = ioctl(fd, EVIOCGBIT(0,      sizeof caps.evbit),    caps.evbit);
@@ -57,33 +105,49 @@ int send_caps(int fd) {
         caps_msg.name[sizeof(caps_msg.name)-1] = 0;
     }
 
+    /* absinfo is sparse since version 2; in version 1, the message is
+     * truncated after the last axis */
     for (i = 0; i < ABS_CNT; i++) {
         if (caps.absbit[i / BITS_PER_LONG] & (1UL<<(i & (BITS_PER_LONG-1)))) {
-            rc = ioctl(fd, EVIOCGABS(i), &caps_msg.absinfo[i]);
+            if (version >= 2) {
+                absinfo = &caps_msg.absinfo[n++];
+            } else {
+                absinfo = &caps_msg.absinfo[i];
+                n = i + 1;
+            }
+            rc = ioctl(fd, EVIOCGABS(i), absinfo);
             if (rc == -1) {
                 perror("ioctl get absinfo");
                 return -1;
             }
         }
     }
+    hello.caps_size += n * sizeof(caps_msg.absinfo[0]);
+    if (proposed)
+        hello.caps_size = sizeof(caps_msg) + sizeof(proposal);
 
-    rc = write_all(1, &hello, sizeof(hello));
+    rc = dst->write(dst, &hello, sizeof(hello));
     if (rc == -1)
         return rc;
-    rc = write_all(1, &caps_msg, sizeof(caps_msg));
+    if (proposed) {
+        rc = dst->write(dst, &caps_msg, sizeof(caps_msg));
+        if (rc == -1)
+            return rc;
+        return dst->write(dst, &proposal, sizeof(proposal));
+    }
+    rc = dst->write(dst, &caps_msg, hello.caps_size);
     return rc;
 }
 
-int ignore_led_events(int fd) {
-    int rc;
-    unsigned long bits[BITS_TO_LONGS(LED_CNT)];
+/* set which codes of given event type (or which types, if type is 0) the
+ * kernel should pass to us */
+int set_event_mask(int fd, int type, const unsigned long *bits, size_t size) {
     struct input_mask input_mask = {
-        .type       = EV_LED,
-        .codes_size = sizeof(bits),
+        .type       = type,
+        .codes_size = size,
         .codes_ptr  = (uintptr_t)bits,
     };
-
-    memset(bits, 0, sizeof(bits));
+    int rc;
 
     rc = ioctl(fd, EVIOCSMASK, &input_mask);
     if (rc == -1) {
@@ -94,7 +158,156 @@ int ignore_led_events(int fd) {
     return 0;
 }
 
-int pass_event(int src_fd, int dst_fd) {
+int ignore_led_events(int fd) {
+    unsigned long bits[BITS_TO_LONGS(LED_CNT)];
+
+    memset(bits, 0, sizeof(bits));
+
+    return set_event_mask(fd, EV_LED, bits, sizeof(bits));
+}
+
+/* since protocol version 3, the receiver tells which capabilities it
+ * accepted (stored in *caps); ask the kernel to not send us anything else, so
+ * it's filtered out before it even leaves this VM
+ *
+ * returns: -1 on error, 0 on EOF, >0 on success
+ */
+int receive_negotiated_caps(struct transport *src, int dev_fd,
+        struct input_proxy_device_caps *caps) {
+    struct input_proxy_hello hello;
+    size_t caps_size;
+    int rc;
+
+    rc = transport_read_all(src, &hello, sizeof(hello));
+    if (rc <= 0)
+        goto err;
+
+    caps_size = hello.caps_size;
+    if (caps_size > sizeof(*caps))
+        caps_size = sizeof(*caps);
+    memset(caps, 0, sizeof(*caps));
+    rc = transport_read_all(src, caps, caps_size);
+    if (rc <= 0)
+        goto err;
+    if (hello.caps_size > sizeof(*caps)) {
+        rc = transport_discard_all(src, hello.caps_size - sizeof(*caps));
+        if (rc <= 0)
+            goto err;
+    }
+
+    /* the receiver always accepts that, but make sure to not lose frame
+     * ends */
+    caps->evbit[0] |= 1UL << EV_SYN;
+
+    if (set_event_mask(dev_fd, 0, caps->evbit, sizeof(caps->evbit)) == -1 ||
+            set_event_mask(dev_fd, EV_KEY, caps->keybit, sizeof(caps->keybit)) == -1 ||
+            set_event_mask(dev_fd, EV_REL, caps->relbit, sizeof(caps->relbit)) == -1 ||
+            set_event_mask(dev_fd, EV_ABS, caps->absbit, sizeof(caps->absbit)) == -1 ||
+            set_event_mask(dev_fd, EV_MSC, caps->mscbit, sizeof(caps->mscbit)) == -1 ||
+            set_event_mask(dev_fd, EV_SND, caps->sndbit, sizeof(caps->sndbit)) == -1 ||
+            set_event_mask(dev_fd, EV_SW,  caps->swbit,  sizeof(caps->swbit)) == -1)
+        return -1;
+    return 1;
+
+err:
+    if (rc == -1)
+        perror("read negotiated caps");
+    return rc;
+}
+
+/* with autorepeat done by the receiver (it accepted EV_REP), send it the
+ * repeat delay and period of the device, as synthetic EV_REP events */
+int send_repeat_settings(int dev_fd, struct transport *dst) {
+    struct input_event ev[3];
+    struct timespec now;
+    unsigned int rep[2];
+    int i;
+
+    if (ioctl(dev_fd, EVIOCGREP, rep) == -1) {
+        perror("ioctl get repeat");
+        return -1;
+    }
+    memset(ev, 0, sizeof(ev));
+    clock_gettime(CLOCK_REALTIME, &now);
+    for (i = 0; i < 3; i++) {
+        ev[i].input_event_sec = now.tv_sec;
+        ev[i].input_event_usec = now.tv_nsec / 1000;
+    }
+    ev[0].type = EV_REP;
+    ev[0].code = REP_DELAY;
+    ev[0].value = rep[0];
+    ev[1].type = EV_REP;
+    ev[1].code = REP_PERIOD;
+    ev[1].value = rep[1];
+    ev[2].type = EV_SYN;
+    ev[2].code = SYN_REPORT;
+    if (dst->write(dst, ev, sizeof(ev)) == -1) {
+        perror("write");
+        return -1;
+    }
+    return 0;
+}
+
+/* since version 3, filter events at the source according to the negotiated
+ * caps, and leave key repeats to the receiver if it accepted EV_REP
+ *
+ * returns: -1 on error, 0 if the receiver rejected the device, >0 on success
+ */
+int start_negotiated(struct options *opt, int dev_fd,
+        struct transport *remote) {
+    struct input_proxy_device_caps caps;
+    int rc;
+
+    rc = receive_negotiated_caps(remote, dev_fd, &caps);
+    if (rc <= 0)
+        return rc;
+    opt->autorepeat = (caps.evbit[0] & (1UL << EV_REP)) != 0;
+    if (opt->autorepeat && send_repeat_settings(dev_fd, remote) == -1)
+        return -1;
+    return 1;
+}
+
+/* pass an event from the receiver to the device; the announce is handled
+ * here too, see INPUT_PROXY_ANNOUNCE_CODE
+ *
+ * returns: -1 on error, 0 on EOF, >0 on success (also if nothing was there)
+ */
+int receive_event(struct options *opt, struct transport *src, int dev_fd) {
+    struct input_event ev;
+    int rc;
+
+    rc = src->read(src, &ev, sizeof(ev));
+    /* spurious wakeup */
+    if (rc == -1 && errno == EAGAIN)
+        return 1;
+    if (rc > 0 && rc < (int)sizeof(ev))
+        rc = transport_read_all(src, (char *)&ev + rc, sizeof(ev) - rc);
+    if (rc == 0)
+        return 0;
+    if (rc == -1) {
+        perror("read");
+        return -1;
+    }
+    if (is_announce(&ev)) {
+        /* only the first one counts, the kernel would ignore it anyway */
+        if (opt->version)
+            return 1;
+        opt->version = announced_version(&ev);
+        if (opt->proposed && opt->version >= 3)
+            return start_negotiated(opt, dev_fd, src);
+        return 1;
+    }
+    rc = write_all(dev_fd, &ev, sizeof(ev));
+    if (rc == -1) {
+        perror("write");
+        return -1;
+    }
+    return rc;
+}
+
+/* if autorepeat is set, key repeats are not passed */
+int pass_event(int src_fd, struct transport *dst, struct stats *stats,
+        int autorepeat) {
     int rc;
     struct input_event ev;
 
@@ -108,53 +321,240 @@ int pass_event(int src_fd, int dst_fd) {
         perror("read");
         return -1;
     }
-    rc = write_all(dst_fd, &ev, sizeof(ev));
+    if (autorepeat && ev.type == EV_KEY && ev.value == 2)
+        return 1;
+    rc = dst->write(dst, &ev, sizeof(ev));
+    if (rc == -1) {
+        perror("write");
+        return -1;
+    }
+    stats_record_written(stats, &ev, 1);
+    return rc;
+}
+
+/* read all the events the device has ready and send complete frames (up to
+ * the last SYN_REPORT) with a single write; the incomplete frame, if any, is
+ * kept in the buffer until the rest of it arrives; if merged is not NULL,
+ * relative motion is coalesced first (see coalesce_rel_frames()); if
+ * repeat_removed is not NULL, key repeats are removed (see
+ * drop_key_repeats())
+ *
+ * returns: -1 on error, 0 on EOF, >0 on success
+ */
+int pass_event_batch(int src_fd, struct transport *dst,
+        struct event_buffer *batch,
+        unsigned long *merged, int *repeat_removed, struct stats *stats) {
+    size_t count, send_count;
+    int rc;
+
+    rc = read(src_fd, (char *)batch->ev + batch->len,
+            sizeof(batch->ev) - batch->len);
+    if (rc == 0)
+        return 0;
+    /* treat device disconnect as EOF */
+    if (rc == -1 && errno == ENODEV)
+        return 0;
+    if (rc == -1) {
+        perror("read");
+        return -1;
+    }
+    batch->len += rc;
+
+    if (repeat_removed)
+        drop_key_repeats(batch, repeat_removed);
+    if (merged)
+        coalesce_event_buffer(batch, merged);
+
+    count = batch->len / sizeof(batch->ev[0]);
+    send_count = complete_frames(batch->ev, count);
+    /* no frame end and no space left - send what we have; the SYN_REPORT
+     * ending this frame must be sent then, even if only repeats follow */
+    if (!send_count && count == EVENT_BUFFER_SIZE) {
+        send_count = count;
+        if (repeat_removed)
+            *repeat_removed = 0;
+    }
+    if (!send_count)
+        return 1;
+
+    rc = dst->write(dst, batch->ev, send_count * sizeof(batch->ev[0]));
     if (rc == -1) {
         perror("write");
         return -1;
     }
+    stats_record_written(stats, batch->ev, send_count);
+    batch->len -= send_count * sizeof(batch->ev[0]);
+    memmove(batch->ev, batch->ev + send_count, batch->len);
     return rc;
 }
 
-int process_events(int fd) {
+/* handle whatever the receiver has sent already, without waiting for more
+ *
+ * returns: -1 on error, 0 on EOF, >0 on success
+ */
+int receive_pending_events(struct options *opt, struct transport *src,
+        int dev_fd) {
     struct pollfd fds[] = {
-        { .fd = 0,  .events = POLLIN, },
+        { .fd = src->poll_fd, .events = POLLIN, },
+    };
+    int rc = 0;
+
+    while (!opt->version && (rc = poll(fds, 1, 0)) > 0) {
+        rc = receive_event(opt, src, dev_fd);
+        if (rc <= 0)
+            return rc;
+    }
+    if (rc == -1) {
+        perror("poll");
+        return -1;
+    }
+    return 1;
+}
+
+int process_events(struct options *opt, int fd, struct transport *remote) {
+    struct pollfd fds[] = {
+        { .fd = remote->poll_fd, .events = POLLIN, },
         { .fd = fd, .events = POLLIN, }
     };
+    struct event_buffer batch = { .len = 0 };
+    unsigned long merged = 0;
+    int repeat_removed = 0;
     int rc = 0;
 
-    while ((rc=poll(fds, 2, -1)) > 0) {
+    while ((rc=poll(fds, 2, stats_timeout(opt->stats))) >= 0) {
         if (fds[0].revents) {
-            rc = pass_event(0, fd);
+            rc = receive_event(opt, remote, fd);
             if (rc <= 0)
-                return rc;
+                goto out;
         }
         if (fds[1].revents) {
-            rc = pass_event(fd, 1);
+            if (opt->batch)
+                rc = pass_event_batch(fd, remote, &batch,
+                        opt->coalesce ? &merged : NULL,
+                        opt->autorepeat ? &repeat_removed : NULL, opt->stats);
+            else
+                rc = pass_event(fd, remote, opt->stats, opt->autorepeat);
             if (rc <= 0)
-                return rc;
+                goto out;
+            if (opt->stats) {
+                opt->stats->merged = merged;
+                stats_record_wakeup(opt->stats);
+            }
         }
+        stats_dump_if_due(opt->stats);
     }
-    if (rc == -1) {
+    if (rc == -1)
         perror("poll");
-        return -1;
-    }
-    return 0;
+out:
+    if (merged)
+        fprintf(stderr, "Merged %lu relative motion events\n", merged);
+    if (opt->stats)
+        stats_dump(opt->stats);
+    return rc == -1 ? -1 : 0;
 }
 
 void usage() {
-    fprintf(stderr, "Usage: input-proxy-sender <device-file-path>\n");
+    fprintf(stderr, "Usage: input-proxy-sender [options...] <device-file-path>\n");
+    fprintf(stderr, "  --no-batch, -B   - send events one by one instead of whole frames\n");
+    fprintf(stderr, "  --coalesce, -c   - merge pending relative motion frames into one\n");
+    fprintf(stderr, "  --stats=PATH     - periodically dump statistics to a file or UNIX socket\n");
+    fprintf(stderr, "  --stats-interval=SECONDS - how often to dump statistics (default: 10)\n");
+    fprintf(stderr, "  --low-latency[=PRIORITY] - run with real-time priority (default: %d)\n",
+            LOW_LATENCY_DEFAULT_PRIORITY);
+    fprintf(stderr, "                     and locked memory\n");
+    fprintf(stderr, "  --cpu=N          - run only on CPU N\n");
+    fprintf(stderr, "  --transport=SPEC - how to talk to the receiver: stdio (default) or\n");
+    fprintf(stderr, "                     shm:SOCKET-PATH\n");
 }
 
-int main(int argc, char **argv) {
-    int fd;
+#define OPT_STATS 128
+#define OPT_STATS_INTERVAL 129
+#define OPT_LOW_LATENCY 130
+#define OPT_CPU 131
+#define OPT_TRANSPORT 132
+
+int parse_options(struct options *opt, int argc, char **argv) {
+    struct option opts[] = {
+        { "no-batch",  0, 0, 'B' },
+        { "coalesce",  0, 0, 'c' },
+        { "stats",     1, 0, OPT_STATS },
+        { "stats-interval", 1, 0, OPT_STATS_INTERVAL },
+        { "low-latency", 2, 0, OPT_LOW_LATENCY },
+        { "cpu",       1, 0, OPT_CPU },
+        { "transport", 1, 0, OPT_TRANSPORT },
+        { 0 }
+    };
+    char *stats_path = NULL;
+    int stats_interval = 10;
+    int o;
+
+    memset(opt, 0, sizeof(*opt));
+    opt->batch = 1;
+    opt->cpu = -1;
+    opt->transport = TRANSPORT_DEFAULT;
 
-    if (argc < 2) {
+    while ((o = getopt_long(argc, argv, "Bc", opts, NULL)) != -1) {
+        switch (o) {
+            case 'B':
+                opt->batch = 0;
+                break;
+            case 'c':
+                opt->coalesce = 1;
+                break;
+            case OPT_STATS:
+                stats_path = optarg;
+                break;
+            case OPT_STATS_INTERVAL:
+                stats_interval = atoi(optarg);
+                if (stats_interval <= 0) {
+                    fprintf(stderr, "Invalid stats interval: %s\n", optarg);
+                    return -1;
+                }
+                break;
+            case OPT_LOW_LATENCY:
+                if (parse_low_latency(optarg, &opt->low_latency) == -1)
+                    return -1;
+                break;
+            case OPT_CPU:
+                if (parse_cpu(optarg, &opt->cpu) == -1)
+                    return -1;
+                break;
+            case OPT_TRANSPORT:
+                opt->transport = optarg;
+                break;
+            default:
+                usage();
+                return -1;
+        }
+    }
+
+    if (optind >= argc) {
         usage();
-        return 1;
+        return -1;
+    }
+    opt->device = argv[optind];
+
+    if (stats_path) {
+        opt->stats = stats_new(stats_path, stats_interval);
+        if (!opt->stats)
+            return -1;
     }
 
-    fd = open(argv[1], O_RDWR);
+    return 0;
+}
+
+int main(int argc, char **argv) {
+    struct options opt;
+    struct transport *remote;
+    int fd, rc;
+
+    if (parse_options(&opt, argc, argv) == -1)
+        return 1;
+
+    if (set_low_latency(opt.low_latency, opt.cpu) == -1)
+        return 1;
+
+    fd = open(opt.device, O_RDWR);
     if (fd == -1) {
         perror("open");
         return 1;
@@ -172,10 +572,30 @@ int main(int argc, char **argv) {
         return 1;
     }
 
-    if (send_caps(fd) == -1)
+    remote = transport_open(opt.transport, 0);
+    if (!remote)
         return 1;
 
-    /* TODO: produce synthetic EV_REP initial events for keyboard */
+    /* the receiver may have announced its version already, otherwise
+     * propose ours, see INPUT_PROXY_ANNOUNCE_CODE */
+    rc = receive_pending_events(&opt, remote, fd);
+    if (rc == -1)
+        return 1;
+    if (rc == 0)
+        return 0;
+    opt.proposed = !opt.version;
+    if (send_caps(fd, opt.version ? opt.version : 1, opt.proposed,
+                remote) == -1)
+        return 1;
+
+    if (opt.version >= 3) {
+        rc = start_negotiated(&opt, fd, remote);
+        if (rc == -1)
+            return 1;
+        /* receiver rejected the device */
+        if (rc == 0)
+            return 0;
+    }
 
     /* The input proxy sender is a client of the evdev driver and has an active
      * grab. By default, Linux will send the LED events back to us, even if we
@@ -186,8 +606,9 @@ int main(int argc, char **argv) {
     if (ignore_led_events(fd) == -1)
         return 1;
 
-    if (process_events(fd) == -1)
+    if (process_events(&opt, fd, remote) == -1)
         return 1;
+    remote->close(remote);
 
     if (ioctl(fd, EVIOCGRAB, 0) == -1) {
         if (errno != ENODEV) {
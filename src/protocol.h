@@ -1,7 +1,33 @@
 #include <linux/input.h>
 #include <stdint.h>
 
-#define INPUT_PROXY_PROTOCOL_VERSION 1
+/* version 2: absinfo in input_proxy_device_caps_msg is sparse, see below
+ * version 3: after receiving the caps message, the receiver sends back
+ *   input_proxy_hello followed by input_proxy_device_caps with capabilities
+ *   it accepted (caps_size is its size, may be truncated or extended the same
+ *   way as input_proxy_device_caps_msg), so the sender can filter out other
+ *   events at the source; if EV_REP was accepted, the receiver generates key
+ *   repeats itself - the sender doesn't send them, and instead starts with
+ *   EV_REP events with the repeat delay and period of the device */
+#define INPUT_PROXY_PROTOCOL_VERSION 3
+/* the oldest version still supported */
+#define INPUT_PROXY_PROTOCOL_VERSION_MIN 1
+
+/* Before anything else, the receiver (since version 2) sends the highest
+ * protocol version it supports, as an input event: type EV_SYN, code
+ * INPUT_PROXY_ANNOUNCE_CODE, value - the version. An older sender passes it to
+ * the device, where the kernel ignores it.
+ *
+ * The sender doesn't wait for it. If the announce is already there when the
+ * sender is about to send the caps message, it uses the lower of both
+ * versions right away. Otherwise it sends hello with version 1 and a full
+ * version 1 caps message followed by struct input_proxy_version_proposal with
+ * the highest version it supports - a version 1 receiver discards it, as
+ * anything else above input_proxy_device_caps_msg. A newer receiver uses the
+ * lower of both versions then (but absinfo of this message is still in the
+ * version 1 layout); the sender learns the result from the announce, which
+ * comes before anything else the receiver sends. */
+#define INPUT_PROXY_ANNOUNCE_CODE SYN_MAX
 
 struct input_proxy_hello {
     uint32_t version;
@@ -45,5 +71,14 @@ struct input_proxy_device_caps_msg {
      * input_proxy_hello.caps_size set smaller accordingly); default value of 0
      * is assumed then */
     char name[128];
+    /* version 1: entry for each axis, zeroed for those not set in
+     * caps.absbit
+     * version 2: entries only for axes set in caps.absbit, in order */
     struct input_absinfo absinfo[ABS_CNT];
 };
+
+/* right after a full input_proxy_device_caps_msg, see
+ * INPUT_PROXY_ANNOUNCE_CODE */
+struct input_proxy_version_proposal {
+    uint32_t version;
+};
@@ -0,0 +1,218 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <sys/stat.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include "stats.h"
+
+static const char *event_type_names[EV_CNT] = {
+    [EV_SYN] = "EV_SYN",
+    [EV_KEY] = "EV_KEY",
+    [EV_REL] = "EV_REL",
+    [EV_ABS] = "EV_ABS",
+    [EV_MSC] = "EV_MSC",
+    [EV_SW]  = "EV_SW",
+    [EV_LED] = "EV_LED",
+    [EV_SND] = "EV_SND",
+    [EV_REP] = "EV_REP",
+    [EV_FF]  = "EV_FF",
+    [EV_PWR] = "EV_PWR",
+    [EV_FF_STATUS] = "EV_FF_STATUS",
+};
+
+struct stats *stats_new(const char *path, int interval) {
+    struct stats *stats;
+
+    stats = calloc(1, sizeof(*stats));
+    if (!stats) {
+        perror("calloc");
+        return NULL;
+    }
+    stats->path = path;
+    stats->interval = interval;
+    clock_gettime(CLOCK_MONOTONIC, &stats->next_dump);
+    stats->next_dump.tv_sec += interval;
+    return stats;
+}
+
+void stats_record_dropped(struct stats *stats, const struct input_event *ev) {
+    if (!stats || ev->type >= EV_CNT)
+        return;
+    stats->dropped[ev->type][ev->code < KEY_CNT ? ev->code : KEY_CNT]++;
+}
+
+static int latency_bucket(const struct input_event *ev,
+        const struct timespec *now) {
+    long long latency;
+    int bucket = 0;
+
+    latency = (now->tv_sec - (long long)ev->input_event_sec) * 1000000 +
+        now->tv_nsec / 1000 - ev->input_event_usec;
+    while (latency >= 2 && bucket < STATS_LATENCY_BUCKETS - 1) {
+        latency >>= 1;
+        bucket++;
+    }
+    return bucket;
+}
+
+/* record events written with a single write */
+void stats_record_written(struct stats *stats,
+        const struct input_event *ev, size_t count) {
+    struct timespec now;
+    size_t i;
+
+    if (!stats)
+        return;
+    /* input events use CLOCK_REALTIME by default */
+    clock_gettime(CLOCK_REALTIME, &now);
+    stats->writes++;
+    for (i = 0; i < count; i++) {
+        if (ev[i].type >= EV_CNT)
+            continue;
+        stats->forwarded[ev[i].type]++;
+        if (ev[i].type == EV_SYN && ev[i].code == SYN_REPORT) {
+            stats->wakeup_frames++;
+            stats->latency_hist[latency_bucket(&ev[i], &now)]++;
+        }
+    }
+}
+
+void stats_record_wakeup(struct stats *stats) {
+    int bucket = 0;
+
+    if (!stats)
+        return;
+    stats->wakeups++;
+    if (!stats->wakeup_frames)
+        return;
+    while (stats->wakeup_frames >= 2 && bucket < STATS_FRAMES_BUCKETS - 1) {
+        stats->wakeup_frames >>= 1;
+        bucket++;
+    }
+    stats->frames_hist[bucket]++;
+    stats->wakeup_frames = 0;
+}
+
+/* time until the next dump, in ms, suitable for poll() */
+int stats_timeout(struct stats *stats) {
+    struct timespec now;
+    long long timeout;
+
+    if (!stats)
+        return -1;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    timeout = (stats->next_dump.tv_sec - now.tv_sec) * 1000LL +
+        (stats->next_dump.tv_nsec - now.tv_nsec) / 1000000;
+    if (timeout < 0)
+        return 0;
+    return timeout;
+}
+
+static FILE *open_output(const char *path) {
+    struct sockaddr_un addr = { .sun_family = AF_UNIX };
+    struct stat st;
+    FILE *f;
+    int fd;
+
+    if (stat(path, &st) == -1 || !S_ISSOCK(st.st_mode))
+        return fopen(path, "a");
+
+    if (strlen(path) >= sizeof(addr.sun_path))
+        return NULL;
+    strcpy(addr.sun_path, path);
+    fd = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+    if (fd == -1)
+        return NULL;
+    if (connect(fd, (struct sockaddr *)&addr, sizeof(addr)) == -1) {
+        close(fd);
+        return NULL;
+    }
+    f = fdopen(fd, "w");
+    if (!f)
+        close(fd);
+    return f;
+}
+
+static void print_type(FILE *f, int type) {
+    if (event_type_names[type])
+        fprintf(f, "\"%s\"", event_type_names[type]);
+    else
+        fprintf(f, "\"%d\"", type);
+}
+
+static void print_hist(FILE *f, const uint64_t *hist, int count) {
+    int i;
+
+    fprintf(f, "[");
+    for (i = 0; i < count; i++)
+        fprintf(f, "%s%llu", i ? ", " : "", (unsigned long long)hist[i]);
+    fprintf(f, "]");
+}
+
+/* write all the counters as a single line JSON object */
+int stats_dump(struct stats *stats) {
+    struct timespec now;
+    FILE *f;
+    int type, code, first;
+
+    f = open_output(stats->path);
+    if (!f) {
+        perror("stats output");
+        return -1;
+    }
+
+    clock_gettime(CLOCK_REALTIME, &now);
+    fprintf(f, "{\"time\": %lld.%03ld", (long long)now.tv_sec,
+            now.tv_nsec / 1000000);
+    fprintf(f, ", \"wakeups\": %llu, \"writes\": %llu, \"merged\": %llu",
+            (unsigned long long)stats->wakeups,
+            (unsigned long long)stats->writes,
+            (unsigned long long)stats->merged);
+
+    fprintf(f, ", \"forwarded\": {");
+    first = 1;
+    for (type = 0; type < EV_CNT; type++) {
+        if (!stats->forwarded[type])
+            continue;
+        fprintf(f, "%s", first ? "" : ", ");
+        print_type(f, type);
+        fprintf(f, ": %llu", (unsigned long long)stats->forwarded[type]);
+        first = 0;
+    }
+
+    fprintf(f, "}, \"dropped\": [");
+    first = 1;
+    for (type = 0; type < EV_CNT; type++) {
+        for (code = 0; code <= KEY_CNT; code++) {
+            if (!stats->dropped[type][code])
+                continue;
+            fprintf(f, "%s{\"type\": ", first ? "" : ", ");
+            print_type(f, type);
+            fprintf(f, ", \"code\": %d, \"count\": %llu}", code,
+                    (unsigned long long)stats->dropped[type][code]);
+            first = 0;
+        }
+    }
+
+    fprintf(f, "], \"frames_per_wakeup\": ");
+    print_hist(f, stats->frames_hist, STATS_FRAMES_BUCKETS);
+    fprintf(f, ", \"latency_us\": ");
+    print_hist(f, stats->latency_hist, STATS_LATENCY_BUCKETS);
+    fprintf(f, "}\n");
+
+    if (fclose(f) == EOF) {
+        perror("stats output");
+        return -1;
+    }
+    return 0;
+}
+
+void stats_dump_if_due(struct stats *stats) {
+    if (!stats || stats_timeout(stats) > 0)
+        return;
+    stats_dump(stats);
+    clock_gettime(CLOCK_MONOTONIC, &stats->next_dump);
+    stats->next_dump.tv_sec += stats->interval;
+}
@@ -0,0 +1,49 @@
+#include <stdint.h>
+#include <stddef.h>
+#include <time.h>
+#include <linux/input.h>
+
+/* older headers */
+#ifndef input_event_sec
+#define input_event_sec time.tv_sec
+#define input_event_usec time.tv_usec
+#endif
+
+/* frames written per wakeup; bucket i counts [2^i, 2^(i+1)), the last one
+ * also everything above */
+#define STATS_FRAMES_BUCKETS 8
+/* time from the kernel event to the write, in microseconds; bucket 0 counts
+ * [0, 2), bucket i>0 counts [2^i, 2^(i+1)), the last one also everything
+ * above */
+#define STATS_LATENCY_BUCKETS 24
+
+struct stats {
+    /* where to dump stats - file (appended to) or UNIX socket */
+    const char *path;
+    /* dump interval, in seconds */
+    int interval;
+    /* CLOCK_MONOTONIC */
+    struct timespec next_dump;
+
+    /* all counters are cumulative, since the process start */
+    uint64_t wakeups;
+    uint64_t writes;
+    uint64_t merged;
+    uint64_t forwarded[EV_CNT];
+    /* events with code above KEY_CNT are counted at KEY_CNT */
+    uint64_t dropped[EV_CNT][KEY_CNT + 1];
+    uint64_t frames_hist[STATS_FRAMES_BUCKETS];
+    uint64_t latency_hist[STATS_LATENCY_BUCKETS];
+
+    /* frames written since the last stats_record_wakeup() */
+    uint64_t wakeup_frames;
+};
+
+struct stats *stats_new(const char *path, int interval);
+void stats_record_dropped(struct stats *stats, const struct input_event *ev);
+void stats_record_written(struct stats *stats,
+        const struct input_event *ev, size_t count);
+void stats_record_wakeup(struct stats *stats);
+int stats_timeout(struct stats *stats);
+int stats_dump(struct stats *stats);
+void stats_dump_if_due(struct stats *stats);
@@ -0,0 +1,537 @@
+#define _GNU_SOURCE
+#include <errno.h>
+#include <poll.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+#include <sys/epoll.h>
+#include <sys/eventfd.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include "common.h"
+#include "transport.h"
+
+/* stdin/stdout or any other pair of file descriptors */
+
+struct fd_transport {
+    struct transport t;
+    int in_fd;
+    int out_fd;
+};
+
+static int fd_read(struct transport *t, void *buf, size_t size) {
+    struct fd_transport *ft = (struct fd_transport *)t;
+
+    return read(ft->in_fd, buf, size);
+}
+
+/* out_fd may be non-blocking (connections accepted with --listen), wait for
+ * space then, the same as transport_read_all() waits for data */
+static int fd_write(struct transport *t, const void *buf, size_t size) {
+    struct fd_transport *ft = (struct fd_transport *)t;
+    struct pollfd fds = { .fd = ft->out_fd, .events = POLLOUT };
+    size_t pos = 0;
+    int ret;
+
+    while (pos < size) {
+        ret = write(ft->out_fd, (const char *)buf + pos, size - pos);
+        if (ret == -1 && errno == EAGAIN) {
+            if (poll(&fds, 1, -1) == -1)
+                return -1;
+            continue;
+        }
+        if (ret == -1)
+            return -1;
+        pos += ret;
+    }
+    return pos;
+}
+
+/* the file descriptors belong to the caller, they are not closed here */
+static void fd_close(struct transport *t) {
+    free(t);
+}
+
+struct transport *transport_fd(int in_fd, int out_fd) {
+    struct fd_transport *ft;
+
+    ft = calloc(1, sizeof(*ft));
+    if (!ft) {
+        perror("calloc");
+        return NULL;
+    }
+    ft->t.poll_fd = in_fd;
+    ft->t.read = fd_read;
+    ft->t.write = fd_write;
+    ft->t.close = fd_close;
+    ft->in_fd = in_fd;
+    ft->out_fd = out_fd;
+    return &ft->t;
+}
+
+/* shared memory: single producer, single consumer byte ring in each
+ * direction; head and tail are free running, only the producer updates head,
+ * only the consumer updates tail */
+
+struct shm_ring {
+    uint32_t head __attribute__((aligned(64)));
+    uint32_t tail __attribute__((aligned(64)));
+    /* set by the producer before it sleeps on a full ring */
+    uint32_t producer_waiting;
+    char data[SHM_RING_SIZE] __attribute__((aligned(64)));
+};
+
+/* ring 0 is from the connecting side (sender) to the listening side
+ * (receiver), ring 1 the other way */
+struct shm_area {
+    struct shm_ring ring[2];
+};
+
+/* passed over the socket, in this order */
+enum {
+    SHM_FD_MEM,
+    SHM_FD_DATA0,
+    SHM_FD_SPACE0,
+    SHM_FD_DATA1,
+    SHM_FD_SPACE1,
+    SHM_FD_COUNT,
+};
+
+struct shm_transport {
+    struct transport t;
+    /* connection to the other side, only used to detect when it goes away */
+    int sock;
+    struct shm_area *area;
+    struct shm_ring *in;
+    struct shm_ring *out;
+    /* eventfds: data is signalled by the producer, space by the consumer */
+    int in_data;
+    int in_space;
+    int out_data;
+    int out_space;
+};
+
+static int signal_eventfd(int fd) {
+    uint64_t one = 1;
+
+    if (write(fd, &one, sizeof(one)) == -1 && errno != EAGAIN) {
+        perror("write eventfd");
+        return -1;
+    }
+    return 0;
+}
+
+static int clear_eventfd(int fd) {
+    uint64_t counter;
+
+    if (read(fd, &counter, sizeof(counter)) == -1 && errno != EAGAIN) {
+        perror("read eventfd");
+        return -1;
+    }
+    return 0;
+}
+
+static int peer_closed(struct shm_transport *st) {
+    char c;
+
+    return recv(st->sock, &c, sizeof(c), MSG_PEEK | MSG_DONTWAIT) == 0;
+}
+
+static int shm_read(struct transport *t, void *buf, size_t size) {
+    struct shm_transport *st = (struct shm_transport *)t;
+    struct shm_ring *ring = st->in;
+    uint32_t head, tail, used, count, offset, first;
+
+    /* clear the wakeup before looking at the ring, anything published after
+     * this signals it again */
+    if (clear_eventfd(st->in_data) == -1)
+        return -1;
+    tail = ring->tail;
+    head = __atomic_load_n(&ring->head, __ATOMIC_ACQUIRE);
+    used = head - tail;
+    if (!used) {
+        if (peer_closed(st))
+            return 0;
+        errno = EAGAIN;
+        return -1;
+    }
+    count = used < size ? used : size;
+    offset = tail & (SHM_RING_SIZE - 1);
+    first = SHM_RING_SIZE - offset;
+    if (first > count)
+        first = count;
+    memcpy(buf, ring->data + offset, first);
+    memcpy((char *)buf + first, ring->data, count - first);
+    __atomic_store_n(&ring->tail, tail + count, __ATOMIC_SEQ_CST);
+    if (__atomic_load_n(&ring->producer_waiting, __ATOMIC_SEQ_CST))
+        if (signal_eventfd(st->in_space) == -1)
+            return -1;
+    /* keep poll_fd readable while something is left */
+    if (count < used)
+        if (signal_eventfd(st->in_data) == -1)
+            return -1;
+    return count;
+}
+
+/* returns: -1 on error (EPIPE if the other side is gone), 0 when there may be
+ * space in the ring */
+static int shm_wait_for_space(struct shm_transport *st, uint32_t head) {
+    struct shm_ring *ring = st->out;
+    struct pollfd fds[2] = {
+        { .fd = st->out_space, .events = POLLIN },
+        { .fd = st->sock, .events = POLLIN },
+    };
+    int rc = 0;
+
+    __atomic_store_n(&ring->producer_waiting, 1, __ATOMIC_SEQ_CST);
+    /* re-check after setting the flag, the consumer may have missed it */
+    if (head - __atomic_load_n(&ring->tail, __ATOMIC_SEQ_CST) == SHM_RING_SIZE) {
+        if (poll(fds, 2, -1) == -1) {
+            perror("poll");
+            rc = -1;
+        } else if (fds[1].revents && peer_closed(st)) {
+            errno = EPIPE;
+            rc = -1;
+        } else {
+            rc = clear_eventfd(st->out_space);
+        }
+    }
+    __atomic_store_n(&ring->producer_waiting, 0, __ATOMIC_SEQ_CST);
+    return rc;
+}
+
+static int shm_write(struct transport *t, const void *buf, size_t size) {
+    struct shm_transport *st = (struct shm_transport *)t;
+    struct shm_ring *ring = st->out;
+    uint32_t head, space, count, offset, first;
+    size_t pos = 0;
+
+    while (pos < size) {
+        head = ring->head;
+        space = SHM_RING_SIZE - (head - __atomic_load_n(&ring->tail,
+                    __ATOMIC_ACQUIRE));
+        if (!space) {
+            if (shm_wait_for_space(st, head) == -1)
+                return -1;
+            continue;
+        }
+        count = size - pos < space ? size - pos : space;
+        offset = head & (SHM_RING_SIZE - 1);
+        first = SHM_RING_SIZE - offset;
+        if (first > count)
+            first = count;
+        memcpy(ring->data + offset, (const char *)buf + pos, first);
+        memcpy(ring->data, (const char *)buf + pos + first, count - first);
+        __atomic_store_n(&ring->head, head + count, __ATOMIC_RELEASE);
+        if (signal_eventfd(st->out_data) == -1)
+            return -1;
+        pos += count;
+    }
+    return pos;
+}
+
+static void shm_close(struct transport *t) {
+    struct shm_transport *st = (struct shm_transport *)t;
+
+    if (st->area)
+        munmap(st->area, sizeof(*st->area));
+    if (st->t.poll_fd != -1)
+        close(st->t.poll_fd);
+    if (st->sock != -1)
+        close(st->sock);
+    if (st->in_data != -1)
+        close(st->in_data);
+    if (st->in_space != -1)
+        close(st->in_space);
+    if (st->out_data != -1)
+        close(st->out_data);
+    if (st->out_space != -1)
+        close(st->out_space);
+    free(st);
+}
+
+static int shm_address(const char *path, struct sockaddr_un *addr) {
+    memset(addr, 0, sizeof(*addr));
+    addr->sun_family = AF_UNIX;
+    if (strlen(path) >= sizeof(addr->sun_path)) {
+        fprintf(stderr, "Socket path too long: %s\n", path);
+        return -1;
+    }
+    strcpy(addr->sun_path, path);
+    return 0;
+}
+
+/* wait for the sender on path, create the shared memory and eventfds and pass
+ * them to it
+ *
+ * returns: -1 on error, connected socket otherwise; fds are filled in
+ */
+static int shm_listen(const char *path, int fds[SHM_FD_COUNT]) {
+    struct sockaddr_un addr;
+    int listen_fd, sock = -1;
+    int i;
+
+    if (shm_address(path, &addr) == -1)
+        return -1;
+    listen_fd = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+    if (listen_fd == -1) {
+        perror("socket");
+        return -1;
+    }
+    unlink(path);
+    if (bind(listen_fd, (struct sockaddr *)&addr, sizeof(addr)) == -1) {
+        perror("bind");
+        goto out;
+    }
+    if (listen(listen_fd, 1) == -1) {
+        perror("listen");
+        goto out_unlink;
+    }
+    fds[SHM_FD_MEM] = memfd_create("input-proxy", MFD_CLOEXEC);
+    if (fds[SHM_FD_MEM] == -1) {
+        perror("memfd_create");
+        goto out_unlink;
+    }
+    if (ftruncate(fds[SHM_FD_MEM], sizeof(struct shm_area)) == -1) {
+        perror("ftruncate");
+        goto out_unlink;
+    }
+    for (i = SHM_FD_DATA0; i < SHM_FD_COUNT; i++) {
+        fds[i] = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+        if (fds[i] == -1) {
+            perror("eventfd");
+            goto out_unlink;
+        }
+    }
+    sock = accept4(listen_fd, NULL, NULL, SOCK_CLOEXEC);
+    if (sock == -1)
+        perror("accept");
+
+out_unlink:
+    unlink(path);
+out:
+    close(listen_fd);
+    return sock;
+}
+
+/* connect to the receiver on path, waiting up to SHM_CONNECT_TIMEOUT for it
+ *
+ * returns: -1 on error, connected socket otherwise
+ */
+static int shm_connect(const char *path) {
+    struct sockaddr_un addr;
+    struct timespec delay = { 0, 10 * 1000 * 1000 };
+    int sock, waited;
+
+    if (shm_address(path, &addr) == -1)
+        return -1;
+    sock = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+    if (sock == -1) {
+        perror("socket");
+        return -1;
+    }
+    for (waited = 0; ; waited += 10) {
+        if (connect(sock, (struct sockaddr *)&addr, sizeof(addr)) == 0)
+            break;
+        if ((errno != ENOENT && errno != ECONNREFUSED) ||
+                waited >= SHM_CONNECT_TIMEOUT) {
+            perror("connect");
+            close(sock);
+            return -1;
+        }
+        nanosleep(&delay, NULL);
+    }
+    return sock;
+}
+
+static int shm_send_fds(int sock, const int fds[SHM_FD_COUNT]) {
+    char byte = 0;
+    struct iovec iov = { &byte, sizeof(byte) };
+    union {
+        char buf[CMSG_SPACE(sizeof(int) * SHM_FD_COUNT)];
+        struct cmsghdr align;
+    } control;
+    struct msghdr msg = {
+        .msg_iov = &iov,
+        .msg_iovlen = 1,
+        .msg_control = control.buf,
+        .msg_controllen = sizeof(control.buf),
+    };
+    struct cmsghdr *cmsg;
+
+    memset(&control, 0, sizeof(control));
+    cmsg = CMSG_FIRSTHDR(&msg);
+    cmsg->cmsg_level = SOL_SOCKET;
+    cmsg->cmsg_type = SCM_RIGHTS;
+    cmsg->cmsg_len = CMSG_LEN(sizeof(int) * SHM_FD_COUNT);
+    memcpy(CMSG_DATA(cmsg), fds, sizeof(int) * SHM_FD_COUNT);
+    if (sendmsg(sock, &msg, MSG_NOSIGNAL) == -1) {
+        perror("sendmsg");
+        return -1;
+    }
+    return 0;
+}
+
+static int shm_recv_fds(int sock, int fds[SHM_FD_COUNT]) {
+    char byte;
+    struct iovec iov = { &byte, sizeof(byte) };
+    union {
+        char buf[CMSG_SPACE(sizeof(int) * SHM_FD_COUNT)];
+        struct cmsghdr align;
+    } control;
+    struct msghdr msg = {
+        .msg_iov = &iov,
+        .msg_iovlen = 1,
+        .msg_control = control.buf,
+        .msg_controllen = sizeof(control.buf),
+    };
+    struct cmsghdr *cmsg;
+    ssize_t rc;
+
+    rc = recvmsg(sock, &msg, MSG_CMSG_CLOEXEC);
+    if (rc == -1) {
+        perror("recvmsg");
+        return -1;
+    }
+    cmsg = CMSG_FIRSTHDR(&msg);
+    if (rc == 0 || !cmsg || cmsg->cmsg_level != SOL_SOCKET ||
+            cmsg->cmsg_type != SCM_RIGHTS ||
+            cmsg->cmsg_len != CMSG_LEN(sizeof(int) * SHM_FD_COUNT)) {
+        fprintf(stderr, "Invalid shared memory setup message\n");
+        return -1;
+    }
+    memcpy(fds, CMSG_DATA(cmsg), sizeof(int) * SHM_FD_COUNT);
+    return 0;
+}
+
+static struct transport *transport_shm(const char *path, int listen) {
+    struct shm_transport *st;
+    struct epoll_event ev = { .events = EPOLLIN };
+    int fds[SHM_FD_COUNT];
+    int i;
+
+    for (i = 0; i < SHM_FD_COUNT; i++)
+        fds[i] = -1;
+    st = calloc(1, sizeof(*st));
+    if (!st) {
+        perror("calloc");
+        return NULL;
+    }
+    st->t.read = shm_read;
+    st->t.write = shm_write;
+    st->t.close = shm_close;
+    st->t.poll_fd = -1;
+
+    if (listen) {
+        st->sock = shm_listen(path, fds);
+        if (st->sock != -1 && shm_send_fds(st->sock, fds) == -1) {
+            close(st->sock);
+            st->sock = -1;
+        }
+    } else {
+        st->sock = shm_connect(path);
+        if (st->sock != -1 && shm_recv_fds(st->sock, fds) == -1) {
+            close(st->sock);
+            st->sock = -1;
+        }
+    }
+    if (listen) {
+        st->in_data = fds[SHM_FD_DATA0];
+        st->in_space = fds[SHM_FD_SPACE0];
+        st->out_data = fds[SHM_FD_DATA1];
+        st->out_space = fds[SHM_FD_SPACE1];
+    } else {
+        st->in_data = fds[SHM_FD_DATA1];
+        st->in_space = fds[SHM_FD_SPACE1];
+        st->out_data = fds[SHM_FD_DATA0];
+        st->out_space = fds[SHM_FD_SPACE0];
+    }
+    if (st->sock == -1)
+        goto err;
+
+    st->area = mmap(NULL, sizeof(*st->area), PROT_READ | PROT_WRITE,
+            MAP_SHARED, fds[SHM_FD_MEM], 0);
+    if (st->area == MAP_FAILED) {
+        perror("mmap");
+        st->area = NULL;
+        goto err;
+    }
+    st->in = &st->area->ring[listen ? 0 : 1];
+    st->out = &st->area->ring[listen ? 1 : 0];
+
+    st->t.poll_fd = epoll_create1(EPOLL_CLOEXEC);
+    if (st->t.poll_fd == -1) {
+        perror("epoll_create1");
+        goto err;
+    }
+    ev.data.fd = st->in_data;
+    if (epoll_ctl(st->t.poll_fd, EPOLL_CTL_ADD, st->in_data, &ev) == -1) {
+        perror("epoll_ctl");
+        goto err;
+    }
+    /* wakes up on disconnect, read then returns EOF */
+    ev.data.fd = st->sock;
+    if (epoll_ctl(st->t.poll_fd, EPOLL_CTL_ADD, st->sock, &ev) == -1) {
+        perror("epoll_ctl");
+        goto err;
+    }
+    close(fds[SHM_FD_MEM]);
+    return &st->t;
+
+err:
+    if (fds[SHM_FD_MEM] != -1)
+        close(fds[SHM_FD_MEM]);
+    shm_close(&st->t);
+    return NULL;
+}
+
+/* listen: whether this is the receiver side */
+struct transport *transport_open(const char *spec, int listen) {
+    if (!spec || strcmp(spec, "stdio") == 0)
+        return transport_fd(0, 1);
+    if (strncmp(spec, "shm:", 4) == 0 && spec[4])
+        return transport_shm(spec + 4, listen);
+    fprintf(stderr, "Invalid transport: %s\n", spec);
+    return NULL;
+}
+
+/* like read_all() */
+int transport_read_all(struct transport *t, void *buf, size_t size) {
+    struct pollfd fds = { .fd = t->poll_fd, .events = POLLIN };
+    size_t pos = 0;
+    int ret;
+
+    while (pos < size) {
+        ret = t->read(t, (char *)buf + pos, size - pos);
+        if (ret == -1 && errno == EAGAIN) {
+            if (poll(&fds, 1, -1) == -1)
+                return -1;
+            continue;
+        }
+        if (ret <= 0)
+            return ret;
+        pos += ret;
+    }
+    return pos;
+}
+
+/* like discard_all() */
+int transport_discard_all(struct transport *t, size_t size) {
+    char discard_buffer[128];
+    int rc = 1;
+
+    while (size) {
+        if (size < sizeof(discard_buffer))
+            rc = transport_read_all(t, discard_buffer, size);
+        else
+            rc = transport_read_all(t, discard_buffer, sizeof(discard_buffer));
+        if (rc <= 0)
+            return rc;
+        size -= rc;
+    }
+    return rc;
+}
@@ -0,0 +1,31 @@
+#include <stddef.h>
+
+/* transport between the sender and the receiver, selected with --transport:
+ *
+ * stdio - stdin/stdout, normally connected to the qrexec service (default)
+ * shm:PATH - shared memory ring buffers with eventfd wakeups, a local stand-in
+ *   for a vchan; the receiver listens on a UNIX socket at PATH, the sender
+ *   connects to it and receives the memory and eventfds over it
+ */
+#define TRANSPORT_DEFAULT "stdio"
+
+/* size of each shm ring, in bytes; must be a power of 2 */
+#define SHM_RING_SIZE (64 * 1024)
+/* how long the sender waits for the receiver's socket, in ms */
+#define SHM_CONNECT_TIMEOUT 5000
+
+struct transport {
+    /* poll for POLLIN before reading; it may be a spurious wakeup, in which
+     * case read fails with EAGAIN */
+    int poll_fd;
+    /* like read(2) */
+    int (*read)(struct transport *t, void *buf, size_t size);
+    /* like write_all() */
+    int (*write)(struct transport *t, const void *buf, size_t size);
+    void (*close)(struct transport *t);
+};
+
+struct transport *transport_fd(int in_fd, int out_fd);
+struct transport *transport_open(const char *spec, int listen);
+int transport_read_all(struct transport *t, void *buf, size_t size);
+int transport_discard_all(struct transport *t, size_t size);